@@ -0,0 +1,167 @@
+from datetime import date, datetime, time
+import json
+import math
+import pyarrow as pa
+import pyarrow.compute as pc
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from .instrumentation import span
+
+"""
+    This file contains the Arrow result helpers.
+    The query functions in server.py return their results as pyarrow Tables (columns) rather than
+        lists of per-row dicts, and the services read the columns they need straight into NumPy.
+    Tables returned by an endpoint are wrapped in ArrowJSONResponse, which encodes the JSON body
+        directly from the columns with Arrow compute kernels - no intermediate Python dicts are built.
+        Column types no query returns (lists, structs...) are still encoded, a value at a time through json.dumps.
+    Large results can be streamed instead (see streaming_response()): the rows are encoded one record batch
+        at a time as they come out of a generator, and written as NDJSON (one row object per line) or as a
+        chunked JSON array. Only one batch is held at a time, so the first byte goes out as soon as the first
+        batch is ready, and memory doesn't grow with the size of the result.
+"""
+
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+def first_value(table, column):
+    """
+    Returns the first value of a column as a Python object (e.g. the single row of get_min_date())
+    """
+    values = table.column(column)
+    return values[0].as_py() if len(values) else None
+
+# JSON strings can't hold the control characters U+0000 to U+001F - the common ones get their short escapes,
+#   the rest are written as \u00XX
+_SHORT_ESCAPES = (("\\", "\\\\"), ('"', '\\"'), ("\n", "\\n"), ("\r", "\\r"), ("\t", "\\t"))
+_CONTROL_ESCAPES = tuple(
+    (chr(code), f"\\u{code:04x}") for code in range(0x20) if chr(code) not in "\n\r\t"
+)
+
+def _escape_json_string(values):
+    for character, escaped in _SHORT_ESCAPES:
+        values = pc.replace_substring(values, character, escaped)
+    # The other control characters are rare - only look for each one if there are any at all
+    if pc.any(pc.match_substring_regex(values, "[\\x00-\\x1f]")).as_py():
+        for character, escaped in _CONTROL_ESCAPES:
+            values = pc.replace_substring(values, character, escaped)
+    return pc.binary_join_element_wise('"', values, '"', "")
+
+def _python_json(value):
+    # The same forms as the Arrow path for values inside nested columns - NaN and infinity as null, dates and times in ISO 8601
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(key): _python_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_python_json(item) for item in value]
+    return value
+
+def _dump_json(value):
+    return json.dumps(_python_json(value), separators=(",", ":"), ensure_ascii=False, default=str)
+
+def _json_values(column):
+    """
+    Encodes every value of a column as JSON text, giving a string array
+    """
+    column_type = column.type
+
+    if pa.types.is_timestamp(column_type):
+        if column_type.tz:
+            # RFC 3339 offsets have a colon (%z gives +0000) - the instants are written in UTC, as +00:00
+            utc = pc.cast(column, pa.timestamp(column_type.unit, tz="UTC"))
+            timestamps = pc.binary_join_element_wise(pc.strftime(utc, format="%Y-%m-%dT%H:%M:%S"), "+00:00", "")
+        else:
+            timestamps = pc.strftime(column, format="%Y-%m-%dT%H:%M:%S")
+        values = _escape_json_string(timestamps)
+    elif pa.types.is_date(column_type):
+        values = _escape_json_string(pc.strftime(column, format="%Y-%m-%d"))
+    elif pa.types.is_string(column_type) or pa.types.is_large_string(column_type):
+        values = _escape_json_string(column)
+    elif pa.types.is_boolean(column_type):
+        values = pc.if_else(column, "true", "false")
+    elif pa.types.is_floating(column_type):
+        # NaN and infinity aren't valid JSON
+        finite = pc.is_finite(column)
+        values = pc.if_else(finite, pc.cast(column, pa.string()), pa.scalar(None, pa.string()))
+    elif pa.types.is_integer(column_type) or pa.types.is_decimal(column_type) or pa.types.is_null(column_type):
+        values = pc.cast(column, pa.string())
+    else:
+        # Lists, structs, maps, binary, times... - no query returns these, so they take the slow path,
+        #   through Python objects, rather than failing
+        values = pa.array(
+            [None if value is None else _dump_json(value) for value in column.to_pylist()],
+            pa.string(),
+        )
+
+    return pc.fill_null(values, "null")
+
+def _encode_rows(table):
+    """
+    Encodes every row of a table (or record batch) as a JSON object, giving a string array
+    """
+    parts = []
+    for index, name in enumerate(table.column_names):
+        key = _escape_json_string(pa.array([name])).to_pylist()[0]
+        parts.append(("{" if index == 0 else ",") + key + ":")
+        parts.append(_json_values(table.column(name)))
+    parts.append("}")
+
+    rows = pc.binary_join_element_wise(*parts, "")
+    return rows.combine_chunks() if isinstance(rows, pa.ChunkedArray) else rows
+
+def _join_rows(rows, separator):
+    # Joins every row into one string without going through Python objects
+    joined = pc.binary_join(pa.ListArray.from_arrays(pa.array([0, len(rows)], pa.int32()), rows), separator)
+    return joined[0].as_buffer().to_pybytes()
+
+def encode_json(table):
+    """
+    Encodes a table as a JSON array of row objects: [{"column": value, ...}, ...]
+    """
+    if table.num_rows == 0:
+        return b"[]"
+
+    return b"[" + _join_rows(_encode_rows(table), ",") + b"]"
+
+"""
+    STREAMING
+"""
+
+def iter_ndjson(batches):
+    """
+    Encodes record batches as NDJSON - one row object per line
+    """
+    for batch in batches:
+        if batch.num_rows:
+            yield _join_rows(_encode_rows(batch), "\n") + b"\n"
+
+def iter_json_array(batches):
+    """
+    Encodes record batches as one JSON array, written a batch at a time
+    """
+    yield b"["
+    first = True
+    for batch in batches:
+        if batch.num_rows:
+            yield (b"" if first else b",") + _join_rows(_encode_rows(batch), ",")
+            first = False
+    yield b"]"
+
+def streaming_response(batches, format="ndjson"):
+    """
+    Streams record batches (any iterable of pyarrow RecordBatches or Tables) as NDJSON or a JSON array.
+    The iterable is consumed lazily - a generator over query result pages isn't run until the response is sent.
+    """
+    encode = iter_ndjson if format == "ndjson" else iter_json_array
+    return StreamingResponse(encode(batches), media_type=STREAM_MEDIA_TYPES[format])
+
+class ArrowJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        with span("encode.arrow"):
+            return encode_json(content)
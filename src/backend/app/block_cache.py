@@ -0,0 +1,170 @@
+from datetime import date, datetime, timedelta, timezone
+import os
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from cachetools import LRUCache
+from . import ride_store
+from .ride_store import MAX_STATION_ID, RIDE_SCHEMA, to_timestamp
+from .station_cube import MEASURES, daily_measures, daily_station_totals, day_numbers, station_ids
+
+"""
+    This file contains the block cache - per-station totals for whole years, months and days, used by server.py
+        to answer the date range queries when there's no station cube (see station_cube.py).
+    The dashboard's date filter produces arbitrary ranges, so almost no two requests share a query cache entry
+        (see query_cache.py), even when the ranges mostly overlap. Instead, a range is split into the fewest
+        calendar-aligned blocks, e.g.
+            2015-03-17 up to 2017-02-03  =  15 days (2015-03-17 to 31) + 9 months (2015-04 to 12) + 1 year (2016)
+                                            + 1 month (2017-01) + 2 days (2017-02-01 and 02)
+        Each block holds the station cube's measures (one array per measure, indexed by station id) and is cached
+        on its own. The blocks that aren't cached yet are fetched in one query, and the range's totals are the sum
+        of its blocks - so an overlapping range only fetches the few blocks at its edges.
+    Like the station cube, rides are counted on the day they started, and a range covers the days from start_date
+        up to (not including) end_date's day.
+    Blocks that aren't over yet (ending after today) aren't cached, since rides are still being added to them.
+"""
+
+BLOCK_CACHE_SIZE = int(os.getenv("BLOCK_CACHE_SIZE", 2048)) # blocks (about 28KB each)
+
+def next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+def decompose(first_day, end_day):
+    """
+    Splits the days from first_day up to (not including) end_day into the fewest year, month and day blocks
+    Returns a list of (first day, end day) pairs, in order
+    """
+    blocks = []
+    day = first_day
+    while day < end_day:
+        if day.month == 1 and day.day == 1 and date(day.year + 1, 1, 1) <= end_day:
+            block_end = date(day.year + 1, 1, 1)
+        elif day.day == 1 and next_month(day) <= end_day:
+            block_end = next_month(day)
+        else:
+            block_end = day + timedelta(days=1)
+        blocks.append((day, block_end))
+        day = block_end
+    return blocks
+
+def block_buckets(blocks):
+    """
+    Returns the sorted boundaries of the blocks, and the bucket number of each block
+    A day's bucket is the number of boundaries on or before it (BigQuery's RANGE_BUCKET, or np.searchsorted(side="right"))
+    """
+    boundaries = sorted({day for block in blocks for day in block})
+    return boundaries, [boundaries.index(first_day) + 1 for first_day, _ in blocks]
+
+def block_rows(blocks, buckets):
+    """
+    Maps bucket numbers (see block_buckets()) to the row of their block, -1 for buckets that aren't one of blocks
+    """
+    boundaries, numbers = block_buckets(blocks)
+    rows = np.full(len(boundaries) + 1, -1, dtype=np.int64)
+    rows[numbers] = np.arange(len(blocks))
+    return rows[buckets]
+
+def bucket_measures(blocks, buckets, start_ids, end_ids, rides, trips, duration_sums):
+    """
+    Aggregates rows of (bucket, start station, end station) -> (rides, trips, duration) into the measures of each block
+    Returns measure -> (blocks x stations) array, in the order of blocks (rows in other buckets are dropped)
+    """
+    rows = block_rows(blocks, buckets)
+    keep = rows >= 0
+    return daily_measures(
+        rows[keep], start_ids[keep], end_ids[keep],
+        rides[keep], trips[keep], duration_sums[keep],
+        num_days=len(blocks),
+    )
+
+def bucket_station_measures(blocks, buckets, station_ids, measures):
+    """
+    Aggregates rows of (bucket, station) -> measures that are already per station (measure -> array of the rows)
+        into the measures of each block
+    Returns measure -> (blocks x stations) array, in the order of blocks (rows in other buckets or without a valid
+        station are dropped)
+    """
+    rows = block_rows(blocks, buckets)
+    keep = (rows >= 0) & (station_ids >= 0) & (station_ids < MAX_STATION_ID)
+    return {
+        measure: daily_station_totals(rows[keep], station_ids[keep], len(blocks), weights=measures[measure][keep])
+        for measure in MEASURES
+    }
+
+def fetch_local_blocks(blocks):
+    """
+    Fetches the measures of blocks from the local ride store (see ride_store.py)
+    """
+    boundaries, _ = block_buckets(blocks)
+    start = datetime.combine(boundaries[0], datetime.min.time(), timezone.utc)
+    end = datetime.combine(boundaries[-1], datetime.min.time(), timezone.utc)
+    start_date_type = RIDE_SCHEMA.field("start_date").type
+
+    month_filter = (pc.field("month") >= start.strftime("%Y-%m")) & (pc.field("month") <= end.strftime("%Y-%m"))
+    date_filter = (pc.field("start_date") >= pa.scalar(start, start_date_type)) & (pc.field("start_date") < pa.scalar(end, start_date_type))
+    rides = ride_store.open_dataset().to_table(
+        columns=["start_date", "duration", "start_station_id", "end_station_id"],
+        filter=month_filter & date_filter,
+    )
+
+    epoch_boundaries = np.array([(day - date(1970, 1, 1)).days for day in boundaries], dtype=np.int64)
+    durations = pc.fill_null(rides.column("duration"), -1).to_numpy()
+    has_duration = durations >= 0
+
+    return bucket_measures(
+        blocks,
+        np.searchsorted(epoch_boundaries, day_numbers(rides.column("start_date")), side="right"),
+        station_ids(rides.column("start_station_id")),
+        station_ids(rides.column("end_station_id")),
+        rides=np.ones(len(rides)),
+        trips=has_duration.astype(np.float64),
+        duration_sums=np.where(has_duration, durations, 0).astype(np.float64),
+    )
+
+class BlockCache:
+    def __init__(self, maxsize=BLOCK_CACHE_SIZE):
+        self.blocks = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def totals(self, start_date, end_date, fetch_blocks):
+        """
+        Returns measure -> per-station totals for the date range
+        fetch_blocks(blocks) is called with the blocks that aren't cached, and returns measure -> (blocks x stations)
+        """
+        first_day = to_timestamp(start_date).date()
+        end_day = max(to_timestamp(end_date).date(), first_day)
+        blocks = decompose(first_day, end_day)
+
+        with self.lock:
+            block_totals = {block: self.blocks.get(block) for block in blocks}
+        missing = [block for block, totals in block_totals.items() if totals is None]
+
+        if missing:
+            fetched = fetch_blocks(missing)
+            for row, block in enumerate(missing):
+                block_totals[block] = {measure: fetched[measure][row] for measure in MEASURES}
+
+            today = date.today()
+            with self.lock:
+                for block in missing:
+                    if block[1] <= today:
+                        self.blocks[block] = block_totals[block]
+
+        totals = {measure: np.zeros(MAX_STATION_ID, dtype=np.int64) for measure in MEASURES}
+        for block in blocks:
+            for measure in MEASURES:
+                totals[measure] += block_totals[block][measure]
+        return totals
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+
+_cache = BlockCache()
+
+def station_totals(start_date, end_date, fetch_blocks):
+    return _cache.totals(start_date, end_date, fetch_blocks)
+
+def clear_block_cache():
+    _cache.clear()
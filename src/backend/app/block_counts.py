@@ -0,0 +1,163 @@
+from datetime import date, timedelta
+from pathlib import Path
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from .ride_store import to_timestamp
+from .block_cache import decompose, next_month
+
+"""
+    This file contains the block count store shared by the flow matrix (flow_matrix.py) and the temporal
+        profiles (profile_tensor.py) - sparse counts over a numbered key space (station pairs, or
+        station / day of week / hour cells), precomputed per day, month and year.
+    Only the keys with a count are kept - as sorted (key, count) entries per block, with an offset array per
+        level, like a CSR matrix with one row per block.
+    The counts between two dates are summed from the fewest day / month / year blocks that cover them
+        (the same decomposition as block_cache.py), so a long range reads a few year rows instead of every day.
+    Like the station cube, rides are counted on the day they started, and a range covers the days from start_date
+        up to (not including) end_date's day.
+    A store is saved as an uncompressed Arrow IPC file of (level, block, key, count) - sorted - and memory-mapped.
+"""
+
+LEVELS = ["day", "month", "year"]
+EPOCH = date(1970, 1, 1)
+
+def block_level(first_day, end_day):
+    if end_day - first_day == timedelta(days=1):
+        return "day"
+    if end_day == next_month(first_day):
+        return "month"
+    return "year"
+
+def block_starts(days, level):
+    """
+    Converts epoch day numbers into the epoch day of the start of their day / month / year block
+    """
+    if level == "day":
+        return days
+    unit = "M" if level == "month" else "Y"
+    return days.astype("datetime64[D]").astype(f"datetime64[{unit}]").astype("datetime64[D]").astype(np.int64)
+
+class BlockCounts:
+    def __init__(self, levels, blocks, keys, counts, num_keys):
+        """
+        Columns of the (level, block, key, count) entries, sorted - level is the index into LEVELS,
+            block is the epoch day its block starts on (may be read-only, e.g. memory-mapped)
+        num_keys: size of the key space
+        """
+        self.keys = keys
+        self.counts = counts
+        self.num_keys = num_keys
+
+        # Per level: the blocks it holds, and the offset of each block's entries (CSR)
+        self.block_index = {}
+        for code, level in enumerate(LEVELS):
+            start, end = np.searchsorted(levels, [code, code + 1])
+            block_keys, first = np.unique(blocks[start:end], return_index=True)
+            self.block_index[level] = (block_keys, np.append(first, end - start) + start)
+
+    def block_entries(self, first_day, end_day):
+        """
+        Returns the slice of entries holding a block (empty if it has no counts)
+        """
+        block_keys, offsets = self.block_index[block_level(first_day, end_day)]
+        block_key = (first_day - EPOCH).days
+        index = np.searchsorted(block_keys, block_key)
+        if index == len(block_keys) or block_keys[index] != block_key:
+            return slice(0, 0)
+        return slice(offsets[index], offsets[index + 1])
+
+    def range_entries(self, start_date, end_date):
+        """
+        Returns the (keys, counts) entries of every block covering the date range (keys may repeat)
+        """
+        first_day = to_timestamp(start_date).date()
+        end_day = max(to_timestamp(end_date).date(), first_day)
+        entries = [self.block_entries(*block) for block in decompose(first_day, end_day)]
+
+        keys = np.concatenate([self.keys[entry] for entry in entries] + [np.empty(0, np.int32)])
+        counts = np.concatenate([self.counts[entry] for entry in entries] + [np.empty(0, np.int64)])
+        return keys, counts
+
+    def totals(self, start_date, end_date):
+        """
+        Returns the dense vector of counts for the date range, indexed by key
+        """
+        keys, counts = self.range_entries(start_date, end_date)
+        return np.bincount(keys, weights=counts, minlength=self.num_keys).astype(np.int64)
+
+    def sparse_totals(self, start_date, end_date):
+        """
+        Returns (keys, counts) for every key with a count in the date range, in key order
+        """
+        keys, counts = self.range_entries(start_date, end_date)
+
+        # A few entries are merged by sorting them, more by counting into a dense vector of every key
+        if len(keys) < self.num_keys // 16:
+            return merge_counts([(keys.astype(np.int64), counts)])
+
+        totals = np.bincount(keys, weights=counts, minlength=self.num_keys)
+        keys = np.flatnonzero(totals)
+        return keys, totals[keys].astype(np.int64)
+
+"""
+    BUILD
+"""
+
+def merge_counts(parts):
+    """
+    Merges (keys, counts) parts into one, summing the counts of equal keys
+    """
+    keys = np.concatenate([part_keys for part_keys, _ in parts] + [np.empty(0, np.int64)])
+    counts = np.concatenate([part_counts for _, part_counts in parts] + [np.empty(0, np.int64)])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+
+def daily_counts(days, keys, counts, num_keys):
+    """
+    Aggregates rows of (epoch day, key, count) into sorted (day * num_keys + key) entries and their summed counts
+    """
+    return merge_counts([(days * num_keys + keys, counts)])
+
+def block_table(day_keys, counts, num_keys):
+    """
+    Rolls the daily (day * num_keys + key, count) entries up into the day, month and year levels
+    Returns the sorted (level, block, key, count) table that's saved to disk
+    """
+    days = day_keys // num_keys
+    keys = day_keys % num_keys
+
+    levels = []
+    for code, level in enumerate(LEVELS):
+        level_keys, level_counts = merge_counts([(block_starts(days, level) * num_keys + keys, counts)])
+        levels.append(pa.table({
+            "level": pa.array(np.full(len(level_keys), code, dtype=np.int8)),
+            "block": pa.array((level_keys // num_keys).astype(np.int32)),
+            "key": pa.array((level_keys % num_keys).astype(np.int32)),
+            "count": pa.array(level_counts),
+        }))
+    return pa.concat_tables(levels).combine_chunks()
+
+def save_block_table(table, path):
+    """
+    Writes the table to a temporary file and swaps it in, so the API never loads a half-written store
+    Uncompressed, so the columns can be memory-mapped straight from the file
+    """
+    path = Path(path)
+    temporary_path = path.with_name(path.name + ".tmp")
+    with ipc.new_file(str(temporary_path), table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temporary_path, path)
+
+def load_block_table(path):
+    """
+    Memory-maps a saved store - returns its (level, block, key, count) columns as read-only views of the file
+    """
+    with pa.memory_map(str(path), "r") as source:
+        table = ipc.open_file(source).read_all()
+
+    return [
+        table.column(name).chunk(0).to_numpy() if table.num_rows else np.empty(0, dtype)
+        for name, dtype in (("level", np.int8), ("block", np.int32), ("key", np.int32), ("count", np.int64))
+    ]
@@ -0,0 +1,136 @@
+import numpy as np
+import pyarrow.compute as pc
+
+"""
+    This file contains the borough aggregation engine used by the borough rankings in services.py.
+    Station-level values (ride counts, usage averages) come in as columns of the query results,
+        and are grouped into boroughs in one vectorized pass with np.bincount, using the
+        station id -> borough code index from the station registry.
+    Top/bottom-k selection uses np.argpartition, so only the k selected boroughs are sorted.
+"""
+
+def station_arrays(stations, *columns):
+    """
+    Reads the station_id column and the requested value columns of a query result (a pyarrow Table)
+        into NumPy arrays
+    """
+    station_ids = pc.fill_null(stations.column("station_id"), -1).to_numpy().astype(np.int64)
+    values = [
+        pc.fill_null(stations.column(column), 0).to_numpy().astype(np.float64)
+        for column in columns
+    ]
+    return station_ids, *values
+
+def borough_codes(registry, station_ids, warn=True):
+    """
+    Looks up the borough code of every station id (-1 where the station or its borough is unknown)
+    """
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+    index = registry.borough_by_station_id
+    in_range = (station_ids >= 0) & (station_ids < len(index))
+    codes = np.where(in_range, index[np.where(in_range, station_ids, 0)], -1)
+
+    if warn:
+        for station_id in station_ids[codes < 0]:
+            print(f"Warning: No borough found for station ID {station_id}")
+
+    return codes
+
+def borough_totals(registry, codes, values):
+    """
+    Group-by borough: returns the total of values per borough code
+    """
+    known = codes >= 0
+    return np.bincount(codes[known], weights=values[known], minlength=len(registry.borough_names))
+
+def boroughs_in_order_seen(codes):
+    """
+    Returns the borough codes that appear in codes, in the order they first appear
+    (so boroughs with equal values are ranked in the same order as the input stations)
+    """
+    boroughs, first_seen = np.unique(codes[codes >= 0], return_index=True)
+    return boroughs[np.argsort(first_seen)]
+
+def per_capita(registry, totals, boroughs, warn=True):
+    """
+    Divides each selected borough's total by its population - NaN where the population is unknown
+    """
+    populations = registry.borough_populations[boroughs]
+    missing = np.isnan(populations) | (populations == 0)
+
+    if warn:
+        for code in boroughs[missing]:
+            print(f"Warning: No population found for borough: {registry.borough_names[code]}")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(missing, np.nan, totals[boroughs] / populations)
+
+def pct_change(starting, ending):
+    # Floors both sides at 1 to avoid division by zero
+    start = np.maximum(starting, 1)
+    end = np.maximum(ending, 1)
+    return (end - start) / start * 100
+
+def top_k(values, k, largest=True):
+    """
+    Returns the positions of the k largest (or smallest) values, in order
+    Ties keep their original order
+    """
+    k = min(k, len(values))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    keys = -values if largest else values
+    if k < len(values):
+        # np.argpartition picks arbitrarily between values tied at the cut-off - the earliest ones are kept instead
+        threshold = np.partition(keys, k - 1)[k - 1]
+        if np.isnan(threshold):
+            # NaNs sort last - every number is kept, and the first NaNs make up the rest
+            before, tied = ~np.isnan(keys), np.isnan(keys)
+        else:
+            before, tied = keys < threshold, keys == threshold
+        selected = np.concatenate([np.flatnonzero(before), np.flatnonzero(tied)[:k - np.count_nonzero(before)]])
+        selected.sort()
+    else:
+        selected = np.arange(len(values))
+
+    return selected[np.argsort(keys[selected], kind="stable")]
+
+"""
+--------------
+    RANKINGS
+--------------
+"""
+
+def rides_per_capita(registry, station_ids, total_rides, round_to=None):
+    """
+    Returns (borough codes, rates) for every borough with at least one station in the input
+        and a known population
+    """
+    codes = borough_codes(registry, station_ids)
+    totals = borough_totals(registry, codes, total_rides)
+
+    boroughs = boroughs_in_order_seen(codes)
+    rates = per_capita(registry, totals, boroughs)
+
+    has_rate = ~np.isnan(rates)
+    boroughs, rates = boroughs[has_rate], rates[has_rate]
+    if round_to is not None:
+        # Python's round() so the rates match the values the API has always returned
+        rates = np.array([round(rate, round_to) for rate in rates.tolist()], dtype=np.float64)
+
+    return boroughs, rates
+
+def usage_change(registry, station_ids, starting_avgs, ending_avgs):
+    """
+    Returns (borough codes, starting totals, ending totals, pct changes) for every borough
+        with at least one station in the input
+    """
+    codes = borough_codes(registry, station_ids, warn=False)
+    starting = borough_totals(registry, codes, starting_avgs)
+    ending = borough_totals(registry, codes, ending_avgs)
+
+    boroughs = boroughs_in_order_seen(codes)
+    starting, ending = starting[boroughs], ending[boroughs]
+
+    return boroughs, starting, ending, pct_change(starting, ending)
@@ -0,0 +1,171 @@
+from pathlib import Path
+import os
+import numpy as np
+from .station_registry import DATA_PATH, load_json
+
+"""
+    This file contains the borough assignment - which borough each station is in, worked out from the
+        London borough boundary shapefile rather than looked up one station at a time.
+    The shapefile is loaded once into a BoundaryIndex: the polygons go into a Shapely STRtree (an R-tree),
+        and all the stations are assigned in one batch query against it, which tests each point only against
+        the polygons whose bounding boxes contain it (Shapely prepares the geometries for the predicate).
+    The boundaries exclude the river (MHW = mean high water), so a station on the embankment or a bridge can
+        fall just outside every polygon - those are given the nearest borough within NEAREST_MAX_DISTANCE metres.
+    The result is a compact station -> borough code table (station_boroughs.npz in utils/data):
+        - borough_names:          the borough names, indexed by code
+        - borough_by_station_id:  the borough code of every station id (-1 where unknown)
+    When the table exists, the station registry takes the station boroughs from it (see station_registry.py).
+    geopandas (and Shapely 2) are only needed to build the table, not to serve the API.
+    From /src:
+        python -m backend.app.borough_assignment    rebuilds the table and lists the stations whose borough changed
+"""
+
+BOROUGH_BOUNDARIES_PATH = Path(os.getenv(
+    "BOROUGH_BOUNDARIES_PATH",
+    Path(__file__).parent / "utils/borough_data_tests/London_Borough_Boundary_Data/London_Borough_Excluding_MHW.shp",
+))
+STATION_BOROUGHS_PATH = Path(os.getenv("STATION_BOROUGHS_PATH", DATA_PATH / "station_boroughs.npz"))
+
+NEAREST_MAX_DISTANCE = 100 # metres
+
+class BoundaryIndex:
+    def __init__(self, names, geometries, crs):
+        """
+        names: the name of each boundary polygon
+        geometries: array of Shapely polygons, in a projected CRS measured in metres
+        crs: the CRS of the geometries
+        """
+        from shapely import STRtree
+
+        self.names = tuple(names)
+        self.geometries = geometries
+        self.crs = crs
+        self.tree = STRtree(geometries)
+
+    def project(self, latitudes, longitudes):
+        """
+        Converts WGS84 coordinates into Shapely points in the boundaries' CRS
+        """
+        import geopandas as gpd
+
+        points = gpd.GeoSeries(gpd.points_from_xy(longitudes, latitudes), crs="EPSG:4326")
+        return points.to_crs(self.crs).values
+
+    def assign(self, latitudes, longitudes, max_distance=NEAREST_MAX_DISTANCE):
+        """
+        Returns the index of the polygon containing each point (-1 where there's none within max_distance)
+        Points with unknown (NaN) coordinates get -1
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        codes = np.full(len(latitudes), -1, dtype=np.int64)
+
+        known = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+        if len(known) == 0:
+            return codes
+        points = self.project(latitudes[known], longitudes[known])
+
+        # Every (point, polygon) pair where the point is inside - reversed so the first match wins on shared edges
+        point_index, polygon_index = self.tree.query(points, predicate="within")
+        codes[known[point_index[::-1]]] = polygon_index[::-1]
+
+        # Points that fell in a gap between the polygons (e.g. the river)
+        outside = np.flatnonzero(codes[known] < 0)
+        if len(outside) and max_distance:
+            point_index, polygon_index = self.tree.query_nearest(points[outside], max_distance=max_distance, all_matches=False)
+            codes[known[outside[point_index]]] = polygon_index
+
+        return codes
+
+_boundaries = {}
+
+def load_boundaries(path=BOROUGH_BOUNDARIES_PATH, name_column="NAME"):
+    """
+    Loads a boundary shapefile into a BoundaryIndex - once per file
+    """
+    key = (str(path), name_column)
+    if key not in _boundaries:
+        try:
+            import geopandas as gpd
+        except ImportError:
+            raise ImportError("Assigning boroughs needs geopandas - pip install geopandas") from None
+
+        frame = gpd.read_file(path)
+        if frame.crs is None or frame.crs.is_geographic:
+            # Distances need to be in metres
+            frame = frame.to_crs("EPSG:27700")
+        _boundaries[key] = BoundaryIndex(
+            frame[name_column].astype(str).str.strip().tolist(), frame.geometry.values, frame.crs
+        )
+
+    return _boundaries[key]
+
+"""
+--------------------
+    STATION TABLE
+--------------------
+"""
+
+def assign_station_boroughs(station_ids, latitudes, longitudes, boundaries=None):
+    """
+    Returns (borough names, borough code of every station id) - the station -> borough code table
+    """
+    boundaries = boundaries if boundaries is not None else load_boundaries()
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+
+    codes = boundaries.assign(latitudes, longitudes)
+    borough_by_station_id = np.full(int(station_ids.max(initial=0)) + 1, -1, dtype=np.int16)
+    borough_by_station_id[station_ids] = codes
+
+    return boundaries.names, borough_by_station_id
+
+def save_station_boroughs(borough_names, borough_by_station_id, path=STATION_BOROUGHS_PATH):
+    path = Path(path)
+    temporary_path = path.with_name(path.name + ".tmp")
+    with temporary_path.open("wb") as file:
+        np.savez(file, borough_names=np.array(borough_names, dtype=str), borough_by_station_id=borough_by_station_id)
+    os.replace(temporary_path, path)
+
+def load_station_boroughs(path=STATION_BOROUGHS_PATH):
+    """
+    Returns (borough names, borough code of every station id), or None if the table hasn't been built
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        return tuple(data["borough_names"].tolist()), data["borough_by_station_id"].astype(np.int64)
+
+def build_station_boroughs():
+    """
+    Assigns every station in station_coords.json to a borough and saves the table
+    Returns the table, and the stations whose borough differs from station_details.json
+    """
+    station_coords = [station for station in load_json("station_coords.json") if station.get("id") is not None]
+    station_ids = [station["id"] for station in station_coords]
+    borough_names, borough_by_station_id = assign_station_boroughs(
+        station_ids,
+        [station.get("latitude", np.nan) for station in station_coords],
+        [station.get("longitude", np.nan) for station in station_coords],
+    )
+    save_station_boroughs(borough_names, borough_by_station_id)
+
+    # Compare with the boroughs in the station details (looked up by id, not searched)
+    stored_boroughs = {station["id"]: station.get("borough") for station in load_json("station_details.json")}
+    changes = []
+    for station_id in station_ids:
+        code = borough_by_station_id[station_id]
+        borough = borough_names[code] if code >= 0 else None
+        stored = stored_boroughs.get(station_id)
+        if (stored or "").strip().lower() != (borough or "").lower():
+            changes.append((station_id, stored, borough))
+
+    return (borough_names, borough_by_station_id), changes
+
+if __name__ == "__main__":
+    (borough_names, borough_by_station_id), changes = build_station_boroughs()
+
+    for station_id, stored, borough in changes:
+        print(f"🔄 ID {station_id}: '{stored}' → '{borough}'")
+    assigned = int(np.count_nonzero(borough_by_station_id >= 0))
+    print(f"✅ {assigned} stations assigned to {len(borough_names)} boroughs, saved to {STATION_BOROUGHS_PATH}. {len(changes)} differ from station_details.json")
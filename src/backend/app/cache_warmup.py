@@ -0,0 +1,285 @@
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from pathlib import Path
+import asyncio
+import json
+import os
+import threading
+import time
+from . import server
+from .arrow_results import first_value
+from .query_cache import QUERY_CACHE_TTL
+from .query_executor import run_query
+from .ride_store import to_timestamp
+from .usage_windows import DEFAULT_WINDOW_MONTHS
+
+try:
+    import fcntl
+except ImportError:
+    # Windows - there are no file locks, so every worker warms up on its own
+    fcntl = None
+
+"""
+    This file contains the cache warm-up - a background task, started with the app, that runs the dashboard's
+        queries ahead of the users, so the first dashboard load after a deploy is answered from the query cache.
+    Each round warms get_ordered_stations (the borough and hot spot panels), get_trip_totals (the CO2 offset panel)
+        and the change in usage query (with the default window) for:
+        - the default range, from get_min_date() to get_max_date() (what the dashboard opens with)
+        - each calendar year
+        - the WARMUP_TOP_RANGES ranges users have requested most often
+    The requested ranges are counted once per dashboard load (record_range(), from /db/hot_spots and /dashboard)
+        and saved to popular_ranges.json after every round, so the most popular ranges are still known after a restart.
+    Every uvicorn worker counts the ranges it serves and adds them to the file (under a file lock, so the workers
+        never overwrite each other's counts), but only one worker warms up - the one holding the lock on
+        WARMUP_LOCK_PATH (see warmup_loop()).
+    The queries go through the same thread pool as the requests (see query_executor.py), at most WARMUP_CONCURRENCY
+        at a time, so a round never takes over the pool. A request for a range that's being warmed shares the
+        running query (see query_cache.py).
+    The app doesn't wait for the warm-up - requests are served from the start, the warm-up only makes them faster.
+    A round runs at startup and then every WARMUP_INTERVAL seconds (the query cache TTL by default, so the entries
+        are put back as they expire) - set WARMUP_INTERVAL=0 to only warm up at startup, or CACHE_WARMUP=0 to turn it off.
+"""
+
+CACHE_WARMUP = os.getenv("CACHE_WARMUP", "1") == "1"
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", 2)) # queries at a time
+WARMUP_INTERVAL = int(os.getenv("WARMUP_INTERVAL", QUERY_CACHE_TTL)) # seconds between rounds
+WARMUP_TOP_RANGES = int(os.getenv("WARMUP_TOP_RANGES", 10))
+
+POPULAR_RANGES_PATH = Path(os.getenv("POPULAR_RANGES_PATH", Path(__file__).parent / "utils/data" / "popular_ranges.json"))
+WARMUP_LOCK_PATH = Path(os.getenv("WARMUP_LOCK_PATH", Path(__file__).parent / "utils/data" / "cache_warmup.lock"))
+
+# Ranges counted at most - when there are more, the least requested half is dropped
+MAX_TRACKED_RANGES = 1000
+
+# The query functions warmed for each range, with their arguments after (start_date, end_date) -
+#   the same arguments the endpoints pass, so the warmed results land on the same cache keys
+WARMED_QUERIES = [
+    (server.get_ordered_stations, ()),
+    (server.get_trip_totals, ()),
+    (server.get_change_in_monthly_average_use_foreach_station, (DEFAULT_WINDOW_MONTHS,)),
+]
+
+"""
+    POPULAR RANGES
+"""
+
+# The counts last read from popular_ranges.json (every worker's), and the requests this process has counted since
+_saved_counts = Counter()
+_unsaved_counts = Counter()
+_range_lock = threading.Lock()
+
+def range_key(start_date, end_date):
+    # The same normalised form as the query cache keys (see query_cache.normalise_argument())
+    return to_timestamp(start_date).isoformat(), to_timestamp(end_date).isoformat()
+
+def record_range(start_date, end_date):
+    """
+    Counts a date range requested by the dashboard - invalid dates are ignored (the endpoint reports them)
+    """
+    try:
+        key = range_key(start_date, end_date)
+    except ValueError:
+        return
+
+    with _range_lock:
+        _unsaved_counts[key] += 1
+        if len(_unsaved_counts) > MAX_TRACKED_RANGES:
+            trim_counts(_unsaved_counts)
+
+def trim_counts(counts):
+    # Keeps the most requested half when there are more than MAX_TRACKED_RANGES ranges
+    if len(counts) > MAX_TRACKED_RANGES:
+        kept = counts.most_common(MAX_TRACKED_RANGES // 2)
+        counts.clear()
+        counts.update(dict(kept))
+
+def popular_ranges(top_n=WARMUP_TOP_RANGES):
+    with _range_lock:
+        return [key for key, _ in (_saved_counts + _unsaved_counts).most_common(top_n)]
+
+def try_lock(path):
+    """
+    Takes an exclusive lock on a lock file without waiting - returns the open file that holds it (until it's
+        closed, or the process exits), or None if another process holds it
+    Without fcntl (on Windows), nothing is locked and every caller gets the lock
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    file = path.open("a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+    return file
+
+@contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on a lock file while the with block runs, waiting for it if another process holds it
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        yield
+
+def read_popular_ranges(path=POPULAR_RANGES_PATH):
+    path = Path(path)
+    counts = Counter()
+    if path.exists():
+        with path.open("r") as file:
+            for entry in json.load(file):
+                counts[(entry["start_date"], entry["end_date"])] += entry["requests"]
+    return counts
+
+def save_popular_ranges(path=POPULAR_RANGES_PATH):
+    """
+    Adds the requests counted since the last save to the counts on disk - every worker saves its own requests,
+        so the file is read and rewritten under a lock, and each worker only adds what it counted
+    Also picks up the other workers' counts, for popular_ranges()
+    """
+    global _saved_counts
+
+    with _range_lock:
+        unsaved = _unsaved_counts.copy()
+        _unsaved_counts.clear()
+
+    path = Path(path)
+    try:
+        with file_lock(path.with_name(path.name + ".lock")):
+            try:
+                counts = read_popular_ranges(path)
+            except (ValueError, KeyError) as error:
+                print(f"Warning: Couldn't read the popular ranges from {path}, starting over: {error!r}")
+                counts = Counter()
+            counts.update(unsaved)
+            trim_counts(counts)
+            saved = [
+                {"start_date": start_date, "end_date": end_date, "requests": requests}
+                for (start_date, end_date), requests in counts.most_common()
+            ]
+
+            temporary_path = path.with_name(path.name + ".tmp")
+            with temporary_path.open("w") as file:
+                json.dump(saved, file, indent=2)
+            os.replace(temporary_path, path)
+    except BaseException:
+        # Counted again next time
+        with _range_lock:
+            _unsaved_counts.update(unsaved)
+        raise
+
+    with _range_lock:
+        _saved_counts = counts
+
+def store_popular_ranges():
+    try:
+        save_popular_ranges()
+    except OSError as error:
+        print(f"Warning: Couldn't save the popular ranges to {POPULAR_RANGES_PATH}: {error!r}")
+
+"""
+    WARM-UP
+"""
+
+_status = {"enabled": CACHE_WARMUP, "leader": False, "running": False, "rounds": 0, "last_started": None, "last_duration_s": None, "queries": 0, "failed": 0}
+
+def warmup_status():
+    return dict(_status)
+
+def warmup_ranges(min_date, max_date, top_n=WARMUP_TOP_RANGES):
+    """
+    Returns the (start_date, end_date) ranges to warm - the default range, each calendar year, then the most
+        requested ranges - without repeats
+    """
+    first_day, last_day = min_date.date(), max_date.date()
+    ranges = [(first_day.isoformat(), last_day.isoformat())]
+    for year in range(first_day.year, last_day.year + 1):
+        ranges.append((max(date(year, 1, 1), first_day).isoformat(), min(date(year + 1, 1, 1), last_day).isoformat()))
+    ranges += popular_ranges(top_n)
+
+    unique = {}
+    for start_date, end_date in ranges:
+        unique.setdefault(range_key(start_date, end_date), (start_date, end_date))
+    return list(unique.values())
+
+async def warm_up():
+    """
+    Runs one round of warm-up queries, at most WARMUP_CONCURRENCY at a time
+    Returns (queries run, queries failed)
+    """
+    min_date = first_value(await run_query(None, server.get_min_date), "min_date")
+    max_date = first_value(await run_query(None, server.get_max_date), "max_date")
+    if min_date is None or max_date is None:
+        return 0, 0
+
+    semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+    errors = []
+
+    async def warm(query_function, args):
+        async with semaphore:
+            try:
+                await run_query(None, query_function, *args)
+            except Exception as error:
+                errors.append(error)
+
+    queries = [
+        (query_function, (start_date, end_date) + extra_args)
+        for start_date, end_date in warmup_ranges(min_date, max_date)
+        for query_function, extra_args in WARMED_QUERIES
+    ]
+    await asyncio.gather(*(warm(query_function, args) for query_function, args in queries))
+
+    if errors:
+        print(f"Warning: {len(errors)} of {len(queries)} cache warm-up queries failed (first error: {errors[0]!r})")
+    return len(queries), len(errors)
+
+async def warmup_round():
+    _status["running"] = True
+    _status["last_started"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    started = time.perf_counter()
+    try:
+        _status["queries"], _status["failed"] = await warm_up()
+    except Exception as error:
+        print(f"Warning: Cache warm-up failed: {error!r}")
+    _status["running"] = False
+    _status["rounds"] += 1
+    _status["last_duration_s"] = round(time.perf_counter() - started, 3)
+
+async def warmup_loop():
+    """
+    Every WARMUP_INTERVAL seconds, until it's cancelled: saves the ranges this worker counted, and warms the
+        caches if this worker is the warm-up leader
+    Every uvicorn worker runs the loop, but only the one holding the lock on WARMUP_LOCK_PATH warms up -
+        the others try to take it over on every round, so a new leader takes over when the leader's process exits
+    """
+    leader_lock = None
+    try:
+        while True:
+            # In a thread - the file lock can wait on another worker, and the event loop keeps serving requests
+            await asyncio.to_thread(store_popular_ranges)
+            if leader_lock is None:
+                leader_lock = try_lock(WARMUP_LOCK_PATH)
+                _status["leader"] = leader_lock is not None
+            # With WARMUP_INTERVAL=0, the leader only warms up once, but the counts are still saved
+            if leader_lock is not None and (WARMUP_INTERVAL > 0 or _status["rounds"] == 0):
+                await warmup_round()
+            await asyncio.sleep(WARMUP_INTERVAL if WARMUP_INTERVAL > 0 else QUERY_CACHE_TTL)
+    finally:
+        # Also on shutdown, so the ranges counted since the last save aren't lost
+        _status["running"] = False
+        await asyncio.to_thread(store_popular_ranges)
+        if leader_lock is not None:
+            leader_lock.close()
+
+def start_warmup():
+    """
+    Starts the warm-up in the background (called from the app's lifespan) - returns its task, or None if it's off
+    """
+    if not CACHE_WARMUP:
+        return None
+    return asyncio.create_task(warmup_loop())
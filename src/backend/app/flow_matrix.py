@@ -0,0 +1,160 @@
+from pathlib import Path
+import os
+import sys
+import numpy as np
+import pyarrow.compute as pc
+from . import ride_store
+from .ride_store import MAX_STATION_ID
+from .block_counts import BlockCounts, block_table, daily_counts, merge_counts, save_block_table, load_block_table
+from .station_cube import day_numbers, station_ids
+from .borough_aggregation import borough_codes, top_k
+from .instrumentation import span
+
+"""
+    This file contains the origin-destination flow matrix - the number of rides between every pair of stations,
+        precomputed from the ride store (or BigQuery), so the flows endpoint never touches the rides themselves.
+    A station pair is numbered start_station_id * MAX_STATION_ID + end_station_id, and the rides per pair are
+        kept sparse, per day, month and year, in a block count store (see block_counts.py) - so the flows for
+        any date range are summed from a few blocks.
+    Only rides between two known stations (below MAX_STATION_ID) count.
+    From /src:
+        python -m backend.app.flow_matrix             builds the flow matrix from the local ride store
+        python -m backend.app.flow_matrix bigquery    builds it from BigQuery
+"""
+
+FLOW_MATRIX_PATH = Path(os.getenv("FLOW_MATRIX_PATH", Path(__file__).parent / "utils/data" / "flow_matrix.arrow"))
+
+NUM_PAIRS = MAX_STATION_ID * MAX_STATION_ID
+
+class FlowMatrix(BlockCounts):
+    def __init__(self, levels, blocks, pairs, rides):
+        super().__init__(levels, blocks, pairs, rides, NUM_PAIRS)
+
+    def pair_totals(self, start_date, end_date):
+        """
+        Returns (pairs, rides) for every station pair with rides in the date range, in pair order
+        """
+        return self.sparse_totals(start_date, end_date)
+
+    def top_flows(self, start_date, end_date, top_n=10):
+        """
+        Returns (start station ids, end station ids, rides) of the top_n busiest station pairs, busiest first
+        """
+        pairs, rides = self.pair_totals(start_date, end_date)
+        selected = top_k(rides, top_n, largest=True)
+        return pairs[selected] // MAX_STATION_ID, pairs[selected] % MAX_STATION_ID, rides[selected]
+
+    def borough_flows(self, registry, start_date, end_date):
+        """
+        Returns the (boroughs x boroughs) matrix of rides between boroughs, indexed by borough code
+        Rides to or from a station without a borough are left out
+        """
+        pairs, rides = self.pair_totals(start_date, end_date)
+        station_boroughs = borough_codes(registry, np.arange(MAX_STATION_ID), warn=False)
+        start_codes = station_boroughs[pairs // MAX_STATION_ID]
+        end_codes = station_boroughs[pairs % MAX_STATION_ID]
+
+        known = (start_codes >= 0) & (end_codes >= 0)
+        num_boroughs = len(registry.borough_names)
+        flows = np.bincount(
+            start_codes[known] * num_boroughs + end_codes[known],
+            weights=rides[known],
+            minlength=num_boroughs * num_boroughs,
+        )
+        return flows.reshape(num_boroughs, num_boroughs).astype(np.int64)
+
+"""
+--------------
+    LOADING
+--------------
+"""
+
+_flow_matrix = None
+_flow_matrix_mtime = None
+
+def get_flow_matrix():
+    """
+    Returns the flow matrix, loading it the first time it's needed (or when the file on disk has changed)
+    Returns None if it hasn't been built
+    """
+    global _flow_matrix, _flow_matrix_mtime
+
+    if not FLOW_MATRIX_PATH.exists():
+        return None
+
+    mtime = FLOW_MATRIX_PATH.stat().st_mtime
+    if _flow_matrix is None or mtime != _flow_matrix_mtime:
+        with span("load.flow_matrix"):
+            _flow_matrix = FlowMatrix(*load_block_table(FLOW_MATRIX_PATH))
+        _flow_matrix_mtime = mtime
+
+    return _flow_matrix
+
+"""
+--------------
+    BUILD
+--------------
+"""
+
+def daily_flows(days, start_ids, end_ids, rides):
+    """
+    Aggregates rows of (epoch day, start station, end station, rides) into sorted (day * NUM_PAIRS + pair) keys
+        and their summed rides - rows without two known stations are dropped
+    """
+    valid = (start_ids >= 0) & (start_ids < MAX_STATION_ID) & (end_ids >= 0) & (end_ids < MAX_STATION_ID)
+    pairs = start_ids[valid] * MAX_STATION_ID + end_ids[valid]
+    return daily_counts(days[valid], pairs, rides[valid], NUM_PAIRS)
+
+def build_flow_matrix():
+    """
+    Builds the flow matrix table from the local ride store, one record batch at a time
+    """
+    parts = []
+    columns = ["start_date", "start_station_id", "end_station_id"]
+    for batch in ride_store.open_dataset().to_batches(columns=columns):
+        parts.append(daily_flows(
+            day_numbers(batch.column("start_date")),
+            station_ids(batch.column("start_station_id")),
+            station_ids(batch.column("end_station_id")),
+            np.ones(len(batch)),
+        ))
+    return block_table(*merge_counts(parts), NUM_PAIRS)
+
+def build_flow_matrix_from_bigquery(client):
+    """
+    Builds the flow matrix table from BigQuery, with the rides already aggregated per day and station pair
+    """
+    query = """
+    SELECT DATE(start_date) AS day, start_station_id, end_station_id, COUNT(*) AS rides
+    FROM `bigquery-public-data.london_bicycles.cycle_hire`
+    WHERE start_date IS NOT NULL
+    AND start_station_id < @max_station_id AND end_station_id < @max_station_id
+    GROUP BY day, start_station_id, end_station_id
+    """
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("max_station_id", "INT64", MAX_STATION_ID),
+    ])
+    rows = client.query(query, job_config=job_config).to_arrow()
+
+    return block_table(*daily_flows(
+        day_numbers(rows.column("day")),
+        station_ids(rows.column("start_station_id")),
+        station_ids(rows.column("end_station_id")),
+        rows.column("rides").to_numpy().astype(np.float64),
+    ), NUM_PAIRS)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bigquery"]:
+        from google.cloud import bigquery
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        table = build_flow_matrix_from_bigquery(bigquery.Client())
+    else:
+        table = build_flow_matrix()
+
+    save_block_table(table, FLOW_MATRIX_PATH)
+    num_daily = pc.sum(pc.equal(table.column("level"), 0)).as_py() or 0
+    print(f"✅ Flow matrix saved to {FLOW_MATRIX_PATH}: {num_daily} (day, station pair) entries, {table.num_rows} in total")
@@ -0,0 +1,211 @@
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import wraps
+import contextvars
+import math
+import os
+import threading
+import time
+from fastapi.responses import JSONResponse
+
+"""
+    This file contains the request instrumentation - timing spans around the hot paths, kept as histograms
+        and served by the /db/metrics endpoint.
+    Spans are opened with span("name") (a with block) or @timed("name") (a whole function):
+        - query.<function>             computing a query function's result (cache misses only)
+        - bigquery.wait.<template>     waiting for a BigQuery job to finish
+        - bigquery.download.<template> converting a job's result into an Arrow table
+        - load.<name>                  loading reference data (the station registry, the cube, the JSON files...)
+        - aggregate.<function>         the services that turn query results into the response
+        - encode.json / encode.arrow   serialising the response body
+    Every BigQuery job also records the bytes it processed and the rows it returned (per query template).
+    With SERVER_TIMING=1, every response carries a Server-Timing header with the spans of its request
+        (as far as they finished before the response started), so they show up in the browser's network panel.
+    Instrumentation is off unless INSTRUMENTATION=1 - then span() hands back a shared no-op context manager,
+        @timed returns the function unchanged, and the middleware isn't installed, so it costs next to nothing.
+"""
+
+INSTRUMENTATION = os.getenv("INSTRUMENTATION", "0") == "1"
+SERVER_TIMING = INSTRUMENTATION and os.getenv("SERVER_TIMING", "0") == "1"
+
+# Histogram bucket upper bounds
+DURATION_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, math.inf] # ms
+SIZE_BUCKETS = [10 ** power for power in range(0, 13)] + [math.inf] # rows or bytes
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in (the max for the last bucket)
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": round(self.sum, 3),
+                "mean": round(self.sum / self.count, 3) if self.count else None,
+                "p50": round(self.quantile(0.5), 3),
+                "p99": round(self.quantile(0.99), 3),
+                "max": round(self.max, 3),
+                "buckets": [
+                    {"le": "+Inf" if math.isinf(bound) else bound, "count": count}
+                    for bound, count in zip(self.buckets, self.counts) if count
+                ],
+            }
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def histogram(name, buckets=DURATION_BUCKETS):
+    """
+    Returns the histogram registered under name, registering it the first time
+    """
+    found = _histograms.get(name)
+    if found is None:
+        with _histograms_lock:
+            found = _histograms.setdefault(name, Histogram(buckets))
+    return found
+
+# The spans of the request being handled - a list of (name, ms), shared with the query threads
+#   (run_query() copies the request's context into the thread it runs the query on)
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+_NO_SPAN = nullcontext()
+
+class Span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = (time.perf_counter() - self.started) * 1000
+        histogram(self.name).observe(elapsed)
+
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((self.name, elapsed))
+        return False
+
+def span(name):
+    """
+    Times a with block as the span name
+    """
+    if not INSTRUMENTATION:
+        return _NO_SPAN
+    return Span(name)
+
+def timed(name):
+    """
+    Decorator that times every call of a function as the span name
+    """
+    def decorator(function):
+        if not INSTRUMENTATION:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+def record_job(template_name, query_job, rows_returned):
+    """
+    Records the bytes processed and the rows returned by a finished BigQuery job
+    """
+    if not INSTRUMENTATION:
+        return
+    histogram(f"bigquery.bytes_processed.{template_name}", SIZE_BUCKETS).observe(query_job.total_bytes_processed or 0)
+    histogram(f"bigquery.rows_returned.{template_name}", SIZE_BUCKETS).observe(rows_returned or 0)
+
+def metrics():
+    """
+    Every histogram, by name - durations in ms, sizes in bytes or rows
+    """
+    return {
+        "enabled": INSTRUMENTATION,
+        "histograms": {name: _histograms[name].stats() for name in sorted(_histograms)},
+    }
+
+"""
+    REQUESTS
+"""
+
+def server_timing(spans, total):
+    """
+    Formats a request's spans as a Server-Timing header value - repeated spans are added up
+    """
+    durations = {}
+    for name, elapsed in spans:
+        durations[name] = durations.get(name, 0) + elapsed
+    entries = [f"{name};dur={elapsed:.2f}" for name, elapsed in durations.items()]
+    return ", ".join(entries + [f"total;dur={total:.2f}"])
+
+class InstrumentationMiddleware:
+    """
+    ASGI middleware that times every request (as request.<path>), collects the spans it opens,
+        and adds the Server-Timing header when SERVER_TIMING=1
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        spans = []
+        reset_token = _request_spans.set(spans)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and SERVER_TIMING:
+                total = (time.perf_counter() - started) * 1000
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(list(spans), total).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_spans.reset(reset_token)
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            histogram(f"request.{path}").observe((time.perf_counter() - started) * 1000)
+
+class TimedJSONResponse(JSONResponse):
+    """
+    The default response class - JSONResponse, with its encoding timed as encode.json
+    """
+    def render(self, content) -> bytes:
+        with span("encode.json"):
+            return super().render(content)
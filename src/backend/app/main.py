@@ -1,10 +1,59 @@
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager, suppress
+from typing import Literal, Optional
+import asyncio
 from .server import *
 from .services import *
+from .query_executor import ClientDisconnected, run_query
+from .station_registry import get_station_registry
+from . import cache_warmup, flow_matrix, profile_tensor, station_cube
+from .query_templates import query_template_stats
+from .result_store import dataset_version, result_store_stats
+from .instrumentation import INSTRUMENTATION, InstrumentationMiddleware, TimedJSONResponse, metrics
+from .arrow_results import ArrowJSONResponse, first_value, streaming_response
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the station and borough reference data, and map the station cube, before serving any requests
+    # (BigQuery isn't connected until a query needs it)
+    get_station_registry()
+    station_cube.get_cube()
+    flow_matrix.get_flow_matrix()
+    profile_tensor.get_profile_tensor()
+    # Starts reading the BigQuery table's version in the background, if the result store needs it (see result_store.py)
+    dataset_version()
+
+    # Warm the query cache for the common dashboard ranges in the background (see cache_warmup.py) -
+    #   requests are served straight away, without waiting for it
+    warmup = cache_warmup.start_warmup()
+    yield
+    if warmup is not None:
+        # Waits for it to stop, so it saves the ranges counted by this worker
+        warmup.cancel()
+        with suppress(asyncio.CancelledError):
+            await warmup
+
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
+
+"""
+    The query functions from server.py are blocking, so every endpoint awaits them through run_query(),
+        which runs them in a thread pool with a timeout, and cancels them if the client goes away.
+    They return Arrow tables - endpoints that return a query result as-is wrap it in ArrowJSONResponse,
+        which encodes the JSON straight from the table's columns.
+    Endpoints that take a format parameter ("ndjson" or "json") stream their result instead,
+        a record batch at a time (see streaming_response() in arrow_results.py).
+"""
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Request, error: ClientDisconnected):
+    # Nobody is listening any more - the status code is only for the logs
+    return Response(status_code=499)
+
+@app.exception_handler(BackendUnavailable)
+async def backend_unavailable(request: Request, error: BackendUnavailable):
+    # e.g. a BigQuery-only endpoint while running with QUERY_BACKEND=local
+    return JSONResponse(status_code=503, content={"detail": str(error)})
 
 # Configure CORS
 app.add_middleware(
@@ -15,6 +64,10 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 
+# Request timings and the Server-Timing header (see instrumentation.py) - only installed when INSTRUMENTATION=1
+if INSTRUMENTATION:
+    app.add_middleware(InstrumentationMiddleware)
+
 """
 The following end points are for testing purposes only
 """
@@ -23,81 +76,175 @@ async def root():
     return {"message": "Hello"}
 
 @app.get("/db/test/hires")
-async def test():
-    data = test_hire_table()
-    return data
+async def test(request: Request):
+    data = await run_query(request, test_hire_table)
+    return ArrowJSONResponse(data)
 
 @app.get("/db/test/stations")
-async def test():
-    data = test_stations_table()
-    return data
+async def test(request: Request):
+    data = await run_query(request, test_stations_table)
+    return ArrowJSONResponse(data)
 
 """
 UTILITY ENDPOINTS
 """
 @app.get("/db/get_min_date")
-async def min_date():
-    data = get_min_date()
-    return data
+async def min_date(request: Request):
+    data = await run_query(request, get_min_date)
+    return ArrowJSONResponse(data)
 
 @app.get("/db/get_max_date")
-async def max_date():
-    data = get_max_date()
-    return data
+async def max_date(request: Request):
+    data = await run_query(request, get_max_date)
+    return ArrowJSONResponse(data)
+
+@app.get("/db/query_stats")
+async def query_stats():
+    # Runs, BigQuery cache hits and bytes processed / billed for every query template (see query_templates.py)
+    return query_template_stats()
+
+@app.get("/db/metrics")
+async def request_metrics():
+    # Histograms of the request, query, reference data load, aggregation and encoding times,
+    #   and of the bytes processed / rows returned per BigQuery job (see instrumentation.py),
+    #   with the hits and size of the persistent result store (see result_store.py)
+    return {**metrics(), "queries": query_template_stats(), "result_store": result_store_stats()}
+
+@app.get("/db/warmup")
+async def warmup():
+    # Progress of the cache warm-up, and the date ranges requested most often (see cache_warmup.py)
+    return {**cache_warmup.warmup_status(), "popular_ranges": cache_warmup.popular_ranges()}
 
 
 """
 DATA ENDPOINTS
 """
 @app.get("/get_all_stations")
-async def top_stations(start_date: str = Query(...), end_date: str = Query(...)):
-    data = get_ordered_stations(start_date, end_date)
-    return data
+async def top_stations(request: Request, start_date: str = Query(...), end_date: str = Query(...)):
+    data = await run_query(request, get_ordered_stations, start_date, end_date)
+    return ArrowJSONResponse(data)
+
+@app.get("/get_station_daily_counts")
+async def station_daily_counts(start_date: str = Query(...), end_date: str = Query(...), format: Literal["ndjson", "json"] = Query("ndjson")):
+    """
+    Streams the rides starting and ending at each station, per day:
+        {"day": "2015-01-04", "station_id": 1, "start_rides": 12, "end_rides": 9}
+    The generator runs as the response is sent, and stops if the client disconnects
+    """
+    return streaming_response(iter_station_daily_counts(start_date, end_date), format)
 
 @app.get("/db/most_sustainable_borough")
-async def most_sustainable(start_date: str = Query(...), end_date: str = Query(...), ignoreCityOfLondon: bool = Query(...)):
-    ordered_stations = get_ordered_stations(start_date, end_date)
-    station_details = load_station_details()
-    borough_populations = load_borough_populations()
+async def most_sustainable(request: Request, start_date: str = Query(...), end_date: str = Query(...), ignoreCityOfLondon: bool = Query(...)):
+    ordered_stations = await run_query(request, get_ordered_stations, start_date, end_date)
+    registry = get_station_registry()
 
-    data = get_most_sustainable_borough(ordered_stations, station_details, borough_populations, ignoreCityOfLondon)
+    data = get_most_sustainable_borough(ordered_stations, registry, ignoreCityOfLondon)
 
     return data
 
 @app.get("/db/least_sustainable_boroughs")
-async def least_sustainable(start_date: str = Query(...), end_date: str = Query(...)):
-    ordered_stations = get_ordered_stations(start_date, end_date)
-    station_details = load_station_details()
-    borough_populations = load_borough_populations()
+async def least_sustainable(request: Request, start_date: str = Query(...), end_date: str = Query(...)):
+    ordered_stations = await run_query(request, get_ordered_stations, start_date, end_date)
+    registry = get_station_registry()
 
-    data = get_least_sustainable_boroughs(ordered_stations, station_details, borough_populations)
+    data = get_least_sustainable_boroughs(ordered_stations, registry)
     return data
 
 @app.get("/db/hot_spots")
-async def hot_spots(start_date: str = Query(...), end_date: str = Query(...)):
-    ordered_stations = get_ordered_stations(start_date, end_date)
-    station_details = load_station_details()
-    station_coords = load_station_coords()
+async def hot_spots(request: Request, start_date: str = Query(...), end_date: str = Query(...)):
+    # Counted once per dashboard load, here (and in /dashboard) - the dashboard calls every panel's endpoint
+    #   for the same range, and refetches only the borough panel when ignoreCityOfLondon changes
+    cache_warmup.record_range(start_date, end_date)
+    ordered_stations = await run_query(request, get_ordered_stations, start_date, end_date)
+    registry = get_station_registry()
 
-    data = get_hot_spots(ordered_stations, station_details, station_coords)
+    data = get_hot_spots(ordered_stations, registry)
     return data
 
-@app.get("/db/CO2_offset")
-async def CO2_offset(start_date: str = Query(...), end_date: str = Query(...)):
-    # Res from API Call:
-    duration_in_seconds = get_cycling_duration(start_date, end_date)[0]["duration"]
-    # Transform into meaning (Carbon offset):
-    co2_amount = get_CO2_offset(duration_in_seconds)[0]
-    estimated_distanced_km = get_CO2_offset(duration_in_seconds)[1]
-    tree_equivalent = calculate_tree_equivalent(co2_amount)
+@app.get("/db/hot_spots/bbox")
+async def hot_spots_in_bbox(
+    request: Request,
+    start_date: str = Query(...), end_date: str = Query(...),
+    min_lat: float = Query(...), min_lon: float = Query(...), max_lat: float = Query(...), max_lon: float = Query(...),
+    top_n: int = Query(10, ge=1, le=1000),
+):
+    """
+    The busiest stations inside the map viewport
+    """
+    ordered_stations = await run_query(request, get_ordered_stations, start_date, end_date)
+    registry = get_station_registry()
 
-    data = [co2_amount, tree_equivalent, estimated_distanced_km]
+    data = get_hot_spots_in_bbox(ordered_stations, registry, min_lat, min_lon, max_lat, max_lon, top_n)
+    return data
 
+@app.get("/db/hot_spots/nearby")
+async def hot_spots_nearby(
+    request: Request,
+    start_date: str = Query(...), end_date: str = Query(...),
+    lat: float = Query(...), lon: float = Query(...), radius_m: float = Query(500, gt=0, le=20000),
+    top_n: int = Query(10, ge=1, le=1000),
+):
+    """
+    The busiest stations within radius_m metres of a point
+    """
+    ordered_stations = await run_query(request, get_ordered_stations, start_date, end_date)
+    registry = get_station_registry()
+
+    data = get_hot_spots_near(ordered_stations, registry, lat, lon, radius_m, top_n)
     return data
 
+@app.get("/db/flows")
+async def flows(
+    start_date: str = Query(...), end_date: str = Query(...),
+    by: Literal["station", "borough"] = Query("station"),
+    top_n: int = Query(10, ge=1, le=1000),
+):
+    """
+    The busiest origin-destination flows, between stations or rolled up into boroughs
+    Served from the precomputed flow matrix (see flow_matrix.py)
+    """
+    matrix = flow_matrix.get_flow_matrix()
+    if matrix is None:
+        raise BackendUnavailable("The flow matrix hasn't been built - run: python -m backend.app.flow_matrix")
+    registry = get_station_registry()
+
+    if by == "borough":
+        return get_borough_flows(matrix, registry, start_date, end_date, top_n)
+    return get_top_flows(matrix, registry, start_date, end_date, top_n)
+
+@app.get("/db/profile")
+async def profile(
+    start_date: str = Query(...), end_date: str = Query(...),
+    station_id: Optional[int] = Query(None), borough: Optional[str] = Query(None),
+):
+    """
+    Departures and arrivals by day of the week and hour, for a station, a borough, or the whole network
+    Served from the precomputed profile tensor (see profile_tensor.py)
+    """
+    tensor = profile_tensor.get_profile_tensor()
+    if tensor is None:
+        raise BackendUnavailable("The profile tensor hasn't been built - run: python -m backend.app.profile_tensor")
+    registry = get_station_registry()
+
+    data = get_demand_profile(tensor, registry, start_date, end_date, station_id, borough)
+    if data is None:
+        raise HTTPException(status_code=404, detail=f"Unknown {'borough' if borough is not None else 'station'}")
+    return data
+
+@app.get("/db/CO2_offset")
+async def CO2_offset(request: Request, start_date: str = Query(...), end_date: str = Query(...)):
+    data = await get_CO2_offset_panel(request, start_date, end_date)
+
+    return data
+
+@app.get("/db/ride_metrics")
+async def ride_metrics(request: Request, start_date: str = Query(...), end_date: str = Query(...)):
+    data = await run_query(request, get_trip_totals, start_date, end_date)
+    return get_ride_metrics(data)
+
 @app.get("/db/change_in_usage")
-async def change_in_usage(start_date: str = Query(...), end_date: str = Query(...)):
-    data = get_change_in_monthly_average_use_foreach_station(start_date, end_date)
+async def change_in_usage(request: Request, start_date: str = Query(...), end_date: str = Query(...), window_months: int = Query(3, ge=1, le=24)):
+    data = await run_query(request, get_change_in_monthly_average_use_foreach_station, start_date, end_date, window_months)
     """
         Raw data returned in the following format:
         0: {station_id: 1, starting_period_avg: 571.67, ending_period_avg: 332.33}
@@ -106,9 +253,44 @@ async def change_in_usage(start_date: str = Query(...), end_date: str = Query(..
         ...
         Now, use a custom backend service to calculate boroughs with the biggest change in usage
     """
-    station_details = load_station_details()    
-    boroughs = get_boroughs_by_biggest_change(station_details, data)
+    registry = get_station_registry()
+    boroughs = get_boroughs_by_biggest_change(registry, data)
 
     return boroughs
 
+@app.get("/dashboard")
+async def dashboard(request: Request, start_date: str = Query(...), end_date: str = Query(...), ignoreCityOfLondon: bool = Query(False), window_months: int = Query(3, ge=1, le=24)):
+    """
+    Returns the data for every dashboard panel in one response.
+    The station totals are fetched once and shared by the three panels that need them.
+    The three queries run concurrently.
+    """
+    cache_warmup.record_range(start_date, end_date)
+    ordered_stations, CO2_offset_data, usage_data = await asyncio.gather(
+        run_query(request, get_ordered_stations, start_date, end_date),
+        get_CO2_offset_panel(request, start_date, end_date),
+        run_query(request, get_change_in_monthly_average_use_foreach_station, start_date, end_date, window_months),
+    )
+    registry = get_station_registry()
+
+    return {
+        "most_sustainable_borough": get_most_sustainable_borough(ordered_stations, registry, ignoreCityOfLondon),
+        "least_sustainable_boroughs": get_least_sustainable_boroughs(ordered_stations, registry),
+        "hot_spots": get_hot_spots(ordered_stations, registry),
+        "CO2_offset": CO2_offset_data,
+        "change_in_usage": get_boroughs_by_biggest_change(registry, usage_data),
+    }
+
+"""
+HELPERS
+"""
+async def get_CO2_offset_panel(request, start_date, end_date):
+    # Res from API Call (the summed duration of the trips, looked up from the station cube):
+    duration_in_seconds = first_value(await run_query(request, get_trip_totals, start_date, end_date), "duration")
+    # Transform into meaning (Carbon offset):
+    co2_amount, estimated_distanced_km = get_CO2_offset(duration_in_seconds)
+    tree_equivalent = calculate_tree_equivalent(co2_amount)
+
+    return [co2_amount, tree_equivalent, estimated_distanced_km]
+
 
@@ -0,0 +1,138 @@
+from pathlib import Path
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from . import ride_store
+from .ride_store import MAX_STATION_ID
+from .block_counts import BlockCounts, block_table, daily_counts, merge_counts, save_block_table, load_block_table
+from .station_cube import day_numbers, station_ids
+from .borough_aggregation import borough_codes
+from .instrumentation import span
+
+"""
+    This file contains the temporal profiles - rides per station by day of the week and hour of the day,
+        for the diurnal and weekly demand curves used for rebalancing.
+    There are two directions: departures (counted at the start station, by the hour the ride started) and
+        arrivals (counted at the end station, by the hour the ride ended). Hours and days of the week are
+        London local time, so the morning peak stays at 8am through the clock changes.
+    Each (direction, station, day of week, hour) cell is numbered, and the counts are kept sparse, per day, month
+        and year, in a block count store (see block_counts.py). The profiles for any date range are summed from
+        a few blocks into a dense (directions x stations x 7 x 24) tensor, and the borough profiles are that tensor
+        summed over the stations of each borough (through the station -> borough index of the station registry).
+    From /src:
+        python -m backend.app.profile_tensor    builds the profiles from the local ride store
+"""
+
+PROFILE_TENSOR_PATH = Path(os.getenv("PROFILE_TENSOR_PATH", Path(__file__).parent / "utils/data" / "profile_tensor.arrow"))
+
+DIRECTIONS = ["departures", "arrivals"]
+DAYS_OF_WEEK = 7 # Monday = 0
+HOURS = 24
+TIMEZONE = "Europe/London"
+
+PROFILE_SHAPE = (len(DIRECTIONS), MAX_STATION_ID, DAYS_OF_WEEK, HOURS)
+NUM_CELLS = int(np.prod(PROFILE_SHAPE))
+
+class ProfileTensor(BlockCounts):
+    def __init__(self, levels, blocks, cells, rides):
+        super().__init__(levels, blocks, cells, rides, NUM_CELLS)
+
+    def station_profiles(self, start_date, end_date):
+        """
+        Returns the (directions x stations x days of week x hours) tensor of rides in the date range,
+            indexed by station id
+        """
+        return self.totals(start_date, end_date).reshape(PROFILE_SHAPE)
+
+    def borough_profiles(self, registry, start_date, end_date):
+        """
+        Returns the (directions x boroughs x days of week x hours) tensor of rides in the date range,
+            indexed by borough code - stations without a borough are left out
+        """
+        profiles = self.station_profiles(start_date, end_date)
+        codes = borough_codes(registry, np.arange(MAX_STATION_ID), warn=False)
+        known = codes >= 0
+
+        boroughs = np.zeros((len(DIRECTIONS), len(registry.borough_names), DAYS_OF_WEEK, HOURS), dtype=np.int64)
+        np.add.at(boroughs, (slice(None), codes[known]), profiles[:, known])
+        return boroughs
+
+"""
+--------------
+    LOADING
+--------------
+"""
+
+_profile_tensor = None
+_profile_tensor_mtime = None
+
+def get_profile_tensor():
+    """
+    Returns the profile tensor, loading it the first time it's needed (or when the file on disk has changed)
+    Returns None if it hasn't been built
+    """
+    global _profile_tensor, _profile_tensor_mtime
+
+    if not PROFILE_TENSOR_PATH.exists():
+        return None
+
+    mtime = PROFILE_TENSOR_PATH.stat().st_mtime
+    if _profile_tensor is None or mtime != _profile_tensor_mtime:
+        with span("load.profile_tensor"):
+            _profile_tensor = ProfileTensor(*load_block_table(PROFILE_TENSOR_PATH))
+        _profile_tensor_mtime = mtime
+
+    return _profile_tensor
+
+"""
+--------------
+    BUILD
+--------------
+"""
+
+def local_time_cells(timestamps):
+    """
+    Returns the (day of week, hour) of a timestamp column, in London local time
+    """
+    local = pc.cast(timestamps, pa.timestamp("us", tz=TIMEZONE))
+    days_of_week = pc.fill_null(pc.day_of_week(local), 0).to_numpy().astype(np.int64)
+    hours = pc.fill_null(pc.hour(local), 0).to_numpy().astype(np.int64)
+    return days_of_week, hours
+
+def daily_profiles(days, start_ids, end_ids, start_times, end_times):
+    """
+    Aggregates rides into sorted (day * NUM_CELLS + cell) keys and their counts, where day is the day the ride started
+    start_times / end_times: (day of week, hour) arrays
+    """
+    cells, cell_days = [], []
+    for direction, ids, (days_of_week, hours) in ((0, start_ids, start_times), (1, end_ids, end_times)):
+        valid = (ids >= 0) & (ids < MAX_STATION_ID)
+        cells.append(((direction * MAX_STATION_ID + ids[valid]) * DAYS_OF_WEEK + days_of_week[valid]) * HOURS + hours[valid])
+        cell_days.append(days[valid])
+
+    cells = np.concatenate(cells)
+    return daily_counts(np.concatenate(cell_days), cells, np.ones(len(cells)), NUM_CELLS)
+
+def build_profile_tensor():
+    """
+    Builds the profile table from the local ride store, one record batch at a time
+    """
+    parts = []
+    columns = ["start_date", "end_date", "start_station_id", "end_station_id"]
+    for batch in ride_store.open_dataset().to_batches(columns=columns):
+        # A ride without an end time has no arrival
+        end_ids = np.where(pc.is_null(batch.column("end_date")).to_numpy(zero_copy_only=False), -1, station_ids(batch.column("end_station_id")))
+        parts.append(daily_profiles(
+            day_numbers(batch.column("start_date")),
+            station_ids(batch.column("start_station_id")),
+            end_ids,
+            local_time_cells(batch.column("start_date")),
+            local_time_cells(batch.column("end_date")),
+        ))
+    return block_table(*merge_counts(parts), NUM_CELLS)
+
+if __name__ == "__main__":
+    table = build_profile_tensor()
+    save_block_table(table, PROFILE_TENSOR_PATH)
+    print(f"✅ Profile tensor saved to {PROFILE_TENSOR_PATH}: {table.num_rows} entries")
@@ -0,0 +1,207 @@
+from concurrent.futures import Future
+import contextvars
+from functools import wraps
+import threading
+import os
+from cachetools import TTLCache
+from . import station_cube
+from .ride_store import to_timestamp
+from .result_store import DatasetReads, dataset_reads, function_fingerprint, load_result, reset_dataset_version, save_result
+
+"""
+    This file contains the query cache used by server.py.
+    The dashboard fires several requests for the same date range at once, and most of them need the same query.
+    Wrapping a query function with @cached_query():
+        - keeps its results in a TTL/LRU cache, keyed on the function and its (normalised) arguments
+        - coalesces calls that arrive while the same query is still running - they join the in-flight query
+            instead of starting their own. The in-flight query counts its listeners, and its BigQuery jobs are
+            only cancelled once none of them is waiting any more (see InFlightQuery).
+        - on a miss, looks the result up in the persistent result store before running the query, and stores
+            the result there afterwards if it read the dataset (see result_store.py) - so results survive restarts
+            and are shared between workers. Pass persist=False to keep a query's results in memory only.
+    When the station cube changes on disk (it's rebuilt or refreshed), every cached query is cleared
+        (see clear_query_caches()) - the cube is checked before each lookup, so no result from the old cube is served.
+"""
+
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", 600)) # seconds
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 256)) # entries per query function
+
+# Whoever is waiting on the code running on this thread: the request's CancelToken (see query_executor.py),
+#   or the in-flight query it's computing. The BigQuery jobs started here are handed to it (add_job()),
+#   and the cached queries called from here join it (attach()), so they can be cancelled with it.
+query_listener = contextvars.ContextVar("query_listener", default=None)
+
+class Participation:
+    """
+    One listener's share of an in-flight query - leave() is safe to call more than once
+    """
+    def __init__(self, query):
+        self.query = query
+        self.left = False
+        self.lock = threading.Lock()
+
+    def leave(self):
+        with self.lock:
+            if self.left:
+                return
+            self.left = True
+        self.query.leave()
+
+class InFlightQuery:
+    """
+    A query that's being run, shared by every call that asked for it before it finished
+    Each call joins it as a listener, and leaves once it has the result or its request stops waiting
+        (it disconnected or timed out). When the last listener leaves before the result is ready, the query is
+        abandoned - its BigQuery jobs are cancelled, and so are the cached queries it was waiting on.
+    """
+    def __init__(self):
+        self.future = Future()
+        self.lock = threading.Lock()
+        self.listeners = 0
+        self.cancelled = False
+        self.jobs = []
+        self.participations = []
+
+    def join(self, listener):
+        """
+        Adds a listener (a CancelToken, an InFlightQuery or None) - returns its Participation,
+            or None if the query has already been abandoned
+        """
+        with self.lock:
+            if self.cancelled:
+                return None
+            self.listeners += 1
+        participation = Participation(self)
+        if listener is not None:
+            listener.attach(participation)
+        return participation
+
+    def leave(self):
+        with self.lock:
+            self.listeners -= 1
+            abandoned = self.listeners == 0 and not self.future.done()
+            if abandoned:
+                self.cancelled = True
+                jobs, participations = list(self.jobs), list(self.participations)
+        if abandoned:
+            for job in jobs:
+                if not job.done():
+                    job.cancel()
+            for participation in participations:
+                participation.leave()
+
+    def add_job(self, job):
+        with self.lock:
+            self.jobs.append(job)
+            cancelled = self.cancelled
+        if cancelled:
+            job.cancel()
+
+    def attach(self, participation):
+        with self.lock:
+            self.participations.append(participation)
+            cancelled = self.cancelled
+        if cancelled:
+            participation.leave()
+
+# Every cached query's cache_clear(), and the number of times they've all been cleared - a query that was
+#   already running when the caches were cleared doesn't cache its result, which may come from the old data
+_cache_clears = []
+_generation = 0
+
+def clear_query_caches():
+    """
+    Empties every query cache - called when the data the queries are answered from changes
+    """
+    global _generation
+
+    _generation += 1
+    reset_dataset_version()
+    for cache_clear in list(_cache_clears):
+        cache_clear()
+
+def normalise_argument(value):
+    """
+    Date strings are normalised so "2015-01-04", "2015-01-04T00:00:00" and "2015-01-04 00:00:00+00:00"
+    all share a cache entry
+    """
+    if isinstance(value, str):
+        try:
+            return to_timestamp(value).isoformat()
+        except ValueError:
+            return value
+    return value
+
+def cached_query(ttl=QUERY_CACHE_TTL, maxsize=QUERY_CACHE_SIZE, persist=True):
+    def decorator(query_function):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        in_flight = {}
+        lock = threading.Lock()
+        fingerprint = function_fingerprint(query_function) if persist else None
+
+        @wraps(query_function)
+        def wrapper(*args):
+            key = tuple(normalise_argument(arg) for arg in args)
+            # Reloads the cube if it has changed, which clears the caches first
+            station_cube.get_cube()
+
+            listener = query_listener.get()
+            with lock:
+                if key in cache:
+                    return cache[key]
+
+                query = in_flight.get(key)
+                participation = query.join(listener) if query is not None else None
+                is_owner = participation is None
+                if is_owner:
+                    query = InFlightQuery()
+                    in_flight[key] = query
+                    participation = query.join(listener)
+
+            try:
+                # Another request is already running this query - share its result
+                if not is_owner:
+                    return query.future.result()
+                return run(query, key, args)
+            finally:
+                participation.leave()
+
+        def run(query, key, args):
+            generation = _generation
+            reset_token = query_listener.set(query)
+            reads = DatasetReads(dataset_reads.get())
+            reads_token = dataset_reads.set(reads)
+            try:
+                result = load_result(fingerprint, key) if persist else None
+                if result is None:
+                    result = query_function(*args)
+                    # Results answered from memory (the station cube, the block cache) aren't worth storing
+                    if persist and reads.read:
+                        save_result(query_function, fingerprint, key, result)
+            except BaseException as error:
+                with lock:
+                    if in_flight.get(key) is query:
+                        del in_flight[key]
+                query.future.set_exception(error)
+                raise
+            finally:
+                dataset_reads.reset(reads_token)
+                query_listener.reset(reset_token)
+
+            with lock:
+                if generation == _generation:
+                    cache[key] = result
+                if in_flight.get(key) is query:
+                    del in_flight[key]
+            query.future.set_result(result)
+            return result
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        _cache_clears.append(cache_clear)
+        return wrapper
+
+    return decorator
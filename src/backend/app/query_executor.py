@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import os
+import threading
+from fastapi import HTTPException, Request
+from .query_cache import query_listener
+
+"""
+    This file runs the (blocking) query functions from server.py off the event loop.
+    The endpoints in main.py await run_query(...), which hands the query to a bounded thread pool,
+        so a slow BigQuery job no longer stalls every other request being handled by uvicorn.
+    Each call also:
+        - gives up after QUERY_TIMEOUT seconds (504), cancelling its BigQuery jobs
+        - cancels its BigQuery jobs if the client disconnects before the result is ready,
+            unless another request is waiting on the same (coalesced) query
+"""
+
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", 8))
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", 120)) # seconds
+DISCONNECT_POLL_INTERVAL = 0.5 # seconds
+
+class ClientDisconnected(Exception):
+    pass
+
+executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+
+class CancelToken:
+    """
+    Collects the BigQuery jobs started on behalf of one request, and the in-flight queries it joined
+        (see query_cache.py), so they can be cancelled together
+    """
+    def __init__(self):
+        self.cancelled = False
+        self.jobs = []
+        self.participations = []
+        self.lock = threading.Lock()
+
+    def add_job(self, job):
+        with self.lock:
+            self.jobs.append(job)
+            cancelled = self.cancelled
+        if cancelled:
+            job.cancel()
+
+    def attach(self, participation):
+        with self.lock:
+            self.participations.append(participation)
+            cancelled = self.cancelled
+        if cancelled:
+            participation.leave()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            jobs, participations = list(self.jobs), list(self.participations)
+        # A shared query is only cancelled once every request waiting on it has left
+        for participation in participations:
+            participation.leave()
+        for job in jobs:
+            if not job.done():
+                job.cancel()
+
+def track_job(job):
+    """
+    Called by server.py for every BigQuery job it starts
+    """
+    listener = query_listener.get()
+    if listener is not None:
+        listener.add_job(job)
+
+async def _wait_for_disconnect(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+async def run_query(request: Request, query_function, *args, timeout=QUERY_TIMEOUT):
+    """
+    Runs query_function(*args) in the query thread pool and returns its result
+    """
+    token = CancelToken()
+    context = contextvars.copy_context()
+    context.run(query_listener.set, token)
+
+    loop = asyncio.get_running_loop()
+    query = loop.run_in_executor(executor, context.run, query_function, *args)
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(request)) if request is not None else None
+
+    try:
+        waiting_on = {query, disconnect} if disconnect is not None else {query}
+        done, _ = await asyncio.wait(waiting_on, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        token.cancel()
+        raise
+    finally:
+        if disconnect is not None:
+            disconnect.cancel()
+
+    if query in done:
+        return query.result()
+
+    token.cancel()
+    if disconnect is not None and disconnect in done:
+        raise ClientDisconnected()
+    raise HTTPException(status_code=504, detail=f"Query timed out after {timeout} seconds")
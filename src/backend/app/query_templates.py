@@ -0,0 +1,122 @@
+from datetime import date, datetime
+import threading
+from .ride_store import to_timestamp
+
+"""
+    This file contains the query template registry used by server.py.
+    The SQL of each query is registered once as a template, with named, typed parameters (@start_date etc.)
+        instead of values formatted into the SQL text. That means:
+        - the SQL text of a query never changes, so BigQuery's result cache can answer any repeat of it -
+            a different way of writing the same date ("2015-01-04", "2015-01-04T00:00:00Z") is normalised
+            to the same parameter value before it's sent
+        - the request values can't change the SQL (no injection through start_date / end_date)
+    Every run of a template is counted: runs, BigQuery result cache hits and misses, bytes processed / billed,
+        and rows returned.
+        The counters are served by the /db/query_stats endpoint.
+"""
+
+# BigQuery parameter type -> function that normalises a request value into the parameter value
+PARAMETER_TYPES = {
+    "TIMESTAMP": lambda value: to_timestamp(value),
+    "DATE": lambda value: value if isinstance(value, date) and not isinstance(value, datetime) else to_timestamp(value).date(),
+    "INT64": int,
+    "FLOAT64": float,
+    "STRING": str,
+}
+
+# Arrays of the types above, e.g. "ARRAY<DATE>"
+for element_type in list(PARAMETER_TYPES):
+    PARAMETER_TYPES[f"ARRAY<{element_type}>"] = lambda values, normalise=PARAMETER_TYPES[element_type]: [normalise(value) for value in values]
+
+class QueryTemplate:
+    def __init__(self, name, sql, parameters):
+        """
+        name: name of the query (used for the counters)
+        sql: the SQL, referring to its parameters as @name
+        parameters: dict of parameter name -> BigQuery type (see PARAMETER_TYPES)
+        """
+        unknown_types = set(parameters.values()) - set(PARAMETER_TYPES)
+        if unknown_types:
+            raise ValueError(f"Unknown parameter type(s) for query {name}: {', '.join(sorted(unknown_types))}")
+
+        self.name = name
+        self.sql = sql
+        self.parameters = dict(parameters)
+
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.cache_hits = 0
+        self.bytes_processed = 0
+        self.bytes_billed = 0
+        self.rows_returned = 0
+
+    def bind(self, **values):
+        """
+        Returns the normalised (name, type, value) of every parameter
+        """
+        missing = set(self.parameters) - set(values)
+        extra = set(values) - set(self.parameters)
+        if missing or extra:
+            raise TypeError(f"Query {self.name} takes the parameters {sorted(self.parameters)}, got {sorted(values)}")
+
+        return [
+            (name, parameter_type, PARAMETER_TYPES[parameter_type](values[name]))
+            for name, parameter_type in self.parameters.items()
+        ]
+
+    def job_config(self, **values):
+        """
+        Returns the BigQuery QueryJobConfig that binds the parameters
+        """
+        from google.cloud import bigquery
+
+        query_parameters = []
+        for name, parameter_type, value in self.bind(**values):
+            if parameter_type.startswith("ARRAY<"):
+                query_parameters.append(bigquery.ArrayQueryParameter(name, parameter_type[len("ARRAY<"):-1], value))
+            else:
+                query_parameters.append(bigquery.ScalarQueryParameter(name, parameter_type, value))
+        return bigquery.QueryJobConfig(query_parameters=query_parameters)
+
+    def record(self, query_job, rows_returned=0):
+        """
+        Counts a finished job
+        """
+        with self.lock:
+            self.runs += 1
+            self.cache_hits += 1 if query_job.cache_hit else 0
+            self.bytes_processed += query_job.total_bytes_processed or 0
+            self.bytes_billed += query_job.total_bytes_billed or 0
+            self.rows_returned += rows_returned or 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "query": self.name,
+                "runs": self.runs,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.runs - self.cache_hits,
+                "bytes_processed": self.bytes_processed,
+                "bytes_billed": self.bytes_billed,
+                "rows_returned": self.rows_returned,
+            }
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+def query_template(name, sql, **parameters):
+    """
+    Returns the template registered under name, registering it the first time
+    (so a query function can declare its SQL inline, and it's only parsed once)
+    """
+    template = _templates.get(name)
+    if template is None:
+        with _templates_lock:
+            template = _templates.get(name)
+            if template is None:
+                template = QueryTemplate(name, sql, parameters)
+                _templates[name] = template
+    return template
+
+def query_template_stats():
+    return [template.stats() for template in _templates.values()]
@@ -0,0 +1,224 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+import pyarrow.ipc as ipc
+from . import borough_assignment
+from .station_registry import DATA_PATH, REFERENCE_FILES, STATION_TABLE_PATH, BOROUGH_TABLE_PATH, StationRegistry, load_json
+
+"""
+    This file contains the build pipeline for the station reference data - it replaces the chain of scripts in
+        utils/scripts and utils/borough_data_tests that passed JSON files to each other by relative path
+        (merge_station_details.py, combine_station_details.py and numOfDiffBoroughs.py are now stages or
+        part of one, see below). The scripts are left where they are, for reference - the API never reads
+        what they write.
+    The pipeline is a list of declared stages, each with its input files, output files and a build function.
+        Every input is hashed (SHA-256 of its contents), and a stage is skipped when its inputs hash the same as
+        the last time it ran and its outputs are still the files it wrote. A stage's outputs are the next stage's
+        inputs, so a change only rebuilds the stages downstream of it.
+    Stages:
+        - station_details:   merges the station names (station_names.json) with the boroughs from reverse geocoding
+                             (stationIdToBorough.json, see reverse_geocoding.py) into station_details.json
+                             (was utils/scripts/merge_station_details.py) - only runs when both files are in
+                             utils/data, otherwise the checked-in station_details.json is used as it is
+        - station_boroughs:  assigns every station to a borough from the boundary shapefile (see borough_assignment.py)
+                             (optional - skipped with a warning if geopandas isn't installed)
+        - station_table:     merges the station details, coordinates, boroughs and populations into the binary
+                             station table - stations.arrow and boroughs.arrow (Arrow IPC), which the API loads
+                             with a memory map instead of parsing JSON (see station_registry.py). The station
+                             table holds the merged details and coordinates that utils/borough_data_tests/
+                             combine_station_details.py used to write out, and the stage prints the number of
+                             stations and boroughs (what utils/scripts/numOfDiffBoroughs.py counted)
+    The hashes are kept in build_manifest.json in utils/data.
+    From /src:
+        python -m backend.app.reference_build [--force] [stage ...]
+"""
+
+BUILD_MANIFEST_PATH = Path(os.getenv("BUILD_MANIFEST_PATH", DATA_PATH / "build_manifest.json"))
+
+# Bump when a stage's build function changes, so its outputs are rebuilt
+PIPELINE_VERSION = 1
+
+class Stage:
+    def __init__(self, name, inputs, outputs, build, optional=False, needs_inputs=False):
+        """
+        optional: the stage is skipped with a warning if its build needs a package that isn't installed
+        needs_inputs: the stage is skipped if any of its inputs is missing (its outputs are kept as they are)
+        """
+        self.name = name
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.build = build
+        self.optional = optional
+        self.needs_inputs = needs_inputs
+
+def file_hash(path):
+    if not path.exists():
+        return "missing"
+    digest = hashlib.sha256()
+    with path.open("rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def inputs_hash(stage):
+    digest = hashlib.sha256(f"{stage.name}:{PIPELINE_VERSION}".encode())
+    for path in stage.inputs:
+        digest.update(f"{path.name}:{file_hash(path)}".encode())
+    return digest.hexdigest()
+
+"""
+    STAGES
+"""
+
+def write_json(data, path):
+    temporary_path = path.with_name(path.name + ".tmp")
+    with temporary_path.open("w", encoding="utf-8") as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+        file.write("\n")
+    os.replace(temporary_path, path)
+
+def build_station_details():
+    station_names = load_json("station_names.json")
+    borough_by_id = {entry["id"]: entry["borough"] for entry in load_json("stationIdToBorough.json")}
+    # Stations reverse geocoding didn't place keep a null borough
+    write_json(
+        [{"id": station["id"], "name": station["name"], "borough": borough_by_id.get(station["id"])} for station in station_names],
+        DATA_PATH / "station_details.json",
+    )
+
+def build_station_boroughs():
+    (borough_names, borough_by_station_id), changes = borough_assignment.build_station_boroughs()
+    for station_id, stored, borough in changes:
+        print(f"    🔄 ID {station_id}: '{stored}' → '{borough}'")
+
+def write_table(table, path):
+    # Uncompressed, so the columns can be memory-mapped straight from the file
+    temporary_path = path.with_name(path.name + ".tmp")
+    with ipc.new_file(str(temporary_path), table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temporary_path, path)
+
+def build_station_table():
+    registry = StationRegistry.from_json(
+        load_json("station_details.json"),
+        load_json("station_coords.json"),
+        load_json("borough_populations.json"),
+        borough_assignment.load_station_boroughs(),
+    )
+    stations, boroughs = registry.to_tables()
+    write_table(stations, STATION_TABLE_PATH)
+    write_table(boroughs, BOROUGH_TABLE_PATH)
+
+    boroughs_with_stations = np.unique(registry.station_boroughs[registry.station_boroughs >= 0])
+    print(f"    {len(registry.station_ids)} stations in {len(boroughs_with_stations)} boroughs")
+
+shapefile = borough_assignment.BOROUGH_BOUNDARIES_PATH
+
+STAGES = [
+    Stage(
+        "station_details",
+        inputs=[DATA_PATH / "station_names.json", DATA_PATH / "stationIdToBorough.json"],
+        outputs=[DATA_PATH / "station_details.json"],
+        build=build_station_details,
+        needs_inputs=True,
+    ),
+    Stage(
+        "station_boroughs",
+        inputs=[DATA_PATH / "station_coords.json", DATA_PATH / "station_details.json"] +
+            [shapefile.with_suffix(suffix) for suffix in (".shp", ".shx", ".dbf", ".prj")],
+        outputs=[borough_assignment.STATION_BOROUGHS_PATH],
+        build=build_station_boroughs,
+        optional=True,
+    ),
+    Stage(
+        "station_table",
+        inputs=[DATA_PATH / file_name for file_name in REFERENCE_FILES] + [borough_assignment.STATION_BOROUGHS_PATH],
+        outputs=[STATION_TABLE_PATH, BOROUGH_TABLE_PATH],
+        build=build_station_table,
+    ),
+]
+
+"""
+    RUNNING
+"""
+
+def load_manifest():
+    if not BUILD_MANIFEST_PATH.exists():
+        return {}
+    with BUILD_MANIFEST_PATH.open("r") as file:
+        return json.load(file)
+
+def save_manifest(manifest):
+    temporary_path = BUILD_MANIFEST_PATH.with_name(BUILD_MANIFEST_PATH.name + ".tmp")
+    with temporary_path.open("w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temporary_path, BUILD_MANIFEST_PATH)
+
+def is_up_to_date(stage, manifest):
+    entry = manifest.get(stage.name)
+    if entry is None or entry["inputs"] != inputs_hash(stage):
+        return False
+    return all(entry["outputs"].get(str(path)) == file_hash(path) for path in stage.outputs)
+
+def run_pipeline(stage_names=None, force=False):
+    """
+    Runs the stages in order (or just the named ones), skipping the ones that are up to date
+    Returns {stage name: "built" | "skipped" | "failed"}
+    """
+    manifest = load_manifest()
+    results = {}
+
+    for stage in STAGES:
+        if stage_names and stage.name not in stage_names:
+            continue
+
+        if stage.needs_inputs and not all(path.exists() for path in stage.inputs):
+            results[stage.name] = "skipped"
+            print(f"⏭️  {stage.name}: no {' / '.join(path.name for path in stage.inputs if not path.exists())}")
+            continue
+
+        if not force and is_up_to_date(stage, manifest):
+            # The inputs may have been touched without changing - keep the outputs newer than them,
+            #   since that's how the API decides the station table is current
+            for path in stage.outputs:
+                os.utime(path)
+            results[stage.name] = "skipped"
+            print(f"⏭️  {stage.name}: up to date")
+            continue
+
+        print(f"🔨 {stage.name}")
+        try:
+            stage.build()
+        except ImportError as error:
+            if not stage.optional:
+                raise
+            # The stages after it use its old outputs (or do without them)
+            results[stage.name] = "failed"
+            print(f"Warning: Skipping optional stage {stage.name}: {error}")
+            continue
+
+        manifest[stage.name] = {
+            "inputs": inputs_hash(stage),
+            "outputs": {str(path): file_hash(path) for path in stage.outputs},
+        }
+        save_manifest(manifest)
+        results[stage.name] = "built"
+
+    return results
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    force = "--force" in arguments
+    stage_names = [argument for argument in arguments if argument != "--force"]
+
+    unknown = set(stage_names) - {stage.name for stage in STAGES}
+    if unknown:
+        print(f"Unknown stage(s): {', '.join(sorted(unknown))} - the stages are: {', '.join(stage.name for stage in STAGES)}")
+        sys.exit(1)
+
+    results = run_pipeline(stage_names, force)
+    built = sum(1 for result in results.values() if result == "built")
+    print(f"✅ {built} stage(s) built, {len(results) - built} skipped or failed")
@@ -0,0 +1,464 @@
+from pathlib import Path
+import contextvars
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+"""
+    This file contains the persistent result store - the second tier of the query cache (see query_cache.py),
+        kept in a SQLite database on disk, so query results survive a restart and are shared by every
+        uvicorn worker on the machine.
+    When the in-memory cache misses, @cached_query() looks the result up here before running the query,
+        and stores what the query returns. Only Arrow tables are stored, as Arrow IPC streams compressed with zstd.
+    Only results that actually read the dataset are stored - a BigQuery job or a ride store scan (they call
+        mark_dataset_read()). Results computed from the station cube or the block cache in memory take well
+        under a millisecond, so storing them would only cost a write.
+    Entries are keyed on a hash of:
+        - the query function - its name, its code and its constants, which include its SQL templates,
+            so changing a query's SQL or logic gives it new keys
+        - the source of every module in the app - a query's result also depends on the code it calls
+            (the ride store scans, the station cube, the block cache, the usage windows...), so any change
+            to the app's code gives every query new keys
+        - its (normalised) arguments
+    Every entry is tagged with the version of the dataset it was computed from (see dataset_version()):
+        the query backend, the station cube and ride store files, and for BigQuery, the time the cycle_hire
+        table was last modified - read by a background thread (see start_version_checks()), so no request
+        waits on BigQuery for it; until its first read, BigQuery results skip the store. Entries from any
+        other version are never returned. Entries are also tagged
+        with their query backend, and a process deletes the entries of its own backend from other versions
+        as soon as it sees a new version - e.g. after the cube is rebuilt or refreshed. The entries of the
+        other backend are left alone (a CLI or a worker running QUERY_BACKEND=local next to BigQuery ones
+        shares the store), and only go when they're evicted.
+    The store is bounded to RESULT_CACHE_MAX_BYTES of payloads: when it's over, the least recently used entries
+        are evicted (down to 90% of the bound). The total size is kept up to date by triggers in the store_size
+        table, so a write doesn't have to add up every entry.
+    SQLite runs in WAL mode, so readers never wait on a writer, and writers in different processes take turns
+        (waiting up to RESULT_CACHE_BUSY_TIMEOUT seconds). The store is only a cache - if it can't be read or
+        written, a warning is printed and the query is run as if it missed.
+    From /src:
+        python -m backend.app.result_store           prints the number of entries and their size
+        python -m backend.app.result_store clear     empties the store
+"""
+
+RESULT_CACHE = os.getenv("RESULT_CACHE", "1") == "1"
+RESULT_CACHE_PATH = Path(os.getenv("RESULT_CACHE_PATH", Path(__file__).parent / "utils/data" / "result_cache.sqlite"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+RESULT_CACHE_BUSY_TIMEOUT = float(os.getenv("RESULT_CACHE_BUSY_TIMEOUT", 5)) # seconds
+# Bump to drop every stored result by hand
+RESULT_CACHE_VERSION = os.getenv("RESULT_CACHE_VERSION", "1")
+
+# How often (seconds) the dataset files / the BigQuery table are checked for changes
+VERSION_CHECK_INTERVAL = 5
+BIGQUERY_VERSION_CHECK_INTERVAL = 3600
+BIGQUERY_VERSION_RETRY_INTERVAL = 60
+
+# The last access time of an entry is only updated if it's older than this (seconds), so most hits don't write
+ACCESS_UPDATE_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    function TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    version TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    size INTEGER NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+CREATE TABLE IF NOT EXISTS store_size (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+INSERT INTO store_size (id, bytes)
+    SELECT 0, (SELECT IFNULL(SUM(size), 0) FROM results) WHERE NOT EXISTS (SELECT 1 FROM store_size);
+CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN
+    UPDATE store_size SET bytes = bytes + new.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF size ON results BEGIN
+    UPDATE store_size SET bytes = bytes + new.size - old.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN
+    UPDATE store_size SET bytes = bytes - old.size WHERE id = 0;
+END;
+"""
+
+"""
+    DATASET VERSION
+"""
+
+_version = None
+_version_checked = 0
+# Read by the version thread - None until its first read
+_bigquery_version = None
+_bigquery_version_thread = None
+_bigquery_version_thread_lock = threading.Lock()
+_version_lock = threading.Lock()
+
+def query_backend():
+    # Imported here - server.py imports this module (through query_cache.py)
+    from .server import QUERY_BACKEND
+    return QUERY_BACKEND
+
+def _mtime_ns(path):
+    return Path(path).stat().st_mtime_ns if Path(path).exists() else None
+
+def check_bigquery_version():
+    """
+    Reads the time the cycle_hire table was last modified - a BigQuery API call, only made by the version thread
+    """
+    global _bigquery_version
+    from .server import get_client
+
+    table = get_client().get_table("bigquery-public-data.london_bicycles.cycle_hire")
+    version = table.modified.isoformat() if table.modified else ""
+    if version != _bigquery_version:
+        _bigquery_version = version
+        reset_dataset_version()
+
+def _bigquery_version_loop():
+    while True:
+        try:
+            check_bigquery_version()
+        except Exception as error:
+            print(f"Warning: Couldn't read the version of the BigQuery table: {error!r}")
+        # Retries sooner until the first read succeeds
+        time.sleep(BIGQUERY_VERSION_CHECK_INTERVAL if _bigquery_version is not None else BIGQUERY_VERSION_RETRY_INTERVAL)
+
+def start_version_checks():
+    """
+    Starts the thread that reads the BigQuery table's version (once per process) - called at startup, and by
+        dataset_version() in processes that don't have one (e.g. the CLIs)
+    """
+    global _bigquery_version_thread
+
+    with _bigquery_version_thread_lock:
+        if _bigquery_version_thread is None:
+            _bigquery_version_thread = threading.Thread(target=_bigquery_version_loop, name="bigquery-version", daemon=True)
+            _bigquery_version_thread.start()
+
+def dataset_version():
+    """
+    Returns a string that changes whenever the data the queries are answered from changes - or None if it's
+        answered from BigQuery and the table's version hasn't been read yet
+    """
+    global _version, _version_checked
+    from .station_cube import STATION_CUBE_PATH
+    from .ride_store import RIDE_STORE_PATH
+
+    now = time.monotonic()
+    if _version is not None and now - _version_checked < VERSION_CHECK_INTERVAL:
+        return _version
+
+    with _version_lock:
+        cube_mtime = _mtime_ns(STATION_CUBE_PATH)
+        backend = query_backend()
+        parts = [RESULT_CACHE_VERSION, backend, cube_mtime]
+        if backend == "local":
+            # The ride store is rewritten (into a new directory) whenever it's ingested
+            parts.append(_mtime_ns(RIDE_STORE_PATH))
+        elif cube_mtime is None:
+            if _bigquery_version is None:
+                start_version_checks()
+                return None
+            parts.append(_bigquery_version)
+
+        _version = hashlib.sha256(json.dumps(parts).encode()).hexdigest()[:16]
+        _version_checked = now
+    return _version
+
+def reset_dataset_version():
+    """
+    Makes the next dataset_version() call check the dataset again, instead of waiting for VERSION_CHECK_INTERVAL
+    """
+    global _version
+
+    with _version_lock:
+        _version = None
+
+"""
+    KEYS AND PAYLOADS
+"""
+
+_source_version = None
+
+def source_version():
+    """
+    Hashes the source of every module in the app (read once per process)
+    """
+    global _source_version
+
+    if _source_version is None:
+        digest = hashlib.sha256()
+        for path in sorted(Path(__file__).parent.glob("*.py")):
+            digest.update(path.name.encode())
+            digest.update(path.read_bytes())
+        _source_version = digest.hexdigest()
+    return _source_version
+
+def function_fingerprint(query_function):
+    """
+    Hashes a query function's name, code and constants (its SQL templates and docstring are constants),
+        and the source of the app's modules, which covers the code it calls
+    Decorators made with functools.wraps (e.g. @timed) are looked through
+    """
+    code = inspect.unwrap(query_function).__code__
+    constants = [constant for constant in code.co_consts if isinstance(constant, (str, int, float, bool, type(None)))]
+    digest = hashlib.sha256()
+    digest.update(source_version().encode())
+    digest.update(f"{query_function.__module__}.{query_function.__qualname__}".encode())
+    digest.update(code.co_code)
+    digest.update(repr(constants).encode())
+    return digest.hexdigest()
+
+def result_key(fingerprint, arguments):
+    return hashlib.sha256(f"{fingerprint}:{json.dumps(arguments, default=str)}".encode()).hexdigest()
+
+def encode_table(table):
+    sink = pa.BufferOutputStream()
+    with ipc.new_stream(sink, table.schema, options=ipc.IpcWriteOptions(compression="zstd")) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def decode_table(payload):
+    return ipc.open_stream(pa.py_buffer(payload)).read_all()
+
+"""
+    DATASET READS
+"""
+
+class DatasetReads:
+    """
+    Whether the cached query being computed read the dataset - passed on to the cached query that called it,
+        since its result was read from the dataset too
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.read = False
+
+    def mark(self):
+        self.read = True
+        if self.parent is not None:
+            self.parent.mark()
+
+# The DatasetReads of the cached query being computed on this thread (set by query_cache.py)
+dataset_reads = contextvars.ContextVar("dataset_reads", default=None)
+
+def mark_dataset_read():
+    """
+    Called by whatever reads the dataset itself - BigQuery jobs (server.py) and ride store scans (ride_store.py)
+    """
+    reads = dataset_reads.get()
+    if reads is not None:
+        reads.mark()
+
+"""
+    STORE
+"""
+
+class ResultStore:
+    def __init__(self, path=RESULT_CACHE_PATH, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        # One connection per thread (sqlite3 connections can't be shared between threads)
+        self.local = threading.local()
+        self.purged_version = None
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=RESULT_CACHE_BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(results)")]
+            if columns and "backend" not in columns:
+                # A store from before entries were tagged with their backend - it's only a cache, start over
+                connection.execute("DROP TABLE results")
+                connection.execute("DROP TABLE IF EXISTS store_size")
+            # In one transaction, so the size row and its triggers are created together
+            connection.executescript(f"BEGIN IMMEDIATE; {SCHEMA} COMMIT;")
+            self.local.connection = connection
+        return connection
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def purge_other_versions(self, connection, backend, version):
+        # Once per process per version - entries of an old dataset can never be returned again
+        # Only this backend's - the other backend's entries are still current for the processes that use it
+        if self.purged_version != (backend, version):
+            connection.execute("DELETE FROM results WHERE backend = ? AND version != ?", (backend, version))
+            self.purged_version = (backend, version)
+
+    def get(self, key, backend, version):
+        """
+        Returns the stored table, or None if there isn't one for this version of the dataset
+        """
+        try:
+            connection = self.connection()
+            self.purge_other_versions(connection, backend, version)
+            row = connection.execute(
+                "SELECT payload, last_access FROM results WHERE key = ? AND version = ?", (key, version)
+            ).fetchone()
+            if row is None:
+                self.count("misses")
+                return None
+
+            now = time.time()
+            if now - row[1] >= ACCESS_UPDATE_INTERVAL:
+                connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            table = decode_table(row[0])
+        except (sqlite3.Error, pa.ArrowException) as error:
+            self.count("errors")
+            print(f"Warning: Couldn't read from the result store {self.path}: {error!r}")
+            return None
+
+        self.count("hits")
+        return table
+
+    def put(self, key, function_name, backend, version, table):
+        """
+        Stores a table, then evicts the least recently used entries if the store is over its size bound
+        """
+        try:
+            payload = encode_table(table)
+            if len(payload) > self.max_bytes:
+                return
+
+            connection = self.connection()
+            now = time.time()
+            connection.execute(
+                # An upsert rather than INSERT OR REPLACE - a replaced row doesn't fire the delete trigger
+                "INSERT INTO results (key, function, backend, version, created, last_access, size, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET function = excluded.function, backend = excluded.backend, version = excluded.version, "
+                "created = excluded.created, last_access = excluded.last_access, size = excluded.size, payload = excluded.payload",
+                (key, function_name, backend, version, now, now, len(payload), payload),
+            )
+            self.evict(connection)
+        except (sqlite3.Error, pa.ArrowException) as error:
+            self.count("errors")
+            print(f"Warning: Couldn't write to the result store {self.path}: {error!r}")
+
+    def total_size(self, connection):
+        return connection.execute("SELECT bytes FROM store_size WHERE id = 0").fetchone()[0]
+
+    def evict(self, connection):
+        if self.total_size(connection) <= self.max_bytes:
+            return
+
+        # In one write transaction, so workers evicting at the same time don't both delete
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            target = int(self.max_bytes * 0.9)
+            total = self.total_size(connection)
+            evicted = []
+            for key, size in connection.execute("SELECT key, size FROM results ORDER BY last_access"):
+                if total <= target:
+                    break
+                evicted.append((key,))
+                total -= size
+            connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        self.connection().execute("DELETE FROM results")
+
+    def stats(self):
+        try:
+            connection = self.connection()
+            entries = connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            size = self.total_size(connection)
+        except sqlite3.Error:
+            entries, size = None, None
+        with self.lock:
+            return {
+                "enabled": True,
+                "path": str(self.path),
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+            }
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_result_store():
+    """
+    Returns the shared store, opening it on first use - None if RESULT_CACHE=0
+    """
+    global _store
+
+    if not RESULT_CACHE:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultStore()
+    return _store
+
+def load_result(fingerprint, arguments):
+    """
+    Returns the stored result of the query function (by its fingerprint) for the arguments and the current dataset,
+        or None
+    """
+    store = get_result_store()
+    if store is None:
+        return None
+    try:
+        version = dataset_version()
+    except Exception as error:
+        print(f"Warning: Couldn't work out the dataset version, skipping the result store: {error!r}")
+        return None
+    if version is None:
+        return None
+    return store.get(result_key(fingerprint, arguments), query_backend(), version)
+
+def save_result(query_function, fingerprint, arguments, result):
+    """
+    Stores the result of query_function(*arguments) - only Arrow tables are stored
+    """
+    store = get_result_store()
+    if store is None or not isinstance(result, pa.Table):
+        return
+    try:
+        version = dataset_version()
+    except Exception as error:
+        print(f"Warning: Couldn't work out the dataset version, skipping the result store: {error!r}")
+        return
+    if version is None:
+        return
+    store.put(result_key(fingerprint, arguments), query_function.__qualname__, query_backend(), version, result)
+
+def result_store_stats():
+    store = get_result_store()
+    return store.stats() if store is not None else {"enabled": False}
+
+if __name__ == "__main__":
+    store = ResultStore()
+    if sys.argv[1:] == ["clear"]:
+        store.clear()
+        print(f"✅ Result store {store.path} cleared")
+    else:
+        stats = store.stats()
+        print(f"✅ Result store {stats['path']}: {stats['entries']} entries, {stats['bytes']} bytes")
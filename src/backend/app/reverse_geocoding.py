@@ -0,0 +1,183 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import json
+import os
+import sys
+import numpy as np
+from .borough_assignment import BOROUGH_BOUNDARIES_PATH, load_boundaries
+from .spatial_index import haversine_m
+from .station_registry import DATA_PATH, load_json
+
+"""
+    This file contains the offline reverse geocoding of the stations - the replacement for the Nominatim loop
+        in utils/scripts/stationIdToBorough.py, which made one request per second over the network.
+    Each station's coordinates are resolved against local boundary polygons (see borough_assignment.py):
+        - borough:  the London borough boundaries (always)
+        - ward:     ward / area boundaries, if WARD_BOUNDARIES_PATH points at a shapefile
+    The stations are split into chunks and resolved in parallel across a process pool - each worker loads the
+        boundaries once. Results are kept in an on-disk cache (geocode_cache.json in utils/data), and a run only
+        resolves the stations that are new, or have moved more than MOVED_THRESHOLD metres, since the last run.
+        The whole cache is redone if the boundary files change.
+    From /src:
+        python -m backend.app.reverse_geocoding [stations.json] [output.json]
+    stations.json is a list of {"id", "latitude", "longitude"} (station_coords.json by default), and the output
+        is a list of {"id", "borough"} (plus "ward"), like stationIdToBorough.json.
+"""
+
+GEOCODE_CACHE_PATH = Path(os.getenv("GEOCODE_CACHE_PATH", DATA_PATH / "geocode_cache.json"))
+WARD_BOUNDARIES_PATH = os.getenv("WARD_BOUNDARIES_PATH")
+WARD_NAME_COLUMN = os.getenv("WARD_NAME_COLUMN", "NAME")
+
+GEOCODE_WORKERS = int(os.getenv("GEOCODE_WORKERS", os.cpu_count() or 1))
+# Below this many stations, the pool costs more than it saves
+MIN_STATIONS_PER_WORKER = 250
+MOVED_THRESHOLD = 1 # metres
+
+def boundary_layers():
+    """
+    Returns {layer name: (shapefile path, name column)} for every boundary layer that's available
+    """
+    layers = {"borough": (str(BOROUGH_BOUNDARIES_PATH), "NAME")}
+    if WARD_BOUNDARIES_PATH and Path(WARD_BOUNDARIES_PATH).exists():
+        layers["ward"] = (WARD_BOUNDARIES_PATH, WARD_NAME_COLUMN)
+    return layers
+
+def layers_signature(layers):
+    # Changes whenever a boundary file is replaced, which invalidates the cache
+    signature = {}
+    for layer, (path, name_column) in layers.items():
+        stat = Path(path).stat()
+        signature[layer] = [path, name_column, stat.st_size, stat.st_mtime]
+    return signature
+
+"""
+    WORKERS
+"""
+
+def geocode_chunk(layers, station_ids, latitudes, longitudes):
+    """
+    Resolves one chunk of stations against every boundary layer (run in the worker processes)
+    Returns a list of {"id", "latitude", "longitude", <layer>: name or None, ...}
+    """
+    resolved = {}
+    for layer, (path, name_column) in layers.items():
+        boundaries = load_boundaries(path, name_column)
+        codes = boundaries.assign(latitudes, longitudes)
+        resolved[layer] = [boundaries.names[code] if code >= 0 else None for code in codes]
+
+    return [
+        {"id": station_id, "latitude": latitude, "longitude": longitude,
+         **{layer: names[i] for layer, names in resolved.items()}}
+        for i, (station_id, latitude, longitude) in enumerate(zip(station_ids, latitudes, longitudes))
+    ]
+
+def _load_layers(layers):
+    # Worker initializer - loads the boundaries once per process, not once per chunk
+    for path, name_column in layers.values():
+        load_boundaries(path, name_column)
+
+def geocode(station_ids, latitudes, longitudes, layers, workers=GEOCODE_WORKERS):
+    """
+    Resolves the stations in parallel, in one chunk per worker
+    """
+    workers = max(min(workers, len(station_ids) // MIN_STATIONS_PER_WORKER), 1)
+    if workers == 1:
+        return geocode_chunk(layers, station_ids, latitudes, longitudes)
+
+    chunks = np.array_split(np.arange(len(station_ids)), workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_load_layers, initargs=(layers,)) as pool:
+        results = pool.map(
+            geocode_chunk,
+            [layers] * len(chunks),
+            [[station_ids[i] for i in chunk] for chunk in chunks],
+            [[latitudes[i] for i in chunk] for chunk in chunks],
+            [[longitudes[i] for i in chunk] for chunk in chunks],
+        )
+        return [station for chunk in results for station in chunk]
+
+"""
+    CACHE
+"""
+
+def load_cache(path=GEOCODE_CACHE_PATH):
+    path = Path(path)
+    if not path.exists():
+        return {"layers": None, "stations": {}}
+    with path.open("r") as file:
+        return json.load(file)
+
+def save_cache(cache, path=GEOCODE_CACHE_PATH):
+    path = Path(path)
+    temporary_path = path.with_name(path.name + ".tmp")
+    with temporary_path.open("w") as file:
+        json.dump(cache, file, indent=2)
+    os.replace(temporary_path, path)
+
+def stale_stations(stations, cache, signature):
+    """
+    Returns the stations that need resolving: new ones, ones that have moved, or all of them if the boundaries changed
+    """
+    if cache["layers"] != signature:
+        return list(stations)
+
+    cached = cache["stations"]
+    stale = []
+    for station in stations:
+        entry = cached.get(str(station["id"]))
+        if entry is None or haversine_m(
+            station["latitude"], station["longitude"], entry["latitude"], entry["longitude"]
+        ) > MOVED_THRESHOLD:
+            stale.append(station)
+    return stale
+
+def geocode_stations(stations, cache_path=GEOCODE_CACHE_PATH, workers=GEOCODE_WORKERS):
+    """
+    Resolves the boroughs (and wards) of a list of {"id", "latitude", "longitude"} stations, using the cache
+    Returns (results in the same order as the input, number of stations that were resolved this run)
+    """
+    stations = [
+        station for station in stations
+        if station.get("id") is not None and station.get("latitude") is not None and station.get("longitude") is not None
+    ]
+    layers = boundary_layers()
+    signature = layers_signature(layers)
+
+    cache = load_cache(cache_path)
+    stale = stale_stations(stations, cache, signature)
+    if cache["layers"] != signature:
+        cache = {"layers": signature, "stations": {}}
+
+    if stale:
+        resolved = geocode(
+            [station["id"] for station in stale],
+            [station["latitude"] for station in stale],
+            [station["longitude"] for station in stale],
+            layers,
+            workers,
+        )
+        for station in resolved:
+            cache["stations"][str(station["id"])] = station
+        save_cache(cache, cache_path)
+
+    results = []
+    for station in stations:
+        entry = cache["stations"][str(station["id"])]
+        results.append({"id": station["id"], **{layer: entry.get(layer) for layer in layers}})
+
+    return results, len(stale)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as file:
+            input_data = json.load(file)
+    else:
+        input_data = load_json("station_coords.json")
+    output_path = sys.argv[2] if len(sys.argv) > 2 else "stationIdToBorough.json"
+
+    results, resolved = geocode_stations(input_data)
+
+    with open(output_path, "w") as file:
+        json.dump(results, file, indent=2)
+
+    unknown = sum(1 for station in results if station["borough"] is None)
+    print(f"✅ {len(results)} stations ({resolved} resolved, {len(results) - resolved} from the cache, {unknown} outside every borough) saved to {output_path}")
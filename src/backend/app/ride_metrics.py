@@ -0,0 +1,64 @@
+import threading
+import numpy as np
+import pyarrow as pa
+from .ride_store import MAX_STATION_ID
+from .spatial_index import haversine_m
+from .station_registry import get_station_registry
+
+"""
+    This file contains the ride metrics used by the CO2 offset panel - the number of trips, their summed duration
+        and their summed straight-line distance.
+    A trip's distance is the great-circle distance between its start and end stations. Those distances are
+        computed once, for every pair of station ids, as a (stations x stations) matrix with a vectorized haversine
+        over the station coordinates (see spatial_index.py), so a trip's distance is a single lookup.
+    The station cube (and the block cache) sum the durations and distances per day and station when they're built
+        (see station_cube.py), so the metrics for a date range are a prefix sum lookup, like the station totals.
+"""
+
+_distances = None
+_distances_registry = None
+_lock = threading.Lock()
+
+def station_distance_matrix(registry):
+    """
+    Great-circle distance in metres between every pair of station ids (0 where either station has no coordinates)
+    """
+    rows = registry.rows(np.arange(MAX_STATION_ID))
+    known = rows >= 0
+    latitudes = np.where(known, registry.latitudes[np.where(known, rows, 0)], np.nan)
+    longitudes = np.where(known, registry.longitudes[np.where(known, rows, 0)], np.nan)
+
+    distances = haversine_m(latitudes[:, None], longitudes[:, None], latitudes[None, :], longitudes[None, :])
+    distances = np.nan_to_num(distances, nan=0.0)
+    distances.flags.writeable = False
+    return distances
+
+def get_station_distances():
+    """
+    Returns the distance matrix for the current station registry, rebuilding it when the registry changes
+    """
+    global _distances, _distances_registry
+
+    registry = get_station_registry()
+    with _lock:
+        if _distances_registry is not registry:
+            _distances = station_distance_matrix(registry)
+            _distances_registry = registry
+        return _distances
+
+def trip_distances(start_ids, end_ids):
+    """
+    Straight-line distance in metres of trips between arrays of (valid) start and end station ids
+    """
+    return get_station_distances()[start_ids, end_ids]
+
+def trip_totals_table(totals):
+    """
+    Turns per-station totals (measure -> array indexed by station id) into the get_trip_totals result:
+    one row of (trips, duration in seconds, distance in metres)
+    """
+    return pa.table({
+        "trips": [int(totals["trip_counts"].sum())],
+        "duration": [int(totals["duration_sums"].sum())],
+        "distance": [int(totals["distance_sums"].sum())],
+    })
@@ -0,0 +1,249 @@
+from datetime import datetime, timezone
+from pathlib import Path
+import os
+import shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from .result_store import mark_dataset_read
+from .usage_windows import DEFAULT_WINDOW_MONTHS, usage_periods, usage_change_table
+
+"""
+    This file contains the local ride store - a copy of the cycle_hire table kept on disk as Parquet,
+        partitioned by month (month=YYYY-MM/rides.parquet) and sorted by start_date inside each partition.
+    When QUERY_BACKEND=local, the query functions in server.py are answered from here instead of BigQuery
+        (the station totals through the blocks in block_cache.py, the rest by the functions below).
+    Only the columns the queries need are scanned, and the date filters are pushed down to the partition
+        and row group level, so a date range query only reads the months (and row groups) it covers.
+    BigQuery is only needed once, to ingest the data (see ingest_rides() at the bottom of this file).
+"""
+
+RIDE_STORE_PATH = Path(os.getenv("RIDE_STORE_PATH", Path(__file__).parent / "utils/data/rides"))
+
+# Same cut-off as the BigQuery queries - station ids from 876 upwards are not in the station details
+MAX_STATION_ID = 876
+
+RIDE_SCHEMA = pa.schema([
+    ("rental_id", pa.int64()),
+    ("duration", pa.int64()),
+    ("start_date", pa.timestamp("us", tz="UTC")),
+    ("end_date", pa.timestamp("us", tz="UTC")),
+    ("start_station_id", pa.int32()),
+    ("end_station_id", pa.int32()),
+])
+
+"""
+--------------
+    UTILITY
+--------------
+"""
+
+def to_timestamp(value):
+    """
+    Parses a date string from the API ("2015-01-04" or a full ISO timestamp) into a UTC datetime,
+    which is how BigQuery interprets the same string when comparing it against a TIMESTAMP column
+    """
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def store_exists():
+    return RIDE_STORE_PATH.exists() and any(RIDE_STORE_PATH.glob("month=*/*.parquet"))
+
+def open_dataset():
+    # pyarrow.dataset is imported on first use - it pulls in pandas, which would slow down the app's startup
+    import pyarrow.dataset as ds
+
+    # Results read from here are worth keeping in the result store (see result_store.py)
+    mark_dataset_read()
+
+    return ds.dataset(RIDE_STORE_PATH, format="parquet", partitioning="hive", schema=RIDE_SCHEMA.append(pa.field("month", pa.string())))
+
+def station_counts(station_ids):
+    """
+    Counts rides per station id, dropping nulls and ids outside the station details (negative or >= MAX_STATION_ID,
+        like the BigQuery queries)
+    Returns an array indexed by station id
+    """
+    ids = pc.drop_null(station_ids).to_numpy()
+    ids = ids[(ids >= 0) & (ids < MAX_STATION_ID)]
+    return np.bincount(ids, minlength=MAX_STATION_ID)
+
+def ordered_stations_table(total_rides):
+    """
+    Turns an array of ride totals indexed by station id into the get_ordered_stations result:
+    a table of (station_id, total_rides) for every station with rides, busiest first
+    """
+    station_ids = np.flatnonzero(total_rides)
+    station_ids = station_ids[np.argsort(-total_rides[station_ids], kind="stable")]
+    return pa.table({
+        "station_id": pa.array(station_ids, pa.int64()),
+        "total_rides": pa.array(total_rides[station_ids], pa.int64()),
+    })
+
+def column_stat(column, stat):
+    """
+    Reads the min or max of a column from the Parquet row group statistics, so no data pages are read
+    """
+    values = []
+    for fragment in open_dataset().get_fragments():
+        metadata = fragment.metadata
+        index = metadata.schema.names.index(column)
+        for i in range(metadata.num_row_groups):
+            statistics = metadata.row_group(i).column(index).statistics
+            if statistics is not None and statistics.has_min_max:
+                values.append(getattr(statistics, stat))
+    if not values:
+        return None
+    value = min(values) if stat == "min" else max(values)
+    return to_timestamp(value)
+
+"""
+    UTILITY QUERIES
+"""
+
+def get_min_date():
+    return pa.table({"min_date": pa.array([column_stat("start_date", "min")], RIDE_SCHEMA.field("start_date").type)})
+
+def get_max_date():
+    return pa.table({"max_date": pa.array([column_stat("end_date", "max")], RIDE_SCHEMA.field("end_date").type)})
+
+"""
+    DATA QUERIES
+"""
+
+def get_change_in_monthly_average_use_foreach_station(start_date: str, end_date: str, window_months=DEFAULT_WINDOW_MONTHS):
+    """
+    Local version of server.get_change_in_monthly_average_use_foreach_station
+    """
+    min_start_date = column_stat("start_date", "min").date()
+    max_end_date = column_stat("end_date", "max").date()
+
+    start_period, end_period = usage_periods(
+        to_timestamp(start_date).date(), to_timestamp(end_date).date(), min_start_date, max_end_date, window_months
+    )
+
+    def period_counts(period):
+        period_start = datetime.combine(period[0], datetime.min.time(), timezone.utc)
+        period_end = datetime.combine(period[1], datetime.max.time(), timezone.utc)
+        month_filter = (pc.field("month") >= period[0].strftime("%Y-%m")) & (pc.field("month") <= period[1].strftime("%Y-%m"))
+        date_filter = (pc.field("start_date") >= pa.scalar(period_start, RIDE_SCHEMA.field("start_date").type)) & \
+            (pc.field("start_date") <= pa.scalar(period_end, RIDE_SCHEMA.field("start_date").type))
+        rides = open_dataset().to_table(columns=["start_station_id"], filter=month_filter & date_filter)
+        return station_counts(rides.column("start_station_id"))
+
+    starting_counts = period_counts(start_period)
+    ending_counts = period_counts(end_period)
+
+    return usage_change_table(starting_counts, ending_counts, window_months)
+
+def iter_station_daily_counts(start_date: str, end_date: str):
+    """
+    Local version of server.iter_station_daily_counts - yields one record batch per month of
+        (day, station_id, start_rides, end_rides), so only one month of rides is in memory at a time.
+    As in the station cube, rides are counted on the day they started, from start_date's day up to (not including)
+        end_date's day, with or without an end_date.
+    """
+    start = to_timestamp(start_date)
+    end = to_timestamp(end_date)
+    first_day_start = datetime.combine(start.date(), datetime.min.time(), timezone.utc)
+    end_day_start = datetime.combine(end.date(), datetime.min.time(), timezone.utc)
+    months = sorted(path.name.split("=", 1)[1] for path in RIDE_STORE_PATH.glob("month=*"))
+    date_filter = (pc.field("start_date") >= pa.scalar(first_day_start, RIDE_SCHEMA.field("start_date").type)) & \
+        (pc.field("start_date") < pa.scalar(end_day_start, RIDE_SCHEMA.field("start_date").type))
+
+    for month in months:
+        if not start.strftime("%Y-%m") <= month <= end.strftime("%Y-%m"):
+            continue
+
+        # The partitions are by start month, so each month's rides are complete days
+        rides = open_dataset().to_table(
+            columns=["start_date", "start_station_id", "end_station_id"],
+            filter=(pc.field("month") == month) & date_filter,
+        )
+        if rides.num_rows == 0:
+            continue
+
+        days = pc.cast(rides.column("start_date"), pa.date32()).to_numpy(zero_copy_only=False).astype("datetime64[D]")
+        first_day = np.datetime64(f"{month}-01", "D")
+        day_rows = (days - first_day).astype(np.int64)
+        num_days = int(day_rows.max()) + 1
+
+        counts = []
+        for column in ("start_station_id", "end_station_id"):
+            ids = pc.fill_null(rides.column(column), MAX_STATION_ID).to_numpy().astype(np.int64)
+            known = (ids >= 0) & (ids < MAX_STATION_ID)
+            cells = np.bincount(day_rows[known] * MAX_STATION_ID + ids[known], minlength=num_days * MAX_STATION_ID)
+            counts.append(cells.reshape(num_days, MAX_STATION_ID))
+        start_counts, end_counts = counts
+
+        day_offsets, stations = np.nonzero(start_counts + end_counts)
+        yield pa.record_batch({
+            "day": pa.array(first_day + day_offsets, pa.date32()),
+            "station_id": pa.array(stations, pa.int64()),
+            "start_rides": pa.array(start_counts[day_offsets, stations], pa.int64()),
+            "end_rides": pa.array(end_counts[day_offsets, stations], pa.int64()),
+        })
+
+"""
+--------------
+    INGEST
+--------------
+"""
+
+def ingest_rides(client, store_path=RIDE_STORE_PATH):
+    """
+    Copies the cycle_hire table out of BigQuery into the local ride store.
+    The rows are streamed through the BigQuery Storage API and written into a staging dataset partitioned by month,
+    then each month is sorted by start_date and rewritten as a single file, so row group statistics on
+    start_date are tight and the date filters on start_date can skip most of the file.
+    """
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    query = """
+    SELECT rental_id, duration, start_date, end_date, start_station_id, end_station_id
+    FROM `bigquery-public-data.london_bicycles.cycle_hire`
+    WHERE start_date IS NOT NULL
+    """
+
+    store_path = Path(store_path)
+    staging_path = store_path.parent / (store_path.name + "_staging")
+    shutil.rmtree(staging_path, ignore_errors=True)
+
+    def batches():
+        for batch in client.query(query).result().to_arrow_iterable():
+            batch = pa.Table.from_batches([batch]).cast(RIDE_SCHEMA)
+            month = pc.strftime(batch.column("start_date"), format="%Y-%m")
+            yield from batch.append_column("month", month).to_batches()
+
+    ds.write_dataset(
+        batches(),
+        staging_path,
+        schema=RIDE_SCHEMA.append(pa.field("month", pa.string())),
+        format="parquet",
+        partitioning=["month"],
+        partitioning_flavor="hive",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+    shutil.rmtree(store_path, ignore_errors=True)
+    for month_path in sorted(staging_path.glob("month=*")):
+        rides = ds.dataset(month_path, format="parquet", schema=RIDE_SCHEMA).to_table().sort_by("start_date")
+        (store_path / month_path.name).mkdir(parents=True, exist_ok=True)
+        pq.write_table(rides, store_path / month_path.name / "rides.parquet", row_group_size=64 * 1024)
+        print(f"✅ {month_path.name}: {len(rides)} rides")
+
+    shutil.rmtree(staging_path, ignore_errors=True)
+
+if __name__ == "__main__":
+    # Run from /src with: python -m backend.app.ride_store
+    from google.cloud import bigquery
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    ingest_rides(bigquery.Client())
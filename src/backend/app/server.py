@@ -1,87 +1,195 @@
-from google.cloud import bigquery
 from dotenv import load_dotenv
+
+# Before the other app modules are imported, since they read their settings from the environment
+load_dotenv()
+
 import json
 import os
+import threading
+import numpy as np
+import pyarrow as pa
+from . import block_cache, ride_store, station_cube
+from .query_cache import cached_query
+from .query_executor import QUERY_TIMEOUT, track_job
+from .instrumentation import record_job, span, timed
+from .query_templates import query_template
+from .result_store import mark_dataset_read
+from .ride_metrics import trip_totals_table
+from .spatial_index import EARTH_RADIUS_M
+from .station_registry import get_station_registry
+from .usage_windows import DEFAULT_WINDOW_MONTHS, usage_periods
+from .arrow_results import first_value
 
 """
     This file creates the instance of the BigQuery connection, loads the API key from the .env file,
         and contains the queries that are run against the database. 
+    The BigQuery client (and the google-cloud libraries) are only loaded the first time a query actually
+        needs BigQuery (see get_client()), so importing the app stays fast and queries answered from the
+        cache, the station cube or the local store never touch them.
     They are then called in main.py, where the endpoints are defined.
+    The data queries can also be answered from the local Parquet ride store (see ride_store.py)
+        by setting QUERY_BACKEND=local in the .env file.
+    Whenever the station cube has been built (see station_cube.py), the station totals and the min/max dates
+        are served from it instead of running a query at all.
+    Without the cube, the station totals are summed from cached year / month / day blocks, and only the blocks
+        no earlier request has covered are fetched (see block_cache.py).
+    Query results are cached, and identical queries that are already running are shared (see query_cache.py).
+    The functions here are blocking - main.py runs them in a thread pool (see query_executor.py).
+    Results are returned as pyarrow Tables (see arrow_results.py).
+    The SQL is registered as query templates with typed parameters (see query_templates.py) - request values
+        are never formatted into the SQL text.
+    With INSTRUMENTATION=1, each query function, BigQuery job wait and result download is timed, and the bytes
+        processed and rows returned by each job are recorded (see instrumentation.py).
+    The iter_* functions at the bottom are generators of record batches for the streaming endpoints -
+        BigQuery results are read a page at a time, so a large result is never held in memory at once.
 """
 
-load_dotenv()
+# "bigquery" (default) or "local"
+# The local backend never creates a BigQuery client - it serves everything from the station cube
+#   and the ride store, and BigQuery is only used to ingest them
+QUERY_BACKEND = os.getenv("QUERY_BACKEND", "bigquery")
+
+class BackendUnavailable(Exception):
+    pass
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Returns the BigQuery client, creating it on first use
+    """
+    global _client
+
+    if _client is None:
+        if QUERY_BACKEND != "bigquery":
+            raise BackendUnavailable(f"BigQuery is disabled (QUERY_BACKEND={QUERY_BACKEND})")
+
+        with _client_lock:
+            if _client is None:
+                from google.cloud import bigquery
+                _client = bigquery.Client()
+
+    return _client
 
-client = bigquery.Client() 
+# Rows per page when a BigQuery result is streamed
+STREAM_PAGE_SIZE = int(os.getenv("STREAM_PAGE_SIZE", 10_000))
+
+def submit_query(query, **parameters):
+    """
+    Starts a BigQuery job for a query template (with its parameters) and waits for it to finish
+        (cancelling it if it takes longer than QUERY_TIMEOUT).
+    The job is registered with the calling request, so it's also cancelled if the client disconnects.
+    """
+    query_job = get_client().query(query.sql, job_config=query.job_config(**parameters))
+    track_job(query_job)
+    mark_dataset_read()
+
+    try:
+        with span(f"bigquery.wait.{query.name}"):
+            rows = query_job.result(timeout=QUERY_TIMEOUT)
+    except TimeoutError:
+        query_job.cancel()
+        raise
+
+    query.record(query_job, rows.total_rows)
+    record_job(query.name, query_job, rows.total_rows)
+    return query_job
+
+def download_table(query, query_job):
+    """
+    Fetches the result of a finished job as an Arrow table (through the BigQuery Storage API)
+    """
+    with span(f"bigquery.download.{query.name}"):
+        return query_job.to_arrow()
 
 """
     CONNECTION TESTS
 """
 
 def test_hire_table():
-    query = """`
+    query = query_template("test_hire_table", """
     SELECT 
         *
     FROM `bigquery-public-data.london_bicycles.cycle_hire` 
     LIMIT 1
-    """
+    """)
     
     # Run the query on the client connection
-    query_job = client.query(query)
+    query_job = submit_query(query)
 
-    # Convert the response to JSON with .to_dataframe()    
-    # Return the JSON as the response to the call
-    response = query_job.to_dataframe().to_dict(orient="records")
+    # Fetch the response as an Arrow table (through the BigQuery Storage API)
+    # main.py encodes the JSON response straight from its columns
+    response = download_table(query, query_job)
     return response
 
 def test_stations_table():
-    query = """
+    query = query_template("test_stations_table", """
     SELECT 
         *
     FROM `bigquery-public-data.london_bicycles.cycle_stations` 
     LIMIT 1
-    """
+    """)
     
-    query_job = client.query(query)
+    query_job = submit_query(query)
 
-    response = query_job.to_dataframe().to_dict(orient="records")
+    response = download_table(query, query_job)
     return response
 
 """
     UTILITY 
 """
 
+@cached_query()
+@timed("query.get_min_date")
 def get_min_date():
-    query = """
+    cube = station_cube.get_cube()
+    if cube is not None:
+        return cube.get_min_date()
+
+    if QUERY_BACKEND == "local":
+        return ride_store.get_min_date()
+
+    query = query_template("min_date", """
     SELECT 
         MIN(start_date) as min_date
     FROM `bigquery-public-data.london_bicycles.cycle_hire` 
-    """
+    """)
     
-    query_job = client.query(query)
+    query_job = submit_query(query)
 
-    response = query_job.to_dataframe().to_dict(orient="records")
+    response = download_table(query, query_job)
     return response
 
+@cached_query()
+@timed("query.get_max_date")
 def get_max_date():
-    query = """
+    cube = station_cube.get_cube()
+    if cube is not None:
+        return cube.get_max_date()
+
+    if QUERY_BACKEND == "local":
+        return ride_store.get_max_date()
+
+    query = query_template("max_date", """
     SELECT 
         MAX(end_date) as max_date
     FROM `bigquery-public-data.london_bicycles.cycle_hire` 
-    """
+    """)
     
-    query_job = client.query(query)
+    query_job = submit_query(query)
 
-    response = query_job.to_dataframe().to_dict(orient="records")
+    response = download_table(query, query_job)
     return response
 
 def get_station_ids_locations():
-    query = """
+    query = query_template("station_locations", """
     SELECT id, latitude, longitude
     FROM `bigquery-public-data.london_bicycles.cycle_stations`
     ORDER BY id
-    """
+    """)
     
-    query_job = client.query(query)
+    query_job = submit_query(query)
 
     # Save the response in a JSON
     response = query_job.to_dataframe().to_json("station_locations.json", orient="records", indent=2)
@@ -97,10 +205,8 @@ def find_missing_station_ids():
 
     known_ids = set(s["id"] for s in station_details if s["id"] is not None)
 
-    client = bigquery.Client()
-
     # Query for all unique station IDs from start and end
-    query = """
+    query = query_template("station_ids", """
         SELECT DISTINCT start_station_id AS id
         FROM `bigquery-public-data.london_bicycles.cycle_hire`
         WHERE start_station_id IS NOT NULL
@@ -108,9 +214,9 @@ def find_missing_station_ids():
         SELECT DISTINCT end_station_id AS id
         FROM `bigquery-public-data.london_bicycles.cycle_hire`
         WHERE end_station_id IS NOT NULL
-    """
+    """)
 
-    query_job = client.query(query)
+    query_job = submit_query(query)
     results = query_job.result()
 
     missing_ids = set()
@@ -129,93 +235,184 @@ def find_missing_station_ids():
     return response
 
 """
-    DATA QUERIES
+    BLOCK TOTALS
 """
 
-def get_ordered_stations(start_date: str, end_date: str):
+@timed("query.fetch_block_totals")
+def fetch_block_totals(blocks):
     """
-    This query is designed to return the bike stations in London 
-    based on the total number of rides starting OR ending at each station, 
-    during the specified date range
+    Fetches the per-station measures of year / month / day blocks (see block_cache.py) in one query
+    The rides are aggregated per block and start station (rides, trips, duration and distance) and per block
+        and end station (rides), so the result has a row per block and station, never per station pair.
+    A trip's distance is the haversine distance between its stations' coordinates in the station registry,
+        passed with the query - the same distances as the station cube (see ride_metrics.py).
     """
+    if QUERY_BACKEND == "local":
+        return block_cache.fetch_local_blocks(blocks)
 
-    query = f"""
-    WITH start_counts AS (
-    SELECT start_station_id AS station_id, COUNT(*) AS start_rides
-    FROM `bigquery-public-data.london_bicycles.cycle_hire`
-    WHERE start_station_id IS NOT NULL 
-    AND start_date > "{start_date}" AND end_date < "{end_date}"
-    AND start_station_id < 876
-    GROUP BY start_station_id
+    query = query_template("block_totals", """
+    WITH stations AS (
+        SELECT
+            id,
+            RADIANS(@latitudes[OFFSET(row)]) AS latitude,
+            RADIANS(@longitudes[OFFSET(row)]) AS longitude
+        FROM UNNEST(@station_ids) AS id WITH OFFSET AS row
     ),
-    end_counts AS (
-    SELECT end_station_id AS station_id, COUNT(*) AS end_rides
-    FROM `bigquery-public-data.london_bicycles.cycle_hire`
-    WHERE end_station_id IS NOT NULL 
-    AND start_date > "{start_date}" AND end_date < "{end_date}"
-    AND end_station_id < 876
-    GROUP BY end_station_id
+    rides AS (
+        SELECT
+            RANGE_BUCKET(DATE(start_date), @boundaries) AS bucket,
+            start_station_id,
+            end_station_id,
+            duration,
+            -- The same trips as the station cube and the local blocks - a negative duration isn't one
+            end_station_id >= 0 AND end_station_id < @max_station_id AND duration >= 0 AS is_trip
+        FROM `bigquery-public-data.london_bicycles.cycle_hire`
+        WHERE DATE(start_date) >= @first_day AND DATE(start_date) < @end_day
+        AND RANGE_BUCKET(DATE(start_date), @boundaries) IN UNNEST(@buckets)
+    ),
+    starts AS (
+        SELECT
+            bucket,
+            start_station_id AS station_id,
+            COUNT(*) AS start_rides,
+            COUNTIF(is_trip) AS trips,
+            IFNULL(SUM(IF(is_trip, duration, 0)), 0) AS duration_sum,
+            -- Stations without coordinates give NULL distances, which SUM skips
+            IFNULL(SUM(IF(is_trip, 2 * @earth_radius * ASIN(SQRT(LEAST(1,
+                POW(SIN((e.latitude - s.latitude) / 2), 2)
+                + COS(s.latitude) * COS(e.latitude) * POW(SIN((e.longitude - s.longitude) / 2), 2)
+            ))), 0)), 0) AS distance_sum
+        FROM rides
+        LEFT JOIN stations AS s ON s.id = rides.start_station_id
+        LEFT JOIN stations AS e ON e.id = rides.end_station_id
+        GROUP BY bucket, station_id
+    ),
+    ends AS (
+        SELECT
+            bucket,
+            end_station_id AS station_id,
+            COUNT(*) AS end_rides
+        FROM rides
+        GROUP BY bucket, station_id
     )
     SELECT
-    COALESCE(sc.station_id, ec.station_id) AS station_id,
-    COALESCE(sc.start_rides, 0) + COALESCE(ec.end_rides, 0) AS total_rides
-    FROM start_counts sc
-    FULL OUTER JOIN end_counts ec
-    ON sc.station_id = ec.station_id
-    ORDER BY total_rides DESC;
+        bucket,
+        station_id,
+        IFNULL(start_rides, 0) AS start_rides,
+        IFNULL(end_rides, 0) AS end_rides,
+        IFNULL(trips, 0) AS trips,
+        IFNULL(duration_sum, 0) AS duration_sum,
+        IFNULL(distance_sum, 0) AS distance_sum
+    FROM starts
+    FULL OUTER JOIN ends USING (bucket, station_id)
+    """,
+        boundaries="ARRAY<DATE>", buckets="ARRAY<INT64>", first_day="DATE", end_day="DATE",
+        station_ids="ARRAY<INT64>", latitudes="ARRAY<FLOAT64>", longitudes="ARRAY<FLOAT64>",
+        max_station_id="INT64", earth_radius="FLOAT64",
+    )
+
+    registry = get_station_registry()
+    located = ~np.isnan(registry.latitudes) & ~np.isnan(registry.longitudes)
+    boundaries, buckets = block_cache.block_buckets(blocks)
+    query_job = submit_query(
+        query,
+        boundaries=boundaries, buckets=buckets, first_day=boundaries[0], end_day=boundaries[-1],
+        station_ids=registry.station_ids[located].tolist(),
+        latitudes=registry.latitudes[located].tolist(),
+        longitudes=registry.longitudes[located].tolist(),
+        max_station_id=ride_store.MAX_STATION_ID, earth_radius=EARTH_RADIUS_M,
+    )
+    rows = download_table(query, query_job)
+
+    return block_cache.bucket_station_measures(
+        blocks,
+        rows.column("bucket").to_numpy(),
+        station_cube.station_ids(rows.column("station_id")),
+        {
+            "start_counts": rows.column("start_rides").to_numpy().astype(np.float64),
+            "end_counts": rows.column("end_rides").to_numpy().astype(np.float64),
+            "trip_counts": rows.column("trips").to_numpy().astype(np.float64),
+            "duration_sums": rows.column("duration_sum").to_numpy().astype(np.float64),
+            "distance_sums": rows.column("distance_sum").to_numpy().astype(np.float64),
+        },
+    )
+
+@timed("query.get_station_totals")
+def get_station_totals(start_date: str, end_date: str):
+    """
+    Per-station totals of the station cube's measures for the days from start_date up to end_date,
+        summed from the cached year / month / day blocks - only the blocks that haven't been seen are fetched
     """
+    return block_cache.station_totals(start_date, end_date, fetch_block_totals)
 
+"""
+    DATA QUERIES
+"""
+
+@cached_query()
+@timed("query.get_ordered_stations")
+def get_ordered_stations(start_date: str, end_date: str):
     """
-        MAYBE CHANGE TO JUST RIDE STARTS, NOT STARTS AND ENDS
+    This query is designed to return the bike stations in London 
+    based on the total number of rides starting OR ending at each station, 
+    during the specified date range
     """
+    cube = station_cube.get_cube()
+    if cube is not None:
+        return cube.get_ordered_stations(start_date, end_date)
 
-    query_job = client.query(query)
+    """
+        MAYBE CHANGE TO JUST RIDE STARTS, NOT STARTS AND ENDS
+    """
 
-    response = query_job.to_dataframe().to_dict(orient="records")
-    return response
+    totals = get_station_totals(start_date, end_date)
+    return ride_store.ordered_stations_table(totals["start_counts"] + totals["end_counts"])
 
+@cached_query()
+@timed("query.get_cycling_duration")
 def get_cycling_duration(start_date: str, end_date: str):
     """
     This query returns the cycling duration in seconds of all rides between
     the specified start and end dates 
     """
+    cube = station_cube.get_cube()
+    if cube is not None:
+        return cube.get_cycling_duration(start_date, end_date)
 
-    query = f"""
-    SELECT COUNT(duration) as duration
-    FROM `bigquery-public-data.london_bicycles.cycle_hire` 
-    WHERE start_station_id IS NOT NULL 
-    AND end_station_id IS NOT NULL
-    AND start_date > "{start_date}" AND end_date < "{end_date}"
-    AND (start_station_id < 876 AND end_station_id < 876)
-    """
+    totals = get_station_totals(start_date, end_date)
+    return pa.table({"duration": [int(totals["duration_sums"].sum())]})
 
-    query_job = client.query(query)
+@cached_query()
+@timed("query.get_trip_totals")
+def get_trip_totals(start_date: str, end_date: str):
+    """
+    Returns the number of trips between the specified start and end dates, with their summed duration
+    (seconds) and summed straight-line distance between stations (metres) - see ride_metrics.py
+    """
+    cube = station_cube.get_cube()
+    if cube is not None:
+        return cube.get_trip_totals(start_date, end_date)
 
-    response = query_job.to_dataframe().to_dict(orient="records")
-    return response
+    return trip_totals_table(get_station_totals(start_date, end_date))
 
+@cached_query()
+@timed("query.get_number_of_trips")
 def get_number_of_trips(start_date: str, end_date: str):
     """
     This query simply returns the number of trips between the specified start and end date
     """
+    cube = station_cube.get_cube()
+    if cube is not None:
+        return cube.get_number_of_trips(start_date, end_date)
 
-    query = f"""
-    SELECT COUNT(*)
-    FROM `bigquery-public-data.london_bicycles.cycle_hire` 
-    WHERE start_station_id IS NOT NULL 
-    AND end_station_id IS NOT NULL
-    AND start_date > "{start_date}" AND end_date < "{end_date}"
-    AND (start_station_id < 876 AND end_station_id < 876)
-    """
-
-    query_job = client.query(query)
-
-    response = query_job.to_dataframe().to_dict(orient="records")
-    return response
+    totals = get_station_totals(start_date, end_date)
+    return pa.table({"f0_": [int(totals["trip_counts"].sum())]})
 
-def get_change_in_monthly_average_use_foreach_station(start_date: str, end_date: str):
+@cached_query()
+@timed("query.get_change_in_monthly_average_use_foreach_station")
+def get_change_in_monthly_average_use_foreach_station(start_date: str, end_date: str, window_months: int = DEFAULT_WINDOW_MONTHS):
     """
-    This query returns the average monthly usage for a 3-month period, and is used in the 
+    This query returns the average monthly usage for a 3-month period (or window_months), and is used in the 
     "Boroughs with Highest Change in Use" graph.
     The starting and ending periods are calculated using the parsed start and end date:
     As long as there is no overlap with the minimum start date, the start period will range from 45 days before
@@ -248,100 +445,116 @@ def get_change_in_monthly_average_use_foreach_station(start_date: str, end_date:
     I also confirmed how GPT was calculating the monthly average:
     - It simply counted the number of rides across the 3 month periods, and divided it by 3, giving a monthly average of the number
     of rides for both the starting period and ending period.
-
-
+    ------
+    The period logic has since moved out of the SQL and into usage_windows.py, where it's shared by every backend
+    and uses the real min/max dates instead of hard-coded ones. The query now makes one pass over the hires,
+    counting the rides in both periods at once (rather than a CROSS JOIN scan per period).
     """
-    query = f"""
-    WITH params AS (
-    SELECT
-    DATE('2023-01-17') AS max_end_date,
-    DATE('2015-01-04') AS min_start_date,
-    DATE('{start_date}') AS user_start_date,  
-    DATE('{end_date}') AS user_end_date     
-    ),
+    cube = station_cube.get_cube()
+    if cube is not None:
+        return cube.get_change_in_monthly_average_use_foreach_station(start_date, end_date, window_months)
+
+    if QUERY_BACKEND == "local":
+        return ride_store.get_change_in_monthly_average_use_foreach_station(start_date, end_date, window_months)
+
+    start_period, end_period = usage_periods(
+        ride_store.to_timestamp(start_date).date(),
+        ride_store.to_timestamp(end_date).date(),
+        first_value(get_min_date(), "min_date").date(),
+        first_value(get_max_date(), "max_date").date(),
+        window_months,
+    )
 
-    start_period AS (
+    query = query_template("change_in_usage", """
     SELECT
-        CASE
-        WHEN DATE_SUB(user_start_date, INTERVAL 45 DAY) < min_start_date THEN min_start_date
-        ELSE DATE_SUB(user_start_date, INTERVAL 45 DAY)
-        END AS start_period_start,
-        
-        CASE
-        WHEN DATE_SUB(user_start_date, INTERVAL 45 DAY) < min_start_date THEN DATE_ADD(min_start_date, INTERVAL 3 MONTH)
-        WHEN DATE_ADD(user_start_date, INTERVAL 45 DAY) > max_end_date THEN max_end_date
-        ELSE DATE_ADD(user_start_date, INTERVAL 45 DAY)
-        END AS start_period_end
-    FROM params
-    ),
+        start_station_id AS station_id,
+        ROUND(COUNTIF(DATE(start_date) BETWEEN @start_period_first AND @start_period_last) / @window_months, 2) AS starting_period_avg,
+        ROUND(COUNTIF(DATE(start_date) BETWEEN @end_period_first AND @end_period_last) / @window_months, 2) AS ending_period_avg
+    FROM `bigquery-public-data.london_bicycles.cycle_hire`
+    WHERE start_station_id IS NOT NULL
+    AND start_station_id < 876
+    AND (
+        DATE(start_date) BETWEEN @start_period_first AND @start_period_last
+        OR DATE(start_date) BETWEEN @end_period_first AND @end_period_last
+    )
+    GROUP BY start_station_id
+    ORDER BY station_id;
+    """,
+        start_period_first="DATE", start_period_last="DATE", end_period_first="DATE", end_period_last="DATE", window_months="INT64",
+    )
 
-    end_period AS (
-    SELECT
-        CASE
-        WHEN DATE_ADD(user_end_date, INTERVAL 45 DAY) > max_end_date THEN DATE_SUB(max_end_date, INTERVAL 3 MONTH)
-        WHEN DATE_SUB(user_end_date, INTERVAL 45 DAY) < min_start_date THEN min_start_date
-        ELSE DATE_SUB(user_end_date, INTERVAL 45 DAY)
-        END AS end_period_start,
-
-        CASE
-        WHEN DATE_ADD(user_end_date, INTERVAL 45 DAY) > max_end_date THEN max_end_date
-        ELSE DATE_ADD(user_end_date, INTERVAL 45 DAY)
-        END AS end_period_end
-    FROM params
-    ),
+    query_job = submit_query(
+        query,
+        start_period_first=start_period[0], start_period_last=start_period[1],
+        end_period_first=end_period[0], end_period_last=end_period[1],
+        window_months=window_months,
+    )
 
-    filtered_hires AS (
-        SELECT
-            start_station_id,
-            start_date
-        FROM
-            `bigquery-public-data.london_bicycles.cycle_hire`
-        WHERE
-            start_station_id IS NOT NULL
-            AND start_station_id < 876
-    ),
+    response = download_table(query, query_job)
+    return response
 
-    usage_start_period AS (
-        SELECT
-            start_station_id,
-            ROUND(COUNT(*) / 3, 2) AS starting_period_avg
-        FROM filtered_hires fh
-        CROSS JOIN start_period sp
-        WHERE DATE(fh.start_date) BETWEEN sp.start_period_start AND sp.start_period_end
-        GROUP BY start_station_id
-    ),
+"""
+    STREAMING
+"""
 
-    usage_end_period AS (
-        SELECT
-            start_station_id,
-            ROUND(COUNT(*) / 3, 2) AS ending_period_avg
-        FROM filtered_hires fh
-        CROSS JOIN end_period ep
-        WHERE DATE(fh.start_date) BETWEEN ep.end_period_start AND ep.end_period_end
-        GROUP BY start_station_id
-    ),
+def iter_query_pages(query, **parameters):
+    """
+    Runs a query template and yields its result a page at a time, as record batches
+    """
+    query_job = submit_query(query, **parameters)
 
-    usage_comparison AS (
-        SELECT
-            COALESCE(s.start_station_id, e.start_station_id) AS station_id,
-            s.starting_period_avg,
-            e.ending_period_avg
-        FROM usage_start_period s
-        FULL OUTER JOIN usage_end_period e
-        ON s.start_station_id = e.start_station_id
-    )
+    for page in query_job.result(page_size=STREAM_PAGE_SIZE).to_arrow_iterable():
+        yield page
 
-    SELECT
-    COALESCE(s.start_station_id, e.start_station_id) AS station_id,
-    s.starting_period_avg,
-    e.ending_period_avg
-    FROM usage_start_period s
-    FULL OUTER JOIN usage_end_period e
-    ON s.start_station_id = e.start_station_id
-    ORDER BY station_id;
+def iter_station_daily_counts(start_date: str, end_date: str):
     """
+    This query returns the number of rides starting and ending at each station, for every day in the date range:
+        (day, station_id, start_rides, end_rides), ordered by day and station.
+    Rides are counted on the day they started - every ride that started from start_date's day up to (not including)
+        end_date's day, with or without an end_date. That's all the station cube knows about a ride, so every
+        backend uses the same days.
+    Only stations with rides that day are included.
+    There's a row per station per day, so it's streamed rather than cached.
+    """
+    cube = station_cube.get_cube()
+    if cube is not None:
+        yield from cube.iter_station_daily_counts(start_date, end_date)
+        return
+
+    if QUERY_BACKEND == "local":
+        yield from ride_store.iter_station_daily_counts(start_date, end_date)
+        return
+
+    query = query_template("station_daily_counts", """
+    WITH rides AS (
+    SELECT DATE(start_date) AS day, start_station_id, end_station_id
+    FROM `bigquery-public-data.london_bicycles.cycle_hire`
+    WHERE DATE(start_date) >= @first_day AND DATE(start_date) < @end_day
+    ),
+    start_counts AS (
+    SELECT day, start_station_id AS station_id, COUNT(*) AS start_rides
+    FROM rides
+    WHERE start_station_id IS NOT NULL
+    AND start_station_id < 876
+    GROUP BY day, start_station_id
+    ),
+    end_counts AS (
+    SELECT day, end_station_id AS station_id, COUNT(*) AS end_rides
+    FROM rides
+    WHERE end_station_id IS NOT NULL
+    AND end_station_id < 876
+    GROUP BY day, end_station_id
+    )
+    SELECT
+    COALESCE(sc.day, ec.day) AS day,
+    COALESCE(sc.station_id, ec.station_id) AS station_id,
+    COALESCE(sc.start_rides, 0) AS start_rides,
+    COALESCE(ec.end_rides, 0) AS end_rides
+    FROM start_counts sc
+    FULL OUTER JOIN end_counts ec
+    ON sc.day = ec.day AND sc.station_id = ec.station_id
+    ORDER BY day, station_id;
+    """, first_day="DATE", end_day="DATE")
 
-    query_job = client.query(query)
-
-    response = query_job.to_dataframe().fillna(0).to_dict(orient="records")
-    return response
+    # The DATE parameters take the day of each date, the same way the station cube does
+    yield from iter_query_pages(query, first_day=start_date, end_day=end_date)
@@ -1,7 +1,10 @@
-import json
-from pathlib import Path
 import math
-from collections import defaultdict
+import numpy as np
+from .station_registry import load_json
+from .borough_aggregation import station_arrays, rides_per_capita, usage_change, top_k
+from .arrow_results import first_value
+from .ride_store import to_timestamp
+from .instrumentation import timed
 
 """
 --------------
@@ -9,23 +12,17 @@ from collections import defaultdict
 --------------
 """
 
+# The endpoints use the shared station registry (see station_registry.py) rather than these loaders,
+#   which re-read the files every time they're called
+
 def load_station_details():
-    file_path = Path(__file__).parent / "utils/data" / "station_details.json"
-    with file_path.open("r") as file:
-        station_details = json.load(file)
-    return station_details
+    return load_json("station_details.json")
 
 def load_borough_populations():
-    file_path = Path(__file__).parent / "utils/data" / "borough_populations.json"
-    with file_path.open("r") as file:
-        borough_populations = json.load(file)
-    return borough_populations
+    return load_json("borough_populations.json")
 
 def load_station_coords():
-    file_path = Path(__file__).parent / "utils/data" / "station_coords.json"
-    with file_path.open("r") as file:
-        station_coords = json.load(file)
-    return station_coords
+    return load_json("station_coords.json")
 
 """
 --------------------
@@ -33,50 +30,19 @@ def load_station_coords():
 --------------------
 """
 
-def get_most_sustainable_borough(top_stations, station_details, borough_populations, ignoreCityOfLondon):
+@timed("aggregate.get_most_sustainable_borough")
+def get_most_sustainable_borough(top_stations, registry, ignoreCityOfLondon):
     """
-    Returns the borough with the highest number of rides per capita.
+    Returns the boroughs ordered by the number of rides per capita (highest first).
     """
+    station_ids, total_rides = station_arrays(top_stations, "total_rides")
+    boroughs, rates = rides_per_capita(registry, station_ids, total_rides)
 
-    # Map station_id to borough
-    station_id_to_borough = {
-        station["id"]: station["borough"]
-        for station in station_details
-    }
-
-    # Aggregate rides by borough
-    borough_rides = {}
-    for station in top_stations:
-        station_id = station["station_id"]
-        total_rides = station["total_rides"]
-        borough = station_id_to_borough.get(station_id)
-
-        if not borough:
-            print(f"Warning: No borough found for station ID {station_id}")
-            continue
-
-        borough_rides[borough] = borough_rides.get(borough, 0) + total_rides
-
-    # Map borough to population
-    borough_to_population = {
-        entry["borough"]: entry["population_2021"]
-        for entry in borough_populations
-    }
-
-    # Calculate rides per capita
-    rides_per_capita = {}
-    for borough, rides in borough_rides.items():
-        population = borough_to_population.get(borough)
-        if not population:
-            print(f"Warning: No population found for borough: {borough}")
-            continue
-        rides_per_capita[borough] = rides / population
-
-    sorted_array = sorted(
-        [{'borough': k, 'rate': v} for k, v in rides_per_capita.items()],
-        key=lambda x: x['rate'],
-        reverse=True
-    )
+    order = top_k(rates, len(rates), largest=True)
+    sorted_array = [
+        {'borough': registry.borough_names[boroughs[i]], 'rate': float(rates[i])}
+        for i in order
+    ]
 
     # Ignore "City of London" if it's first and should be ignored
     if ignoreCityOfLondon and sorted_array and sorted_array[0]['borough'] == 'City of London':
@@ -84,76 +50,38 @@ def get_most_sustainable_borough(top_stations, station_details, borough_populati
 
     return sorted_array
 
-def get_least_sustainable_boroughs(top_stations, station_details, borough_populations):
+@timed("aggregate.get_least_sustainable_boroughs")
+def get_least_sustainable_boroughs(top_stations, registry):
     """
     Returns the 8 least sustainable boroughs based on ride count per capita.
     
     Args:
-        top_stations (list): List of dicts with 'station_id' and 'total_rides'.
-        station_details (list): List of dicts with 'id' and 'borough'.
-        borough_populations (list): List of dicts with 'borough' and 'population_2021'.
+        top_stations (pa.Table): Table with 'station_id' and 'total_rides' columns.
+        registry (StationRegistry): The shared station and borough reference data.
     """
-
-    # Map station_id to borough
-    station_id_to_borough = {
-        station["id"]: station["borough"]
-        for station in station_details
-    }
-
-    # Aggregate total rides by borough
-    borough_rides = {}
-    for station in top_stations:
-        station_id = station["station_id"]
-        total_rides = station["total_rides"]
-        borough = station_id_to_borough.get(station_id)
-        
-        if not borough:
-            print(f"Warning: No borough found for station ID {station_id}")
-            continue
-        
-        borough_rides[borough] = borough_rides.get(borough, 0) + total_rides
-
-    # Map borough to population
-    borough_to_population = {
-        entry["borough"]: entry["population_2021"]
-        for entry in borough_populations
-    }
-
-    # Calculate rides per capita
-    rides_per_capita = {}
-    for borough, rides in borough_rides.items():
-        population = borough_to_population.get(borough)
-        if not population:
-            print(f"Warning: No population found for borough: {borough}")
-            continue
-        rides_per_capita[borough] = round(rides / population, 4)
+    station_ids, total_rides = station_arrays(top_stations, "total_rides")
+    boroughs, rates = rides_per_capita(registry, station_ids, total_rides, round_to=4)
 
     # Find the bottom 8 boroughs by rides per capita (least sustainable)
-    bottom_8 = sorted(
-        [
-            {"borough": b, "rate": rate}
-            for b, rate in rides_per_capita.items()
-            if rate > 0
-        ],
-        key=lambda x: x["rate"]
-    )[:8]
+    has_rides = rates > 0
+    boroughs, rates = boroughs[has_rides], rates[has_rides]
+    bottom_8 = top_k(rates, 8, largest=False)
 
     # Flip to show "least bad" first (like the reversed JS logic)
-    return list(reversed(bottom_8))
-
-def get_hot_spots(ordered_stations, station_details, station_coords, top_n=10):
-    # Create lookup dictionaries for fast access
-    id_to_name = {station["id"]: station["name"] for station in station_details}
-    id_to_coords = {station["id"]: (station["latitude"], station["longitude"]) for station in station_coords}
+    return [
+        {"borough": registry.borough_names[boroughs[i]], "rate": float(rates[i])}
+        for i in reversed(bottom_8)
+    ]
 
+@timed("aggregate.get_hot_spots")
+def get_hot_spots(ordered_stations, registry, top_n=10):
     # Prepare results
     top_stations_info = []
 
-    for entry in ordered_stations[:top_n]:
-        station_id = entry["station_id"]
-        total_rides = entry["total_rides"]
-        name = id_to_name.get(station_id, "Unknown")
-        lat, lon = id_to_coords.get(station_id, (None, None))
+    top_stations = ordered_stations.slice(0, top_n)
+    for station_id, total_rides in zip(top_stations.column("station_id").to_pylist(), top_stations.column("total_rides").to_pylist()):
+        name = registry.name_of(station_id) or "Unknown"
+        lat, lon = registry.coords_of(station_id)
 
         top_stations_info.append({
             "name": name,
@@ -164,14 +92,125 @@ def get_hot_spots(ordered_stations, station_details, station_coords, top_n=10):
 
     return top_stations_info
 
-def get_CO2_offset(duration_in_seconds):
-    # ASSUMPTIONS:
-    # Avg cycling speed in London = ~15 km/h (4.17 m/s)
-    # Avg emissions: 171 grams / 0.171kg CO² per km (for a car)
+def _station_info(registry, row, total_rides):
+    lat, lon = registry.coords_of(int(registry.station_ids[row]))
+    return {
+        "station_id": int(registry.station_ids[row]),
+        "name": registry.station_names[row],
+        "total_rides": int(total_rides),
+        "latitude": lat,
+        "longitude": lon
+    }
+
+def _rides_by_row(ordered_stations, registry):
+    # Ride totals indexed by registry row (0 for stations without rides in the date range)
+    station_ids, total_rides = station_arrays(ordered_stations, "total_rides")
+    rows = registry.rows(station_ids)
+    rides = np.zeros(len(registry), dtype=np.int64)
+    rides[rows[rows >= 0]] = total_rides[rows >= 0]
+    return rides
+
+@timed("aggregate.get_hot_spots_in_bbox")
+def get_hot_spots_in_bbox(ordered_stations, registry, min_lat, min_lon, max_lat, max_lon, top_n=10):
+    """
+    Returns the busiest top_n stations inside a bounding box (the map viewport), busiest first
+    """
+    rows = np.sort(registry.grid.in_bbox(min_lat, min_lon, max_lat, max_lon))
+    rides = _rides_by_row(ordered_stations, registry)[rows]
+
+    return [_station_info(registry, rows[i], rides[i]) for i in top_k(rides, top_n, largest=True)]
+
+@timed("aggregate.get_hot_spots_near")
+def get_hot_spots_near(ordered_stations, registry, lat, lon, radius_m, top_n=10):
+    """
+    Returns the busiest top_n stations within radius_m metres of a point, busiest first
+    (stations with the same number of rides are ordered nearest first)
+    """
+    rows, distances = registry.grid.within_radius(lat, lon, radius_m)
+    rides = _rides_by_row(ordered_stations, registry)[rows]
+
+    stations = []
+    for i in top_k(rides, top_n, largest=True):
+        station = _station_info(registry, rows[i], rides[i])
+        station["distance_m"] = round(float(distances[i]), 1)
+        stations.append(station)
 
-    AVG_CYCLING_SPEED = 4.17 # m/s
-    AVG_EMISSIONS = 0.171 # kg/km
+    return stations
 
+@timed("aggregate.get_top_flows")
+def get_top_flows(flow_matrix, registry, start_date, end_date, top_n=10):
+    """
+    Returns the top_n busiest station-to-station flows (see flow_matrix.py), busiest first
+    """
+    start_ids, end_ids, rides = flow_matrix.top_flows(start_date, end_date, top_n)
+    return [
+        {
+            "start_station_id": int(start_id),
+            "start_station_name": registry.name_of(int(start_id)),
+            "end_station_id": int(end_id),
+            "end_station_name": registry.name_of(int(end_id)),
+            "rides": int(count),
+        }
+        for start_id, end_id, count in zip(start_ids, end_ids, rides)
+    ]
+
+@timed("aggregate.get_borough_flows")
+def get_borough_flows(flow_matrix, registry, start_date, end_date, top_n=10):
+    """
+    Returns the top_n busiest borough-to-borough flows (including rides within a borough), busiest first
+    """
+    flows = flow_matrix.borough_flows(registry, start_date, end_date).reshape(-1)
+    num_boroughs = len(registry.borough_names)
+    return [
+        {
+            "start_borough": registry.borough_names[i // num_boroughs],
+            "end_borough": registry.borough_names[i % num_boroughs],
+            "rides": int(flows[i]),
+        }
+        for i in top_k(flows, top_n, largest=True) if flows[i] > 0
+    ]
+
+def days_of_week_in_range(start_date, end_date):
+    """
+    Returns how many Mondays, Tuesdays, ... Sundays there are from start_date up to (not including) end_date's day
+    """
+    first_day = to_timestamp(start_date).date()
+    num_days = max((to_timestamp(end_date).date() - first_day).days, 0)
+    return np.bincount((first_day.weekday() + np.arange(num_days)) % 7, minlength=7)
+
+@timed("aggregate.get_demand_profile")
+def get_demand_profile(profile_tensor, registry, start_date, end_date, station_id=None, borough=None):
+    """
+    Returns the departures and arrivals by day of the week (Monday first) and hour of the day (see profile_tensor.py)
+        for one station, one borough, or every station - with the number of each day of the week in the range,
+        so the frontend can turn the counts into averages
+    Returns None if the station or borough isn't known
+    """
+    if borough is not None:
+        code = registry.borough_code.get(borough)
+        if code is None:
+            return None
+        profiles = profile_tensor.borough_profiles(registry, start_date, end_date)[:, code]
+    elif station_id is not None:
+        if registry.row(station_id) < 0:
+            return None
+        profiles = profile_tensor.station_profiles(start_date, end_date)[:, station_id]
+    else:
+        profiles = profile_tensor.station_profiles(start_date, end_date).sum(axis=1)
+
+    return {
+        "departures": profiles[0].tolist(),
+        "arrivals": profiles[1].tolist(),
+        "days_of_week": days_of_week_in_range(start_date, end_date).tolist(),
+    }
+
+# ASSUMPTIONS:
+# Avg cycling speed in London = ~15 km/h (4.17 m/s)
+# Avg emissions: 171 grams / 0.171kg CO² per km (for a car)
+AVG_CYCLING_SPEED = 4.17 # m/s
+AVG_EMISSIONS = 0.171 # kg/km
+
+def get_CO2_offset(duration_in_seconds):
     # S = D / T → D = S * T
     estimated_distance_m = AVG_CYCLING_SPEED * duration_in_seconds # meters
     estimated_distance_km = int(estimated_distance_m / 1000) # kilometers 
@@ -181,6 +220,31 @@ def get_CO2_offset(duration_in_seconds):
 
     return (data)
 
+@timed("aggregate.get_ride_metrics")
+def get_ride_metrics(trip_totals):
+    """
+    Returns the trip totals (see server.get_trip_totals) with the CO2 offset estimated two ways:
+        - from the summed duration, at the average cycling speed (what the CO2 offset panel shows)
+        - from the summed straight-line distance between stations (a lower bound - round trips count as 0 km)
+    """
+    trips = first_value(trip_totals, "trips")
+    duration_in_seconds = first_value(trip_totals, "duration")
+    straight_line_distance_km = int(first_value(trip_totals, "distance") / 1000)
+
+    co2_amount, estimated_distance_km = get_CO2_offset(duration_in_seconds)
+    straight_line_co2_amount = int(straight_line_distance_km * AVG_EMISSIONS) # kg
+
+    return {
+        "trips": trips,
+        "duration_hours": round(duration_in_seconds / 3600, 1),
+        "average_duration_minutes": round(duration_in_seconds / 60 / trips, 1) if trips else None,
+        "estimated_distance_km": estimated_distance_km,
+        "straight_line_distance_km": straight_line_distance_km,
+        "CO2_offset_kg": co2_amount,
+        "straight_line_CO2_offset_kg": straight_line_co2_amount,
+        "tree_equivalent": calculate_tree_equivalent(co2_amount),
+    }
+
 def calculate_tree_equivalent(co2_amount):
     # ASSUMPTIONS
     # Avg CO² absorption rate for 1 tree = 21 kg / year
@@ -189,39 +253,28 @@ def calculate_tree_equivalent(co2_amount):
 
     return math.floor(tree_equivalent)
 
-def get_boroughs_by_biggest_change(station_details, usage_data):
-    # Create a mapping of station_id to borough
-    station_id_to_borough = {station["id"]: station["borough"] for station in station_details}
-
-    # Aggregate usage per borough
-    borough_usage = defaultdict(lambda: {"starting_avg": 0, "ending_avg": 0, "count": 0})
+@timed("aggregate.get_boroughs_by_biggest_change")
+def get_boroughs_by_biggest_change(registry, usage_data):
+    """
+    Returns the 8 boroughs with the biggest change (either way) in monthly average usage
+    """
+    station_ids, starting_avgs, ending_avgs = station_arrays(usage_data, "starting_period_avg", "ending_period_avg")
+    boroughs, starting, ending, pct_changes = usage_change(registry, station_ids, starting_avgs, ending_avgs)
 
-    for record in usage_data:
-        station_id = record["station_id"]
-        if station_id in station_id_to_borough:
-            borough = station_id_to_borough[station_id]
-            borough_usage[borough]["starting_avg"] += record["starting_period_avg"]
-            borough_usage[borough]["ending_avg"] += record["ending_period_avg"]
-            borough_usage[borough]["count"] += 1
+    # Sort by absolute percentage change descending
+    biggest_8 = top_k(np.abs(np.round(pct_changes, 2)), 8, largest=True)
 
     # Create the list with actual and displayed percentage change
     borough_changes = []
-    for borough, data in borough_usage.items():
-        start = max(data["starting_avg"], 1)  # Avoid division by zero
-        end = max(data["ending_avg"], 1)
-
-        pct_change = round(((end - start) / start) * 100, 2)
+    for i in biggest_8:
+        pct_change = round(float(pct_changes[i]), 2)
 
         borough_changes.append({
-            "borough": borough,
-            "starting_avg": round(data["starting_avg"], 2),
-            "ending_avg": round(data["ending_avg"], 2),
+            "borough": registry.borough_names[boroughs[i]],
+            "starting_avg": round(float(starting[i]), 2),
+            "ending_avg": round(float(ending[i]), 2),
             "actual_pct_change": pct_change,
             "pct_change": 100 if abs(pct_change) > 100 else pct_change
         })
 
-    # Sort by absolute percentage change descending
-    borough_changes.sort(key=lambda x: abs(x["actual_pct_change"]), reverse=True)
-
-    return borough_changes[:8]
-
+    return borough_changes
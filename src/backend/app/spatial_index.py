@@ -0,0 +1,110 @@
+import math
+import numpy as np
+
+"""
+    This file contains the spatial index over the station coordinates, used by the map view's
+        "busiest stations in this viewport" and "stations near this point" queries.
+    The stations are bucketed into a uniform grid of square cells (GRID_CELL_SIZE metres across), using an
+        equirectangular projection around the centre of the stations - accurate to well under a metre at
+        the scale of London. The rows are sorted by cell, with an offset array per cell (like a CSR matrix),
+        so a query only looks at the stations in the cells it overlaps instead of scanning every station.
+    The grid is built once per station registry (see station_registry.py), so it's ready at startup.
+"""
+
+EARTH_RADIUS_M = 6_371_000
+GRID_CELL_SIZE = 250 # metres
+
+def haversine_m(latitude, longitude, latitudes, longitudes):
+    """
+    Great-circle distance in metres from one point (or array of points) to an array of points
+    """
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+class StationGrid:
+    def __init__(self, latitudes, longitudes, cell_size=GRID_CELL_SIZE):
+        """
+        latitudes, longitudes: coordinates of every registry row (NaN where unknown - those rows are left out)
+        """
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.cell_size = cell_size
+
+        known = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        rows = np.flatnonzero(known)
+
+        # Projection: metres east/north of the south-west corner of the stations
+        self.origin_latitude = float(latitudes[known].min()) if len(rows) else 0.0
+        self.origin_longitude = float(longitudes[known].min()) if len(rows) else 0.0
+        centre_latitude = float(np.mean(latitudes[known])) if len(rows) else 0.0
+        self.metres_per_degree_lat = math.pi * EARTH_RADIUS_M / 180
+        self.metres_per_degree_lon = self.metres_per_degree_lat * math.cos(math.radians(centre_latitude))
+
+        columns, cell_rows = self.cell_of(latitudes[rows], longitudes[rows])
+        self.num_columns = int(columns.max()) + 1 if len(rows) else 1
+        self.num_rows = int(cell_rows.max()) + 1 if len(rows) else 1
+
+        # Station rows sorted by cell, and the offset of each cell's first station
+        cells = cell_rows * self.num_columns + columns
+        order = np.argsort(cells, kind="stable")
+        self.rows = rows[order]
+        self.cell_starts = np.searchsorted(cells[order], np.arange(self.num_columns * self.num_rows + 1))
+
+    def cell_of(self, latitudes, longitudes):
+        """
+        Returns the (column, row) grid cell of each point
+        """
+        x = (np.asarray(longitudes) - self.origin_longitude) * self.metres_per_degree_lon
+        y = (np.asarray(latitudes) - self.origin_latitude) * self.metres_per_degree_lat
+        return np.floor(x / self.cell_size).astype(np.int64), np.floor(y / self.cell_size).astype(np.int64)
+
+    def _rows_in_cells(self, min_latitude, min_longitude, max_latitude, max_longitude):
+        """
+        Returns the registry rows of every station in the cells overlapping a bounding box
+        (a superset of the stations inside it)
+        """
+        (first_column, last_column), (first_row, last_row) = self.cell_of(
+            [min_latitude, max_latitude], [min_longitude, max_longitude]
+        )
+        first_column, first_row = max(first_column, 0), max(first_row, 0)
+        last_column, last_row = min(last_column, self.num_columns - 1), min(last_row, self.num_rows - 1)
+        if first_column > last_column or first_row > last_row:
+            return np.empty(0, dtype=np.int64)
+
+        # Each row of cells is one contiguous run of the sorted stations
+        runs = [
+            self.rows[self.cell_starts[row * self.num_columns + first_column]:self.cell_starts[row * self.num_columns + last_column + 1]]
+            for row in range(first_row, last_row + 1)
+        ]
+        return np.concatenate(runs)
+
+    def in_bbox(self, min_latitude, min_longitude, max_latitude, max_longitude):
+        """
+        Returns the registry rows of the stations inside a bounding box (edges included)
+        """
+        candidates = self._rows_in_cells(min_latitude, min_longitude, max_latitude, max_longitude)
+        latitudes = self.latitudes[candidates]
+        longitudes = self.longitudes[candidates]
+        inside = (latitudes >= min_latitude) & (latitudes <= max_latitude) & \
+            (longitudes >= min_longitude) & (longitudes <= max_longitude)
+        return candidates[inside]
+
+    def within_radius(self, latitude, longitude, radius_m):
+        """
+        Returns (registry rows, distances in metres) of the stations within radius_m of a point, nearest first
+        """
+        # The box around the circle, then the exact distance for the stations in it
+        delta_latitude = radius_m / self.metres_per_degree_lat
+        delta_longitude = radius_m / (self.metres_per_degree_lat * max(math.cos(math.radians(latitude)), 1e-6))
+        candidates = self._rows_in_cells(
+            latitude - delta_latitude, longitude - delta_longitude, latitude + delta_latitude, longitude + delta_longitude
+        )
+
+        distances = haversine_m(latitude, longitude, self.latitudes[candidates], self.longitudes[candidates])
+        inside = distances <= radius_m
+        candidates, distances = candidates[inside], distances[inside]
+
+        order = np.argsort(distances, kind="stable")
+        return candidates[order], distances[order]
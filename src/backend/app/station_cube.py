@@ -0,0 +1,456 @@
+from datetime import date, timedelta, timezone
+from pathlib import Path
+import os
+import sys
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+from . import ride_store
+from .ride_store import MAX_STATION_ID, RIDE_SCHEMA
+from .ride_metrics import trip_distances, trip_totals_table
+from .usage_windows import DEFAULT_WINDOW_MONTHS, usage_periods, usage_change_table
+from .instrumentation import timed
+
+"""
+    This file contains the station cube - daily ride counts for every station, precomputed from the ride store
+        or straight from BigQuery.
+    Each measure is held as a NumPy array shaped (days x stations), where the row is the day the ride started
+        and the column is the station id. The arrays are stored as cumulative sums over the days,
+        with an extra row of zeros at the top, so the totals for any date range are just:
+            prefix[end_row] - prefix[start_row]
+    That turns get_ordered_stations, get_cycling_duration and both periods of the change in usage query
+        into two row lookups and a subtraction each, no matter how long the date range is.
+    Measures:
+        - start_counts:   rides starting at the station
+        - end_counts:     rides ending at the station (on the day the ride started)
+        - trip_counts:    rides starting at the station that also end at a known station
+        - duration_sums:  total duration (seconds) of those trips
+        - distance_sums:  total straight-line distance (metres) between the start and end stations of those trips
+                          (see ride_metrics.py)
+    The cube is saved as a single uncompressed Arrow IPC file holding just the prefix sums (a day's totals are the
+        difference of two neighbouring rows), and loaded with a memory map - loading costs an mmap call rather
+        than a decompress, and every uvicorn worker reads the same page-cache pages instead of holding its own copy.
+    The cube also keeps the earliest start_date and latest end_date it has seen. The latest end_date is the
+        watermark - a refresh only pulls the rides that started from REFRESH_OVERLAP_DAYS before the watermark's
+        day onwards from BigQuery, aggregated per day and station, and replaces those days of the cube with them,
+        so it costs time proportional to the new data. The overlap picks up rides that landed in the table after
+        the last refresh, and rides without an end_date are counted the same way as when the cube is built.
+    A refresh only updates the cube - the ride store, the flow matrix and the profile tensor are rebuilt separately
+        (python -m backend.app.ride_store, then backend.app.flow_matrix and backend.app.profile_tensor), so until
+        they are, the endpoints served from them don't have the new rides.
+    The API picks up a new cube file on the next query (see get_cube()) and clears the query caches, so results
+        from the old cube (including get_min_date / get_max_date) aren't served until they expire.
+    A cube without every measure (saved before one was added) isn't used - the queries fall back to QUERY_BACKEND
+        until it's rebuilt.
+    From /src:
+        python -m backend.app.station_cube            builds the cube from the local ride store
+        python -m backend.app.station_cube refresh    folds in new rides from BigQuery (or builds it, if there's no cube yet)
+"""
+
+STATION_CUBE_PATH = Path(os.getenv("STATION_CUBE_PATH", Path(__file__).parent / "utils/data" / "station_cube.arrow"))
+
+MEASURES = ["start_counts", "end_counts", "trip_counts", "duration_sums", "distance_sums"]
+
+# Days before the watermark's day that a refresh pulls again (see refresh_cube())
+REFRESH_OVERLAP_DAYS = int(os.getenv("REFRESH_OVERLAP_DAYS", 1))
+
+class StationCube:
+    def __init__(self, first_day, prefix, min_date, max_date):
+        """
+        first_day: the date of row 0
+        prefix: dict of measure name -> ((days + 1) x stations) array of cumulative daily totals, starting with a row of zeros
+            (may be read-only, e.g. memory-mapped)
+        min_date, max_date: earliest start_date and latest end_date folded into the cube (max_date is the watermark)
+        """
+        self.first_day = first_day
+        self.prefix = prefix
+        self.num_days = len(prefix["start_counts"]) - 1
+        self.min_date = min_date
+        self.max_date = max_date
+
+    @classmethod
+    def from_daily(cls, first_day, daily, min_date, max_date):
+        """
+        Builds the cube from daily totals (measure -> (days x stations) array)
+        """
+        prefix = {}
+        for measure, values in daily.items():
+            prefix[measure] = np.zeros((len(values) + 1, MAX_STATION_ID), dtype=np.int64)
+            np.cumsum(values, axis=0, out=prefix[measure][1:])
+        return cls(first_day, prefix, min_date, max_date)
+
+    def day_row(self, value):
+        """
+        Converts a date string into a prefix row, clamped to the days held in the cube
+        """
+        day = ride_store.to_timestamp(value).date()
+        return min(max((day - self.first_day).days, 0), self.num_days)
+
+    def daily(self, measure, start_row, end_row):
+        """
+        Returns the daily totals of a measure for the rows start_row up to (not including) end_row
+        """
+        return np.diff(self.prefix[measure][start_row:end_row + 1], axis=0)
+
+    def window(self, measure, start_date, end_date):
+        """
+        Returns the per-station totals of a measure for rides starting on or after start_date, and before end_date
+        (the day-level equivalent of: start_date > "{start_date}" AND end_date < "{end_date}")
+        """
+        prefix = self.prefix[measure]
+        start_row = self.day_row(start_date)
+        end_row = max(self.day_row(end_date), start_row)
+        return prefix[end_row] - prefix[start_row]
+
+    def period_totals(self, measure, period):
+        """
+        Returns the per-station totals of a measure over an inclusive (first day, last day) period
+        """
+        prefix = self.prefix[measure]
+        start_row = min(max((period[0] - self.first_day).days, 0), self.num_days)
+        end_row = min(max((period[1] - self.first_day).days + 1, start_row), self.num_days)
+        return prefix[end_row] - prefix[start_row]
+
+    @property
+    def last_day(self):
+        return self.first_day + timedelta(days=self.num_days - 1)
+
+    def fold_in(self, first_day, updates, min_date, max_date, replace=False):
+        """
+        Adds daily totals (updates: measure -> (days x stations), with row 0 = first_day) into the cube.
+        With replace=True, every day from first_day to the end of the cube is replaced by the updates instead
+            (days the updates don't cover become zero).
+        Only the prefix rows from the first updated day onwards are changed.
+        Returns the updated cube (the prefix arrays are copied first, so a memory-mapped cube isn't written to).
+        """
+        padding = max((self.first_day - first_day).days, 0)
+        cube_first_day = self.first_day - timedelta(days=padding)
+        offset = (first_day - cube_first_day).days
+        num_update_days = len(updates["start_counts"])
+        num_days = max(self.num_days + padding, offset + num_update_days)
+
+        prefix = {}
+        for measure in MEASURES:
+            old_prefix = self.prefix[measure]
+            # New days before the start of the cube (not expected, since the table only grows at the tail) are rows of zeros
+            #   at the top, and new days after the end repeat the last cumulative total
+            new_prefix = np.empty((num_days + 1, MAX_STATION_ID), dtype=np.int64)
+            new_prefix[:padding] = 0
+            new_prefix[padding:padding + len(old_prefix)] = old_prefix
+            new_prefix[padding + len(old_prefix):] = old_prefix[-1]
+            if replace:
+                new_prefix[offset + 1:] = new_prefix[offset]
+
+            cumulative = np.cumsum(updates[measure], axis=0)
+            new_prefix[offset + 1:offset + 1 + num_update_days] += cumulative
+            new_prefix[offset + 1 + num_update_days:] += cumulative[-1]
+            prefix[measure] = new_prefix
+
+        return StationCube(cube_first_day, prefix, min(self.min_date, min_date), max(self.max_date, max_date))
+
+    """
+        QUERIES
+    """
+
+    def get_min_date(self):
+        return pa.table({"min_date": pa.array([self.min_date], RIDE_SCHEMA.field("start_date").type)})
+
+    def get_max_date(self):
+        return pa.table({"max_date": pa.array([self.max_date], RIDE_SCHEMA.field("end_date").type)})
+
+    def get_ordered_stations(self, start_date: str, end_date: str):
+        total_rides = self.window("start_counts", start_date, end_date) + self.window("end_counts", start_date, end_date)
+        return ride_store.ordered_stations_table(total_rides)
+
+    def get_cycling_duration(self, start_date: str, end_date: str):
+        return pa.table({"duration": [int(self.window("duration_sums", start_date, end_date).sum())]})
+
+    def get_trip_totals(self, start_date: str, end_date: str):
+        return trip_totals_table({
+            measure: self.window(measure, start_date, end_date)
+            for measure in ("trip_counts", "duration_sums", "distance_sums")
+        })
+
+    def get_number_of_trips(self, start_date: str, end_date: str):
+        return pa.table({"f0_": [int(self.window("trip_counts", start_date, end_date).sum())]})
+
+    def get_change_in_monthly_average_use_foreach_station(self, start_date: str, end_date: str, window_months=DEFAULT_WINDOW_MONTHS):
+        # Both period averages are two prefix row differences, for all stations at once
+        start_period, end_period = usage_periods(
+            ride_store.to_timestamp(start_date).date(),
+            ride_store.to_timestamp(end_date).date(),
+            self.min_date.date(),
+            self.max_date.date(),
+            window_months,
+        )
+        starting_counts = self.period_totals("start_counts", start_period)
+        ending_counts = self.period_totals("start_counts", end_period)
+        return usage_change_table(starting_counts, ending_counts, window_months)
+
+    def iter_station_daily_counts(self, start_date: str, end_date: str, days_per_batch=31):
+        """
+        Yields the per-day breakdown of the date range as record batches of
+            (day, station_id, start_rides, end_rides), one row per station with rides that day.
+        Each batch covers up to days_per_batch days, so only that slice of the cube is ever copied.
+        """
+        start_row = self.day_row(start_date)
+        end_row = max(self.day_row(end_date), start_row)
+
+        for batch_start in range(start_row, end_row, days_per_batch):
+            batch_end = min(batch_start + days_per_batch, end_row)
+            start_counts = self.daily("start_counts", batch_start, batch_end)
+            end_counts = self.daily("end_counts", batch_start, batch_end)
+
+            day_offsets, stations = np.nonzero(start_counts + end_counts)
+            days = np.datetime64(self.first_day, "D") + batch_start + day_offsets
+            yield pa.record_batch({
+                "day": pa.array(days, pa.date32()),
+                "station_id": pa.array(stations, pa.int64()),
+                "start_rides": pa.array(start_counts[day_offsets, stations], pa.int64()),
+                "end_rides": pa.array(end_counts[day_offsets, stations], pa.int64()),
+            })
+
+    def save(self, path=STATION_CUBE_PATH):
+        """
+        Writes the cube to a temporary file and swaps it in, so the API never loads a half-written cube
+        Each measure's prefix array is one flat int64 column, and the dates go in the schema metadata
+        """
+        path = Path(path)
+        temporary_path = path.with_name(path.name + ".tmp")
+        table = pa.table(
+            {measure: pa.array(self.prefix[measure].reshape(-1)) for measure in MEASURES},
+            metadata={
+                "first_day": self.first_day.isoformat(),
+                "min_date": self.min_date.astimezone(timezone.utc).isoformat(),
+                "max_date": self.max_date.astimezone(timezone.utc).isoformat(),
+            },
+        )
+        with ipc.new_file(str(temporary_path), table.schema) as writer:
+            writer.write_table(table)
+        os.replace(temporary_path, path)
+
+"""
+--------------
+    LOADING
+--------------
+"""
+
+_cube = None
+_cube_mtime = None
+_cube_lock = threading.Lock()
+
+@timed("load.station_cube")
+def load_cube(path=STATION_CUBE_PATH):
+    """
+    Memory-maps the cube - the prefix arrays are read-only views of the file
+    """
+    with pa.memory_map(str(path), "r") as source:
+        table = ipc.open_file(source).read_all()
+
+    # A cube saved before a measure was added can't answer the queries that use it
+    missing = [measure for measure in MEASURES if measure not in table.column_names]
+    if missing:
+        raise ValueError(f"The station cube {path} has no {', '.join(missing)} - rebuild it with: python -m backend.app.station_cube")
+
+    metadata = {key.decode(): value.decode() for key, value in table.schema.metadata.items()}
+    prefix = {measure: table.column(measure).chunk(0).to_numpy().reshape(-1, MAX_STATION_ID) for measure in MEASURES}
+    return StationCube(
+        date.fromisoformat(metadata["first_day"]),
+        prefix,
+        ride_store.to_timestamp(metadata["min_date"]),
+        ride_store.to_timestamp(metadata["max_date"]),
+    )
+
+def get_cube():
+    """
+    Returns the station cube, loading it the first time it's needed (or when the file on disk has changed)
+    Returns None if the cube hasn't been built, or can't be used, so callers can fall back to the query backend
+    When a changed cube is loaded, the query caches are cleared, since their results came from the old one
+    """
+    global _cube, _cube_mtime
+
+    if not STATION_CUBE_PATH.exists():
+        if _cube is not None:
+            _cube, _cube_mtime = None, None
+            clear_caches()
+        return None
+
+    mtime = STATION_CUBE_PATH.stat().st_mtime
+    if mtime != _cube_mtime:
+        with _cube_lock:
+            if mtime != _cube_mtime:
+                try:
+                    cube = load_cube(STATION_CUBE_PATH)
+                except (ValueError, OSError, pa.ArrowException) as error:
+                    print(f"Warning: Not using the station cube, the queries are answered from QUERY_BACKEND until it's rebuilt: {error}")
+                    cube = None
+                reloaded = _cube_mtime is not None
+                _cube, _cube_mtime = cube, mtime
+                if reloaded:
+                    clear_caches()
+
+    return _cube
+
+def clear_caches():
+    # Imported here - query_cache.py imports this module
+    from .query_cache import clear_query_caches
+    clear_query_caches()
+
+"""
+--------------
+    BUILD
+--------------
+"""
+
+def daily_station_totals(day_rows, station_ids, num_days, weights=None):
+    """
+    Group-by (day, station) in one pass with np.bincount - returns a (days x stations) array
+    """
+    cells = day_rows.astype(np.int64) * MAX_STATION_ID + station_ids
+    totals = np.bincount(cells, weights=weights, minlength=num_days * MAX_STATION_ID)
+    return np.rint(totals).reshape(num_days, MAX_STATION_ID).astype(np.int64)
+
+def daily_measures(day_rows, start_ids, end_ids, rides, trips, duration_sums, num_days):
+    """
+    Aggregates rows of (day, start station, end station) -> (rides, trips, duration) into the daily cube measures
+    Missing station ids should be passed as -1
+    """
+    valid_start = (start_ids >= 0) & (start_ids < MAX_STATION_ID)
+    valid_end = (end_ids >= 0) & (end_ids < MAX_STATION_ID)
+    valid_trip = valid_start & valid_end
+    distance_sums = trip_distances(start_ids[valid_trip], end_ids[valid_trip]) * trips[valid_trip]
+
+    return {
+        "start_counts": daily_station_totals(day_rows[valid_start], start_ids[valid_start], num_days, weights=rides[valid_start]),
+        "end_counts": daily_station_totals(day_rows[valid_end], end_ids[valid_end], num_days, weights=rides[valid_end]),
+        "trip_counts": daily_station_totals(day_rows[valid_trip], start_ids[valid_trip], num_days, weights=trips[valid_trip]),
+        "duration_sums": daily_station_totals(day_rows[valid_trip], start_ids[valid_trip], num_days, weights=duration_sums[valid_trip]),
+        "distance_sums": daily_station_totals(day_rows[valid_trip], start_ids[valid_trip], num_days, weights=distance_sums),
+    }
+
+def day_numbers(timestamps):
+    # Days since 1970-01-01 of a timestamp (or date) column
+    return pc.cast(timestamps, pa.date32()).to_numpy(zero_copy_only=False).astype("datetime64[D]").astype(np.int64)
+
+def station_ids(column):
+    # Nulls are filled with -1 so they fail the station checks
+    return pc.fill_null(column, -1).to_numpy().astype(np.int64)
+
+def build_cube():
+    """
+    Builds the cube from the local ride store, one record batch at a time
+    """
+    min_date = ride_store.column_stat("start_date", "min")
+    max_date = ride_store.column_stat("end_date", "max")
+    first_day = min_date.date()
+    last_day = ride_store.column_stat("start_date", "max").date()
+    num_days = (last_day - first_day).days + 1
+
+    daily = {measure: np.zeros((num_days, MAX_STATION_ID), dtype=np.int64) for measure in MEASURES}
+    epoch_day = (first_day - date(1970, 1, 1)).days
+
+    columns = ["start_date", "duration", "start_station_id", "end_station_id"]
+    for batch in ride_store.open_dataset().to_batches(columns=columns):
+        durations = pc.fill_null(batch.column("duration"), -1).to_numpy()
+        has_duration = durations >= 0
+
+        batch_measures = daily_measures(
+            day_numbers(batch.column("start_date")) - epoch_day,
+            station_ids(batch.column("start_station_id")),
+            station_ids(batch.column("end_station_id")),
+            rides=np.ones(len(batch)),
+            trips=has_duration.astype(np.float64),
+            duration_sums=np.where(has_duration, durations, 0).astype(np.float64),
+            num_days=num_days,
+        )
+        for measure in MEASURES:
+            daily[measure] += batch_measures[measure]
+
+    return StationCube.from_daily(first_day, daily, min_date, max_date)
+
+def refresh_cube(client, cube=None):
+    """
+    Pulls the rides that started from REFRESH_OVERLAP_DAYS before the cube's watermark day onwards from BigQuery -
+        already aggregated per day and station pair - and replaces those days of the cube with them.
+    Every ride is counted on the day it started, with or without an end_date, like build_cube().
+    With no cube, the whole table is pulled (aggregated the same way), which builds it from scratch.
+    Returns the refreshed cube, or the same cube if there was nothing to pull.
+    """
+    from google.cloud import bigquery
+
+    query = """
+    SELECT
+        DATE(start_date) AS day,
+        start_station_id,
+        end_station_id,
+        COUNT(*) AS rides,
+        COUNTIF(duration >= 0) AS trips,
+        IFNULL(SUM(IF(duration >= 0, duration, 0)), 0) AS duration_sum,
+        MIN(start_date) AS min_date,
+        MAX(end_date) AS max_date
+    FROM `bigquery-public-data.london_bicycles.cycle_hire`
+    WHERE start_date IS NOT NULL
+    AND (@replace_from IS NULL OR DATE(start_date) >= @replace_from)
+    GROUP BY day, start_station_id, end_station_id
+    """
+    replace_from = cube.max_date.date() - timedelta(days=REFRESH_OVERLAP_DAYS) if cube is not None else None
+    if replace_from is not None:
+        # Never leaves a gap between the cube and the replaced days
+        replace_from = min(replace_from, cube.last_day + timedelta(days=1))
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("replace_from", "DATE", replace_from),
+    ])
+    rows = client.query(query, job_config=job_config).to_arrow()
+
+    if rows.num_rows == 0:
+        return cube
+
+    days = day_numbers(rows.column("day"))
+    if cube is None:
+        first_day = date(1970, 1, 1) + timedelta(days=int(days.min()))
+        last_day = date(1970, 1, 1) + timedelta(days=int(days.max()))
+    else:
+        # The updates cover every day that's replaced, up to the end of the cube
+        first_day = replace_from
+        last_day = max(date(1970, 1, 1) + timedelta(days=int(days.max())), cube.last_day)
+    first_epoch_day = (first_day - date(1970, 1, 1)).days
+    num_days = (last_day - first_day).days + 1
+
+    updates = daily_measures(
+        days - first_epoch_day,
+        station_ids(rows.column("start_station_id")),
+        station_ids(rows.column("end_station_id")),
+        rides=rows.column("rides").to_numpy().astype(np.float64),
+        trips=rows.column("trips").to_numpy().astype(np.float64),
+        duration_sums=rows.column("duration_sum").to_numpy().astype(np.float64),
+        num_days=num_days,
+    )
+    min_date = ride_store.to_timestamp(pc.min(rows.column("min_date")).as_py())
+    max_date = pc.max(rows.column("max_date")).as_py()
+    # NULL if every pulled ride is still without an end_date - fold_in() keeps the cube's watermark then
+    max_date = ride_store.to_timestamp(max_date) if max_date is not None else min_date
+
+    if cube is None:
+        return StationCube.from_daily(first_day, updates, min_date, max_date)
+    return cube.fold_in(first_day, updates, min_date, max_date, replace=True)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["refresh"]:
+        from google.cloud import bigquery
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        previous = load_cube() if STATION_CUBE_PATH.exists() else None
+        cube = refresh_cube(bigquery.Client(), previous)
+        if cube is None or cube is previous:
+            print(f"✅ No rides to pull since {previous.max_date if previous is not None else None}")
+            sys.exit(0)
+    else:
+        cube = build_cube()
+
+    cube.save()
+    print(f"✅ Station cube saved to {STATION_CUBE_PATH}: {cube.num_days} days x {MAX_STATION_ID} stations, up to {cube.max_date}")
+    if sys.argv[1:] == ["refresh"]:
+        print("The ride store, flow matrix and profile tensor aren't refreshed - rebuild them to add the new rides to /db/flows, /db/profile and QUERY_BACKEND=local")
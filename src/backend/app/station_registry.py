@@ -0,0 +1,251 @@
+from pathlib import Path
+import json
+import os
+import threading
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from .spatial_index import StationGrid
+from .instrumentation import span, timed
+
+"""
+    This file contains the station registry - the station and borough reference data from utils/data,
+        loaded once and held as arrays, so the services don't re-read and re-index the JSON files on every request.
+    Stations are stored as columns (id, name, latitude, longitude, borough code), one row per station,
+        with a dense index from station id to row, and a spatial grid over the coordinates (see spatial_index.py).
+    Boroughs are numbered (borough codes), with a population vector indexed by the same code.
+    The registry is loaded from the binary station table (stations.arrow and boroughs.arrow, Arrow IPC files
+        written by reference_build.py) when it's up to date, and from the JSON files otherwise.
+    If the station -> borough code table has been built from the borough boundaries (see borough_assignment.py),
+        the station boroughs come from it, and the borough names in station_details.json are only a fallback.
+    The registry is immutable - when one of the files changes on disk, a new registry is built and swapped in.
+"""
+
+DATA_PATH = Path(__file__).parent / "utils/data"
+REFERENCE_FILES = ["station_details.json", "station_coords.json", "borough_populations.json"]
+
+# The binary station table, written by reference_build.py
+STATION_TABLE_PATH = Path(os.getenv("STATION_TABLE_PATH", DATA_PATH / "stations.arrow"))
+BOROUGH_TABLE_PATH = Path(os.getenv("BOROUGH_TABLE_PATH", DATA_PATH / "boroughs.arrow"))
+
+# How often (seconds) get_station_registry() checks the files for changes
+RELOAD_CHECK_INTERVAL = 5
+
+def load_json(file_name):
+    file_path = DATA_PATH / file_name
+    with span(f"load.{file_name}"), file_path.open("r") as file:
+        return json.load(file)
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+class StationRegistry:
+    def __init__(self, station_ids, station_names, latitudes, longitudes, station_boroughs, borough_names, borough_populations):
+        """
+        Station columns (one row per station, sorted by id) and borough columns (one row per borough code)
+        Use from_json() or from_tables() to build one from the reference files
+        """
+        self.borough_names = tuple(borough_names)
+        self.borough_code = {borough: code for code, borough in enumerate(self.borough_names)}
+        self.borough_populations = _read_only(np.asarray(borough_populations, dtype=np.float64))
+
+        self.station_ids = _read_only(np.asarray(station_ids, dtype=np.int64))
+        self.station_names = _read_only(np.asarray(station_names, dtype=object))
+        self.station_boroughs = _read_only(np.asarray(station_boroughs, dtype=np.int64))
+        self.latitudes = _read_only(np.asarray(latitudes, dtype=np.float64))
+        self.longitudes = _read_only(np.asarray(longitudes, dtype=np.float64))
+
+        # Dense index: station id -> row (-1 for unknown ids)
+        station_index = np.full(int(self.station_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+        station_index[self.station_ids] = np.arange(len(self.station_ids))
+        self.station_index = _read_only(station_index)
+
+        # Station id -> borough code, indexed directly by station id (-1 for unknown ids)
+        self.borough_by_station_id = _read_only(np.where(station_index >= 0, self.station_boroughs[station_index], -1))
+
+        # Spatial index for the bounding box and radius queries
+        self.grid = StationGrid(self.latitudes, self.longitudes)
+
+    @classmethod
+    def from_json(cls, station_details, station_coords, borough_populations, station_boroughs=None):
+        """
+        Builds the registry from the contents of the JSON reference files
+        station_boroughs: optional (borough names, borough code of every station id) table from borough_assignment.py
+        """
+        station_details = [station for station in station_details if station["id"] is not None]
+        station_details.sort(key=lambda station: station["id"])
+        coords_by_id = {station["id"]: station for station in station_coords}
+
+        if station_boroughs is not None:
+            table_names, table_codes = station_boroughs
+            for index, station in enumerate(station_details):
+                station_id = station["id"]
+                if 0 <= station_id < len(table_codes) and table_codes[station_id] >= 0:
+                    station_details[index] = {**station, "borough": table_names[table_codes[station_id]]}
+
+        # Boroughs
+        borough_names = sorted(
+            {station["borough"] for station in station_details if station["borough"]} |
+            {entry["borough"] for entry in borough_populations}
+        )
+        borough_code = {borough: code for code, borough in enumerate(borough_names)}
+        populations = np.full(len(borough_names), np.nan)
+        for entry in borough_populations:
+            populations[borough_code[entry["borough"]]] = entry["population_2021"]
+
+        # Stations
+        return cls(
+            [station["id"] for station in station_details],
+            [station["name"] for station in station_details],
+            [coords_by_id.get(station["id"], {}).get("latitude", np.nan) for station in station_details],
+            [coords_by_id.get(station["id"], {}).get("longitude", np.nan) for station in station_details],
+            [borough_code.get(station["borough"], -1) for station in station_details],
+            borough_names,
+            populations,
+        )
+
+    @classmethod
+    def from_tables(cls, stations, boroughs):
+        """
+        Builds the registry from the binary station and borough tables (see to_tables())
+        """
+        return cls(
+            stations.column("id").to_numpy(),
+            stations.column("name").to_numpy(zero_copy_only=False),
+            stations.column("latitude").to_numpy(),
+            stations.column("longitude").to_numpy(),
+            stations.column("borough_code").to_numpy(),
+            boroughs.column("name").to_pylist(),
+            boroughs.column("population").to_numpy(),
+        )
+
+    def to_tables(self):
+        """
+        Returns the registry as (stations, boroughs) pyarrow Tables - missing values are NaN / -1, not null
+        """
+        stations = pa.table({
+            "id": pa.array(self.station_ids, pa.int64()),
+            "name": pa.array(self.station_names.tolist(), pa.string()),
+            "latitude": pa.array(self.latitudes, pa.float64()),
+            "longitude": pa.array(self.longitudes, pa.float64()),
+            "borough_code": pa.array(self.station_boroughs, pa.int64()),
+        })
+        boroughs = pa.table({
+            "name": pa.array(self.borough_names, pa.string()),
+            "population": pa.array(self.borough_populations, pa.float64()),
+        })
+        return stations, boroughs
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def rows(self, station_ids):
+        """
+        Returns the registry rows of an array of station ids (-1 where the id isn't known)
+        """
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        in_range = (station_ids >= 0) & (station_ids < len(self.station_index))
+        return np.where(in_range, self.station_index[np.where(in_range, station_ids, 0)], -1)
+
+    def row(self, station_id):
+        if 0 <= station_id < len(self.station_index):
+            return int(self.station_index[station_id])
+        return -1
+
+    def borough_of(self, station_id):
+        row = self.row(station_id)
+        if row < 0 or self.station_boroughs[row] < 0:
+            return None
+        return self.borough_names[self.station_boroughs[row]]
+
+    def population_of(self, borough):
+        code = self.borough_code.get(borough)
+        if code is None or np.isnan(self.borough_populations[code]):
+            return None
+        return int(self.borough_populations[code])
+
+    def name_of(self, station_id):
+        row = self.row(station_id)
+        return self.station_names[row] if row >= 0 else None
+
+    def coords_of(self, station_id):
+        row = self.row(station_id)
+        if row < 0 or np.isnan(self.latitudes[row]):
+            return (None, None)
+        return (float(self.latitudes[row]), float(self.longitudes[row]))
+
+"""
+--------------
+    LOADING
+--------------
+"""
+
+_registry = None
+_registry_mtimes = None
+_last_checked = 0
+_lock = threading.Lock()
+
+def _mtime(path):
+    return path.stat().st_mtime if path.exists() else None
+
+def _reference_mtimes():
+    from .borough_assignment import STATION_BOROUGHS_PATH
+
+    mtimes = tuple((DATA_PATH / file_name).stat().st_mtime for file_name in REFERENCE_FILES)
+    # The borough code table and the binary station table are optional
+    return mtimes + (_mtime(STATION_BOROUGHS_PATH), _mtime(STATION_TABLE_PATH), _mtime(BOROUGH_TABLE_PATH))
+
+def read_table(path):
+    with pa.memory_map(str(path), "r") as source:
+        return ipc.open_file(source).read_all()
+
+def station_table_is_current():
+    """
+    The binary table is only used if it's newer than every file it was built from
+    """
+    from .borough_assignment import STATION_BOROUGHS_PATH
+
+    if not (STATION_TABLE_PATH.exists() and BOROUGH_TABLE_PATH.exists()):
+        return False
+    built = min(STATION_TABLE_PATH.stat().st_mtime, BOROUGH_TABLE_PATH.stat().st_mtime)
+    sources = [DATA_PATH / file_name for file_name in REFERENCE_FILES] + [STATION_BOROUGHS_PATH]
+    return all(_mtime(source) is None or _mtime(source) <= built for source in sources)
+
+@timed("load.station_registry")
+def load_station_registry():
+    if station_table_is_current():
+        return StationRegistry.from_tables(read_table(STATION_TABLE_PATH), read_table(BOROUGH_TABLE_PATH))
+
+    if STATION_TABLE_PATH.exists():
+        print("Warning: The station table is out of date, loading the JSON reference files instead - run: python -m backend.app.reference_build")
+
+    # Imported here - borough_assignment.py reads the reference files through this module
+    from .borough_assignment import load_station_boroughs
+
+    return StationRegistry.from_json(
+        load_json("station_details.json"),
+        load_json("station_coords.json"),
+        load_json("borough_populations.json"),
+        load_station_boroughs(),
+    )
+
+def get_station_registry():
+    """
+    Returns the shared registry - building it on first use, and rebuilding it if the files have changed
+    """
+    global _registry, _registry_mtimes, _last_checked
+
+    now = time.monotonic()
+    if _registry is not None and now - _last_checked < RELOAD_CHECK_INTERVAL:
+        return _registry
+
+    with _lock:
+        mtimes = _reference_mtimes()
+        if _registry is None or mtimes != _registry_mtimes:
+            _registry = load_station_registry()
+            _registry_mtimes = mtimes
+        _last_checked = now
+
+    return _registry
@@ -0,0 +1,67 @@
+from datetime import timedelta
+import numpy as np
+import pyarrow as pa
+
+"""
+    This file contains the period logic for the "Boroughs with Highest Change in Use" graph.
+    It used to live in the SQL of get_change_in_monthly_average_use_foreach_station (the params/start_period/end_period CTEs),
+        with the min and max dates of the data hard-coded. It's now plain Python, so every backend shares it
+        (the station cube answers it with prefix sums), and the comparison window isn't fixed to 3 months.
+    With the default window_months=3, the periods are exactly the ones the original query produced:
+        - each period runs from 45 days before to 45 days after the parsed date
+        - if the starting period would begin before the first ride, it runs from the first ride for 3 months instead
+        - if the ending period would finish after the last ride, it runs for the 3 months up to the last ride instead
+"""
+
+DEFAULT_WINDOW_MONTHS = 3
+
+def shift_months(date, months):
+    """
+    Adds (or subtracts) whole months, clamping the day to the end of the month like BigQuery's
+    DATE_ADD(..., INTERVAL n MONTH) does (e.g. 31st Jan + 1 month = 28th Feb)
+    """
+    month_index = date.year * 12 + date.month - 1 + months
+    year, month = divmod(month_index, 12)
+    for day in range(date.day, 27, -1):
+        try:
+            return date.replace(year=year, month=month + 1, day=day)
+        except ValueError:
+            continue
+    return date.replace(year=year, month=month + 1)
+
+def usage_periods(start_date, end_date, min_start_date, max_end_date, window_months=DEFAULT_WINDOW_MONTHS):
+    """
+    Works out the starting and ending comparison periods
+    All arguments and return values are datetime.date objects, and both periods are inclusive
+    """
+    # Half of the window either side of the date (45 days for the default 3 months)
+    half_window = timedelta(days=window_months * 15)
+
+    if start_date - half_window < min_start_date:
+        start_period = (min_start_date, shift_months(min_start_date, window_months))
+    elif start_date + half_window > max_end_date:
+        start_period = (start_date - half_window, max_end_date)
+    else:
+        start_period = (start_date - half_window, start_date + half_window)
+
+    if end_date + half_window > max_end_date:
+        end_period = (shift_months(max_end_date, -window_months), max_end_date)
+    elif end_date - half_window < min_start_date:
+        end_period = (min_start_date, end_date + half_window)
+    else:
+        end_period = (end_date - half_window, end_date + half_window)
+
+    return start_period, end_period
+
+def usage_change_table(starting_counts, ending_counts, window_months=DEFAULT_WINDOW_MONTHS):
+    """
+    Turns the ride counts of both periods (arrays indexed by station id) into the query result:
+    the monthly average for each station that had rides in either period, ordered by station id
+    """
+    station_ids = np.flatnonzero(starting_counts + ending_counts)
+
+    return pa.table({
+        "station_id": pa.array(station_ids, pa.int64()),
+        "starting_period_avg": np.round(starting_counts[station_ids] / window_months, 2),
+        "ending_period_avg": np.round(ending_counts[station_ids] / window_months, 2),
+    })
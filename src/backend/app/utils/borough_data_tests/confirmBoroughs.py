@@ -40,25 +40,27 @@ stations_gdf = gpd.GeoDataFrame(station_points, geometry="geometry", crs="EPSG:4
 joined = gpd.sjoin(stations_gdf, boroughs_gdf.to_crs("EPSG:4326"), predicate="within")
 
 # Check and update mismatches
+# (the API builds the same assignment in backend/app/borough_assignment.py)
+stations_by_id = {s.get("id"): s for s in stations}
 mismatches = 0
 updates = 0
-for i, row in joined.iterrows():
-    correct_borough = row[borough_col].strip()
+for station_id, correct_borough in zip(joined["id"], joined[borough_col].str.strip()):
     if correct_borough not in VALID_BOROUGHS:
         print(f"⚠️ Skipping unknown borough: '{correct_borough}'")
         continue
 
-    for s in stations:
-        if s["id"] == row["id"]:
-            if s.get("borough", "").strip().lower() != correct_borough.lower():
-                print(f"🔄 ID {s['id']} – '{s['name']}': '{s['borough']}' → '{correct_borough}'")
-                s["borough"] = correct_borough
-                mismatches += 1
-            updates += 1
-            break
+    s = stations_by_id.get(station_id)
+    if s is None:
+        continue
+    if (s.get("borough") or "").strip().lower() != correct_borough.lower():
+        print(f"🔄 ID {s['id']} – '{s['name']}': '{s.get('borough')}' → '{correct_borough}'")
+        s["borough"] = correct_borough
+        mismatches += 1
+    updates += 1
 
-# Save the updated file
-with open("combined_station_details.json", "w", encoding="utf-8") as f:
-    json.dump(stations, f, indent=4)
+# Save the updated file (only if something changed)
+if mismatches:
+    with open("combined_station_details.json", "w", encoding="utf-8") as f:
+        json.dump(stations, f, indent=4)
 
 print(f"\n✅ {updates} stations checked. {mismatches} borough(s) updated.")
@@ -0,0 +1,317 @@
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import urlencode
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+from .synthetic_rides import dataset_paths
+
+"""
+    This file contains the benchmark harness - it measures the API endpoints and the service functions against
+        a synthetic dataset (see synthetic_rides.py), served by the local backend, so no BigQuery is needed.
+    Endpoints are called in-process through the ASGI interface (no sockets), after running the app's lifespan:
+        - latency: the requests are sent one at a time, and p50 / p99 / mean are reported
+        - throughput: the same number of requests are sent with --concurrency in flight, and requests/s is reported
+    The date ranges are drawn (seeded) from a pool of --ranges ranges, so the query cache sees repeats like it would
+        from a dashboard.
+    Service functions (services.py) are microbenchmarked on the results of a one-year query.
+    The results are written as JSON - pass a previous results file with --compare to see what got faster or slower.
+    From /src (after generating a dataset):
+        python -m backend.benchmarks.run_benchmarks --data /tmp/bench [--requests 200] [--concurrency 8] [--compare old.json]
+"""
+
+RESULTS_PATH = Path(__file__).parent / "results"
+
+# A change in p50 bigger than this is flagged by --compare
+REGRESSION_THRESHOLD = 0.10
+
+# Range lengths (days) the date ranges are drawn from
+RANGE_LENGTHS = [7, 30, 90, 365, 1095]
+
+# Central London, for the map endpoints
+BBOX = {"min_lat": 51.49, "min_lon": -0.16, "max_lat": 51.53, "max_lon": -0.07}
+POINT = {"lat": 51.5074, "lon": -0.1278, "radius_m": 1000}
+
+# name -> (path, extra query parameters) - every endpoint also gets start_date and end_date
+ENDPOINTS = {
+    "dashboard": ("/dashboard", {}),
+    "get_all_stations": ("/get_all_stations", {}),
+    "get_station_daily_counts": ("/get_station_daily_counts", {}),
+    "most_sustainable_borough": ("/db/most_sustainable_borough", {"ignoreCityOfLondon": "false"}),
+    "least_sustainable_boroughs": ("/db/least_sustainable_boroughs", {}),
+    "hot_spots": ("/db/hot_spots", {}),
+    "hot_spots_bbox": ("/db/hot_spots/bbox", BBOX),
+    "hot_spots_nearby": ("/db/hot_spots/nearby", POINT),
+    "CO2_offset": ("/db/CO2_offset", {}),
+    "ride_metrics": ("/db/ride_metrics", {}),
+    "change_in_usage": ("/db/change_in_usage", {}),
+    "flows_station": ("/db/flows", {"by": "station"}),
+    "flows_borough": ("/db/flows", {"by": "borough"}),
+    "profile_network": ("/db/profile", {}),
+    "profile_borough": ("/db/profile", {"borough": "Westminster"}),
+}
+
+"""
+    ASGI CLIENT
+"""
+
+async def asgi_get(app, path, parameters):
+    """
+    Sends a GET request straight to the ASGI app, and returns (status, body)
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": urlencode(parameters).encode(),
+        "root_path": "",
+        "headers": [(b"host", b"benchmark")],
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    request_sent = False
+    status = None
+    body = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client never disconnects
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, b"".join(body)
+
+"""
+    ENDPOINTS
+"""
+
+def date_ranges(first_day, last_day, count, seed):
+    """
+    Draws count (start_date, end_date) ranges inside the dataset
+    """
+    rng = np.random.default_rng(seed)
+    ranges = []
+    for _ in range(count):
+        length = min(int(rng.choice(RANGE_LENGTHS)), (last_day - first_day).days)
+        start = first_day + timedelta(days=int(rng.integers(0, (last_day - first_day).days - length + 1)))
+        ranges.append((start.isoformat(), (start + timedelta(days=length)).isoformat()))
+    return ranges
+
+def summarise(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "mean_ms": round(float(latencies.mean()), 3),
+    }
+
+async def benchmark_endpoint(app, path, extra, ranges, num_requests, concurrency, rng):
+    requests = [
+        {"start_date": start, "end_date": end, **extra}
+        for start, end in (ranges[i] for i in rng.integers(0, len(ranges), size=num_requests))
+    ]
+    errors = 0
+
+    # Latency - one request at a time
+    latencies = []
+    for parameters in requests:
+        started = time.perf_counter()
+        status, _ = await asgi_get(app, path, parameters)
+        latencies.append(time.perf_counter() - started)
+        errors += status != 200
+
+    # Throughput - concurrency requests in flight
+    queue = list(requests)
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            status, _ = await asgi_get(app, path, queue.pop())
+            errors += status != 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {"requests": num_requests, "errors": errors, **summarise(latencies), "rps": round(num_requests / elapsed, 1)}
+
+async def benchmark_endpoints(app, ranges, num_requests, concurrency, seed, names=None):
+    rng = np.random.default_rng(seed)
+    results = {}
+    async with app.router.lifespan_context(app):
+        for name, (path, extra) in ENDPOINTS.items():
+            if names and name not in names:
+                continue
+            results[name] = await benchmark_endpoint(app, path, extra, ranges, num_requests, concurrency, rng)
+            print(f"  {name:<28} p50 {results[name]['p50_ms']:>9.3f} ms   p99 {results[name]['p99_ms']:>9.3f} ms   "
+                  f"{results[name]['rps']:>8.1f} req/s   {results[name]['errors']} errors")
+    return results
+
+"""
+    SERVICES
+"""
+
+def time_calls(function, repeat):
+    for _ in range(min(5, repeat)):
+        function()
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        function()
+        timings.append(time.perf_counter_ns() - started)
+
+    timings = np.asarray(timings) / 1000
+    return {
+        "calls": repeat,
+        "p50_us": round(float(np.percentile(timings, 50)), 2),
+        "p99_us": round(float(np.percentile(timings, 99)), 2),
+        "calls_per_s": round(float(1e6 / timings.mean()), 1),
+    }
+
+def benchmark_services(start_date, end_date, repeat):
+    from backend.app import server, services, flow_matrix, profile_tensor
+    from backend.app.arrow_results import first_value
+    from backend.app.station_registry import get_station_registry
+
+    registry = get_station_registry()
+    ordered_stations = server.get_ordered_stations(start_date, end_date)
+    usage_data = server.get_change_in_monthly_average_use_foreach_station(start_date, end_date)
+    trip_totals = server.get_trip_totals(start_date, end_date)
+    duration = first_value(trip_totals, "duration")
+    flows = flow_matrix.get_flow_matrix()
+    profiles = profile_tensor.get_profile_tensor()
+
+    calls = {
+        "get_most_sustainable_borough": lambda: services.get_most_sustainable_borough(ordered_stations, registry, False),
+        "get_least_sustainable_boroughs": lambda: services.get_least_sustainable_boroughs(ordered_stations, registry),
+        "get_hot_spots": lambda: services.get_hot_spots(ordered_stations, registry),
+        "get_hot_spots_in_bbox": lambda: services.get_hot_spots_in_bbox(ordered_stations, registry, *BBOX.values()),
+        "get_hot_spots_near": lambda: services.get_hot_spots_near(ordered_stations, registry, *POINT.values()),
+        "get_boroughs_by_biggest_change": lambda: services.get_boroughs_by_biggest_change(registry, usage_data),
+        "get_CO2_offset": lambda: services.calculate_tree_equivalent(services.get_CO2_offset(duration)[0]),
+        "get_ride_metrics": lambda: services.get_ride_metrics(trip_totals),
+    }
+    if flows is not None:
+        calls["get_top_flows"] = lambda: services.get_top_flows(flows, registry, start_date, end_date)
+        calls["get_borough_flows"] = lambda: services.get_borough_flows(flows, registry, start_date, end_date)
+    if profiles is not None:
+        calls["get_demand_profile"] = lambda: services.get_demand_profile(profiles, registry, start_date, end_date, borough="Westminster")
+
+    results = {}
+    for name, function in calls.items():
+        # The services print warnings for stations without a borough - they're part of the cost, but not the output
+        with redirect_stdout(io.StringIO()):
+            results[name] = time_calls(function, repeat)
+        print(f"  {name:<32} p50 {results[name]['p50_us']:>10.2f} us   p99 {results[name]['p99_us']:>10.2f} us")
+    return results
+
+"""
+    RESULTS
+"""
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    """
+    Prints the change in p50 of every endpoint and service function against a previous results file
+    """
+    print(f"\nCompared with {previous['meta'].get('created')} ({previous['meta'].get('git_commit')}):")
+    for section, metric in (("endpoints", "p50_ms"), ("services", "p50_us")):
+        for name, result in results.get(section, {}).items():
+            old = previous.get(section, {}).get(name)
+            if not old or not old.get(metric):
+                continue
+            change = result[metric] / old[metric] - 1
+            flag = "⚠️ " if change > REGRESSION_THRESHOLD else "  "
+            print(f"{flag}{section}/{name:<32} {old[metric]:>10.3f} -> {result[metric]:>10.3f}  ({change:+.1%})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints and service functions")
+    parser.add_argument("--data", required=True, help="dataset directory written by synthetic_rides.py")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint (for latency, and again for throughput)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--ranges", type=int, default=50, help="number of distinct date ranges")
+    parser.add_argument("--repeat", type=int, default=200, help="calls per service function")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--endpoints", nargs="*", help="only these endpoints (see ENDPOINTS)")
+    parser.add_argument("--skip-services", action="store_true")
+    parser.add_argument("--out", help="results file (default: benchmarks/results/<time>.json)")
+    parser.add_argument("--compare", help="previous results file to compare with")
+    arguments = parser.parse_args()
+
+    # The app reads its settings when it's imported
+    # (the cache warm-up is off unless asked for, so it doesn't compete with the requests being measured,
+    #   and so is the persistent result store, so one run's results don't answer the next run's queries)
+    os.environ.update(dataset_paths(arguments.data))
+    os.environ.setdefault("CACHE_WARMUP", "0")
+    os.environ.setdefault("RESULT_CACHE", "0")
+    from backend.app.main import app
+    from backend.app import station_cube
+
+    cube = station_cube.get_cube()
+    if cube is None:
+        raise SystemExit(f"No station cube in {arguments.data} - generate the dataset with --build first")
+    ranges = date_ranges(cube.first_day, cube.last_day + timedelta(days=1), arguments.ranges, arguments.seed)
+
+    created = datetime.now(timezone.utc)
+    results = {
+        "meta": {
+            "created": created.isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "data": str(arguments.data),
+            "days": cube.num_days,
+            "rides": int(cube.prefix["start_counts"][-1].sum()),
+            "requests": arguments.requests,
+            "concurrency": arguments.concurrency,
+            "ranges": arguments.ranges,
+            "seed": arguments.seed,
+        },
+    }
+
+    print(f"Endpoints ({arguments.requests} requests each, concurrency {arguments.concurrency}):")
+    results["endpoints"] = asyncio.run(benchmark_endpoints(
+        app, ranges, arguments.requests, arguments.concurrency, arguments.seed, arguments.endpoints,
+    ))
+
+    if not arguments.skip_services:
+        year_start = max(cube.first_day, cube.last_day - timedelta(days=365))
+        print(f"Services ({arguments.repeat} calls each, {year_start} to {cube.last_day}):")
+        results["services"] = benchmark_services(year_start.isoformat(), cube.last_day.isoformat(), arguments.repeat)
+
+    out_path = Path(arguments.out) if arguments.out else RESULTS_PATH / f"{created:%Y%m%d-%H%M%S}.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with out_path.open("w") as file:
+        json.dump(results, file, indent=2)
+    print(f"✅ Results saved to {out_path}")
+
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(results, json.load(file))
@@ -0,0 +1,209 @@
+from datetime import date
+from pathlib import Path
+import argparse
+import os
+import shutil
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+"""
+    This file contains the synthetic cycle_hire generator used by the benchmarks - it writes a local ride store
+        (the same month=YYYY-MM/rides.parquet layout as ride_store.py) that QUERY_BACKEND=local serves, so the API
+        can be measured without BigQuery.
+    The rides use the real station ids, coordinates and boroughs from utils/data (through the station registry):
+        - start stations are drawn from a skewed popularity distribution, so there are hot spots
+        - most trips end in the same borough, some end where they started (round trips)
+        - durations follow the straight-line distance at a random cycling speed, plus a stop
+        - start times follow a weekday commuter / weekend leisure profile, with a summer peak
+        - a small share of rides have no end station (like the real table)
+    Everything is drawn from a seeded generator, one month at a time, so the same seed always gives the same
+        rides and 100M rides never have to be held in memory at once.
+    From /src:
+        python -m backend.benchmarks.synthetic_rides --rides 1000000 --out /tmp/bench [--seed 0] [--build]
+    --build also builds the station cube, the flow matrix and the profile tensor from the generated rides.
+"""
+
+START_DAY = date(2015, 1, 1)
+END_DAY = date(2023, 1, 1)
+
+# Share of trips that end at the start station / in the start station's borough / with no end station
+ROUND_TRIP_SHARE = 0.05
+SAME_BOROUGH_SHARE = 0.55
+NO_END_SHARE = 0.001
+
+# Relative demand by hour of the day (UTC), for weekdays and weekends
+WEEKDAY_HOURS = np.array([1, 0.5, 0.3, 0.2, 0.3, 1, 4, 10, 16, 9, 5, 5, 6, 6, 5, 6, 9, 15, 12, 7, 5, 4, 3, 2], dtype=np.float64)
+WEEKEND_HOURS = np.array([2, 1.5, 1, 0.5, 0.3, 0.3, 0.8, 2, 4, 6, 8, 9, 10, 10, 10, 9, 8, 7, 6, 5, 4, 3, 3, 2], dtype=np.float64)
+
+def day_weights(days):
+    """
+    Relative demand per day - weekends are quieter, and summer is busier than winter
+    """
+    day_numbers = days.astype(np.int64)
+    weekday = (day_numbers + 3) % 7 # 1970-01-01 was a Thursday
+    day_of_year = (days - days.astype("datetime64[Y]")).astype(np.int64)
+    seasonal = 1 + 0.35 * np.sin(2 * np.pi * (day_of_year - 100) / 365)
+    return np.where(weekday >= 5, 0.8, 1.0) * seasonal, weekday >= 5
+
+def start_times(rng, days, num_rides):
+    """
+    Draws num_rides start times (datetime64[us]) over days, sorted
+    """
+    weights, weekend = day_weights(days)
+    ride_days = rng.choice(len(days), size=num_rides, p=weights / weights.sum())
+    ride_weekend = weekend[ride_days]
+
+    hours = np.empty(num_rides, dtype=np.int64)
+    for is_weekend, profile in ((False, WEEKDAY_HOURS), (True, WEEKEND_HOURS)):
+        rows = np.flatnonzero(ride_weekend == is_weekend)
+        hours[rows] = rng.choice(24, size=len(rows), p=profile / profile.sum())
+
+    microseconds = hours * 3_600_000_000 + rng.integers(0, 3_600_000_000, size=num_rides)
+    times = days[ride_days].astype("datetime64[us]") + microseconds.astype("timedelta64[us]")
+    return np.sort(times)
+
+def end_stations(rng, registry, start_rows, popularity):
+    """
+    Draws the end station (registry row) of every ride
+    """
+    num_rides = len(start_rows)
+    end_rows = rng.choice(len(popularity), size=num_rides, p=popularity)
+
+    choice = rng.random(num_rides)
+    end_rows = np.where(choice < ROUND_TRIP_SHARE, start_rows, end_rows)
+
+    # Same borough: draw from the stations of the start station's borough, by popularity
+    same_borough = (choice >= ROUND_TRIP_SHARE) & (choice < ROUND_TRIP_SHARE + SAME_BOROUGH_SHARE)
+    start_boroughs = registry.station_boroughs[start_rows]
+    for code in np.unique(start_boroughs[same_borough]):
+        if code < 0:
+            continue
+        rides = np.flatnonzero(same_borough & (start_boroughs == code))
+        stations = np.flatnonzero(registry.station_boroughs == code)
+        weights = popularity[stations] / popularity[stations].sum()
+        end_rows[rides] = stations[rng.choice(len(stations), size=len(rides), p=weights)]
+
+    return end_rows
+
+def durations(rng, registry, start_rows, end_rows):
+    """
+    Trip durations in seconds - the straight-line distance at 3-6 m/s plus a stop, or a leisure loop for round trips
+    """
+    from backend.app.spatial_index import haversine_m
+
+    distances = haversine_m(
+        registry.latitudes[start_rows], registry.longitudes[start_rows],
+        registry.latitudes[end_rows], registry.longitudes[end_rows],
+    )
+    distances = np.nan_to_num(distances, nan=2000.0)
+    seconds = distances * 1.3 / rng.uniform(3, 6, size=len(start_rows)) + rng.exponential(120, size=len(start_rows))
+    seconds = np.where(start_rows == end_rows, rng.exponential(1800, size=len(start_rows)) + 300, seconds)
+    return np.maximum(seconds, 60).astype(np.int64)
+
+def month_rides(rng, registry, popularity, first_day, end_day, num_rides, first_rental_id):
+    """
+    Generates the rides of one month as a table in the ride store schema, sorted by start_date
+    """
+    from backend.app.ride_store import RIDE_SCHEMA
+
+    days = np.arange(np.datetime64(first_day, "D"), np.datetime64(end_day, "D"))
+    starts = start_times(rng, days, num_rides)
+
+    start_rows = rng.choice(len(popularity), size=num_rides, p=popularity)
+    end_rows = end_stations(rng, registry, start_rows, popularity)
+    trip_seconds = durations(rng, registry, start_rows, end_rows)
+    ends = starts + (trip_seconds * 1_000_000).astype("timedelta64[us]")
+
+    no_end = rng.random(num_rides) < NO_END_SHARE
+    return pa.table({
+        "rental_id": pa.array(np.arange(first_rental_id, first_rental_id + num_rides), pa.int64()),
+        "duration": pa.array(trip_seconds, pa.int64(), mask=no_end),
+        "start_date": pa.array(starts, pa.timestamp("us")).cast(RIDE_SCHEMA.field("start_date").type),
+        "end_date": pa.array(ends, pa.timestamp("us"), mask=no_end).cast(RIDE_SCHEMA.field("end_date").type),
+        "start_station_id": pa.array(registry.station_ids[start_rows], pa.int32()),
+        "end_station_id": pa.array(registry.station_ids[end_rows], pa.int32(), mask=no_end),
+    }, schema=RIDE_SCHEMA)
+
+def generate_rides(store_path, num_rides, seed=0, start_day=START_DAY, end_day=END_DAY):
+    """
+    Writes num_rides synthetic rides into a ride store at store_path (replacing it), one month at a time
+    """
+    from backend.app.block_cache import next_month
+    from backend.app.station_registry import load_station_registry
+
+    registry = load_station_registry()
+    rng = np.random.default_rng(seed)
+    popularity = rng.lognormal(mean=0, sigma=1, size=len(registry))
+    popularity /= popularity.sum()
+
+    # Rides per month, in proportion to the demand of its days
+    months = []
+    month = start_day.replace(day=1)
+    while month < end_day:
+        months.append((max(month, start_day), min(next_month(month), end_day)))
+        month = next_month(month)
+    weights = np.array([
+        day_weights(np.arange(np.datetime64(first, "D"), np.datetime64(end, "D")))[0].sum()
+        for first, end in months
+    ])
+    counts = rng.multinomial(num_rides, weights / weights.sum())
+
+    store_path = Path(store_path)
+    shutil.rmtree(store_path, ignore_errors=True)
+    rental_id = 1
+    for (first, end), count in zip(months, counts):
+        rides = month_rides(rng, registry, popularity, first, end, int(count), rental_id)
+        rental_id += int(count)
+        month_path = store_path / f"month={first:%Y-%m}"
+        month_path.mkdir(parents=True, exist_ok=True)
+        pq.write_table(rides, month_path / "rides.parquet", row_group_size=64 * 1024)
+
+    return rental_id - 1
+
+def dataset_paths(data_path):
+    """
+    The environment variables that point the app at a generated dataset
+    """
+    data_path = Path(data_path)
+    return {
+        "QUERY_BACKEND": "local",
+        "RIDE_STORE_PATH": str(data_path / "rides"),
+        "STATION_CUBE_PATH": str(data_path / "station_cube.arrow"),
+        "FLOW_MATRIX_PATH": str(data_path / "flow_matrix.arrow"),
+        "PROFILE_TENSOR_PATH": str(data_path / "profile_tensor.arrow"),
+    }
+
+def build_derived(data_path):
+    """
+    Builds the station cube, flow matrix and profile tensor of a generated dataset
+    (the app modules read their paths from the environment when they're imported, so it's set first)
+    """
+    os.environ.update(dataset_paths(data_path))
+    from backend.app import station_cube, flow_matrix, profile_tensor
+    from backend.app.block_counts import save_block_table
+
+    station_cube.build_cube().save(station_cube.STATION_CUBE_PATH)
+    save_block_table(flow_matrix.build_flow_matrix(), flow_matrix.FLOW_MATRIX_PATH)
+    save_block_table(profile_tensor.build_profile_tensor(), profile_tensor.PROFILE_TENSOR_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic cycle_hire ride store")
+    parser.add_argument("--rides", type=int, default=1_000_000)
+    parser.add_argument("--out", required=True, help="dataset directory (the rides go in <out>/rides)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--build", action="store_true", help="also build the station cube, flow matrix and profile tensor")
+    arguments = parser.parse_args()
+
+    os.environ.update(dataset_paths(arguments.out))
+
+    started = time.perf_counter()
+    written = generate_rides(Path(arguments.out) / "rides", arguments.rides, arguments.seed)
+    print(f"✅ {written} rides written to {Path(arguments.out) / 'rides'} in {time.perf_counter() - started:.1f}s")
+
+    if arguments.build:
+        started = time.perf_counter()
+        build_derived(arguments.out)
+        print(f"✅ Station cube, flow matrix and profile tensor built in {time.perf_counter() - started:.1f}s")
+
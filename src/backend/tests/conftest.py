@@ -0,0 +1,34 @@
+from pathlib import Path
+import sys
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pytest
+
+"""
+    Makes the backend importable as backend.app (the same way it's run, from /src).
+    From the repository root:
+        python -m pytest src/backend/tests
+"""
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from backend.app import ride_store
+
+@pytest.fixture
+def make_ride_store(tmp_path, monkeypatch):
+    """
+    Writes rides (a list of (rental_id, duration, start_date, end_date, start_station_id, end_station_id) tuples)
+        into a ride store partitioned by start month, the way ride_store.ingest_rides() does, and points the app at it
+    """
+    def make(rides):
+        table = pa.table(dict(zip(ride_store.RIDE_SCHEMA.names, zip(*rides))), schema=ride_store.RIDE_SCHEMA)
+        months = pc.strftime(table.column("start_date"), format="%Y-%m")
+        for month in sorted(set(months.to_pylist())):
+            month_path = tmp_path / "rides" / f"month={month}"
+            month_path.mkdir(parents=True)
+            pq.write_table(table.filter(pc.equal(months, month)).sort_by("start_date"), month_path / "rides.parquet")
+        monkeypatch.setattr(ride_store, "RIDE_STORE_PATH", tmp_path / "rides")
+        return table
+
+    return make
@@ -0,0 +1,83 @@
+from datetime import date, datetime, time, timezone
+import json
+import pyarrow as pa
+from backend.app.arrow_results import encode_json, iter_json_array, iter_ndjson
+
+def decoded(table):
+    return json.loads(encode_json(table))
+
+def test_strings_escape_quotes_backslashes_and_every_control_character():
+    values = ['say "hi"', "back\\slash", "line\nbreak\r\ttab", "bell\x07 nul\x00 unit\x1f", "ünïcode ✓", None]
+    table = pa.table({"name": values})
+
+    assert decoded(table) == [{"name": value} for value in values]
+    body = encode_json(table)
+    assert b"\\u0007" in body and b"\\u0000" in body and b"\\u001f" in body
+    assert not any(byte < 0x20 for byte in body)
+
+def test_column_names_are_escaped():
+    table = pa.table({'odd "name"\n': [1]})
+
+    assert decoded(table) == [{'odd "name"\n': 1}]
+
+def test_nan_and_infinity_become_null():
+    table = pa.table({"value": [1.5, float("nan"), float("inf"), float("-inf"), None, 0.1]})
+
+    assert decoded(table) == [{"value": 1.5}, {"value": None}, {"value": None}, {"value": None}, {"value": None}, {"value": 0.1}]
+
+def test_naive_timestamps_have_no_offset():
+    table = pa.table({"at": pa.array([datetime(2016, 1, 4, 10, 30), None], pa.timestamp("s"))})
+
+    assert decoded(table) == [{"at": "2016-01-04T10:30:00"}, {"at": None}]
+
+def test_timezone_aware_timestamps_are_written_in_utc_with_an_rfc_3339_offset():
+    instant = datetime(2016, 7, 4, 10, 30, tzinfo=timezone.utc)
+    table = pa.table({
+        "utc": pa.array([instant], pa.timestamp("s", tz="UTC")),
+        "london": pa.array([instant], pa.timestamp("s", tz="Europe/London")),
+    })
+
+    assert decoded(table) == [{"utc": "2016-07-04T10:30:00+00:00", "london": "2016-07-04T10:30:00+00:00"}]
+    assert datetime.fromisoformat(decoded(table)[0]["london"]) == instant
+
+def test_dates_booleans_integers_and_nulls():
+    table = pa.table({
+        "day": pa.array([date(2016, 1, 4), None], pa.date32()),
+        "flag": [True, None],
+        "count": pa.array([2 ** 40, None], pa.int64()),
+        "nothing": pa.nulls(2),
+    })
+
+    assert decoded(table) == [
+        {"day": "2016-01-04", "flag": True, "count": 2 ** 40, "nothing": None},
+        {"day": None, "flag": None, "count": None, "nothing": None},
+    ]
+
+def test_nested_and_other_types_fall_back_to_python_values():
+    table = pa.table({
+        "ids": pa.array([[1, 2], [], None]),
+        "point": pa.array([{"x": 1.5, "label": 'a "b"'}, {"x": float("nan"), "label": None}, None]),
+        "at": pa.array([time(10, 30), None, time(0, 0, 1)]),
+    })
+
+    assert decoded(table) == [
+        {"ids": [1, 2], "point": {"x": 1.5, "label": 'a "b"'}, "at": "10:30:00"},
+        {"ids": [], "point": {"x": None, "label": None}, "at": None},
+        {"ids": None, "point": None, "at": "00:00:01"},
+    ]
+
+def test_empty_table():
+    assert encode_json(pa.table({"station_id": pa.array([], pa.int64())})) == b"[]"
+
+def test_streaming_encoders_skip_empty_batches():
+    schema = pa.schema([("station_id", pa.int64())])
+    batches = [
+        pa.record_batch([pa.array([1, 2])], schema=schema),
+        pa.record_batch([pa.array([], pa.int64())], schema=schema),
+        pa.record_batch([pa.array([3])], schema=schema),
+    ]
+
+    assert b"".join(iter_ndjson(batches)) == b'{"station_id":1}\n{"station_id":2}\n{"station_id":3}\n'
+    assert json.loads(b"".join(iter_json_array(batches))) == [{"station_id": 1}, {"station_id": 2}, {"station_id": 3}]
+    assert b"".join(iter_json_array([])) == b"[]"
+    assert b"".join(iter_ndjson([])) == b""
@@ -0,0 +1,73 @@
+from datetime import date, timedelta
+import numpy as np
+from backend.app.block_cache import BlockCache, block_buckets, bucket_station_measures, decompose
+from backend.app.ride_store import MAX_STATION_ID
+from backend.app.station_cube import MEASURES
+
+def days(first_day, count):
+    return [(first_day + timedelta(days=n), first_day + timedelta(days=n + 1)) for n in range(count)]
+
+def months(year, first_month, last_month):
+    return [
+        (date(year, month, 1), date(year + month // 12, month % 12 + 1, 1))
+        for month in range(first_month, last_month + 1)
+    ]
+
+def test_decompose_uses_the_fewest_calendar_blocks():
+    blocks = decompose(date(2015, 3, 17), date(2017, 2, 3))
+
+    assert blocks == (
+        days(date(2015, 3, 17), 15)
+        + months(2015, 4, 12)
+        + [(date(2016, 1, 1), date(2017, 1, 1))]
+        + months(2017, 1, 1)
+        + days(date(2017, 2, 1), 2)
+    )
+    assert len(blocks) == 15 + 9 + 1 + 1 + 2
+
+def test_decompose_whole_year_and_empty_range():
+    assert decompose(date(2016, 1, 1), date(2017, 1, 1)) == [(date(2016, 1, 1), date(2017, 1, 1))]
+    assert decompose(date(2016, 1, 1), date(2016, 1, 1)) == []
+
+def test_decompose_month_that_ends_the_range_early_is_split_into_days():
+    assert decompose(date(2016, 2, 1), date(2016, 2, 3)) == days(date(2016, 2, 1), 2)
+
+def test_block_buckets_follow_range_bucket_numbering():
+    blocks = [(date(2016, 1, 1), date(2016, 2, 1)), (date(2016, 3, 5), date(2016, 3, 6))]
+    boundaries, buckets = block_buckets(blocks)
+
+    assert boundaries == [date(2016, 1, 1), date(2016, 2, 1), date(2016, 3, 5), date(2016, 3, 6)]
+    # Days in February fall in bucket 2, between the blocks, and are dropped
+    assert buckets == [1, 3]
+
+def test_bucket_station_measures_scatters_rows_into_blocks():
+    blocks = [(date(2016, 1, 1), date(2016, 2, 1)), (date(2016, 3, 5), date(2016, 3, 6))]
+    buckets = np.array([1, 1, 3, 2, 3])
+    station_ids = np.array([7, 7, 7, 7, -1])
+    measures = {measure: np.array([1.0, 2.0, 4.0, 8.0, 16.0]) for measure in MEASURES}
+
+    totals = bucket_station_measures(blocks, buckets, station_ids, measures)
+
+    for measure in MEASURES:
+        assert totals[measure].shape == (2, MAX_STATION_ID)
+        assert totals[measure][0, 7] == 3 and totals[measure][1, 7] == 4
+        assert totals[measure].sum() == 7
+
+def test_overlapping_range_only_fetches_the_blocks_it_is_missing():
+    fetched = []
+
+    def fetch_blocks(blocks):
+        # Every block has one ride per day at station 1
+        fetched.append(list(blocks))
+        totals = {measure: np.zeros((len(blocks), MAX_STATION_ID), dtype=np.int64) for measure in MEASURES}
+        for row, (first_day, end_day) in enumerate(blocks):
+            totals["start_counts"][row, 1] = (end_day - first_day).days
+        return totals
+
+    cache = BlockCache()
+    first = cache.totals("2016-01-01", "2016-03-03", fetch_blocks)
+    second = cache.totals("2016-02-01", "2016-03-05", fetch_blocks)
+
+    assert first["start_counts"][1] == 31 + 29 + 2
+    assert second["start_counts"][1] == 29 + 4
+    assert fetched[1] == days(date(2016, 3, 3), 2)
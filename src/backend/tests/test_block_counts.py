@@ -0,0 +1,70 @@
+from datetime import date, timedelta
+import numpy as np
+from backend.app.block_counts import EPOCH, BlockCounts, block_table, daily_counts, load_block_table, save_block_table
+
+NUM_KEYS = 2000
+FIRST_DAY = date(2015, 11, 20)
+NUM_DAYS = 500
+
+def random_entries(count=3000, seed=0):
+    """
+    Rows of (epoch day, key, count) from 2015-11-20 to 2017-04-02, with repeated (day, key)s
+    """
+    rng = np.random.default_rng(seed)
+    days = (FIRST_DAY - EPOCH).days + rng.integers(0, NUM_DAYS, count)
+    keys = rng.integers(0, NUM_KEYS, count)
+    counts = rng.integers(1, 5, count).astype(np.float64)
+    return days, keys, counts
+
+def expected_totals(entries, start_date, end_date):
+    days, keys, counts = entries
+    first, end = (date.fromisoformat(start_date) - EPOCH).days, (date.fromisoformat(end_date) - EPOCH).days
+    selected = (days >= first) & (days < end)
+    return np.bincount(keys[selected], weights=counts[selected], minlength=NUM_KEYS).astype(np.int64)
+
+def random_ranges(count=200, seed=1):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        start = FIRST_DAY + timedelta(days=int(rng.integers(-20, NUM_DAYS)))
+        # Mostly short ranges, some over a year
+        length = int(rng.choice([rng.integers(0, 3), rng.integers(0, 60), rng.integers(0, 600)]))
+        yield start.isoformat(), (start + timedelta(days=length)).isoformat()
+
+def test_daily_counts_sums_repeated_days_and_keys():
+    keys, counts = daily_counts(np.array([3, 3, 1, 3]), np.array([5, 5, 2, 1]), np.array([1.0, 2.0, 4.0, 1.0]), 10)
+
+    assert keys.tolist() == [12, 31, 35]
+    assert counts.tolist() == [4, 1, 3]
+
+def test_block_table_rolls_the_days_up_into_months_and_years():
+    day = (date(2016, 2, 10) - EPOCH).days
+    table = block_table(*daily_counts(np.array([day, day + 1, day + 30]), np.array([4, 4, 4]), np.ones(3), NUM_KEYS), NUM_KEYS)
+
+    blocks = [date(1970, 1, 1) + timedelta(days=block) for block in table.column("block").to_pylist()]
+    assert list(zip(table.column("level").to_pylist(), blocks, table.column("count").to_pylist())) == [
+        (0, date(2016, 2, 10), 1), (0, date(2016, 2, 11), 1), (0, date(2016, 3, 11), 1),
+        (1, date(2016, 2, 1), 2), (1, date(2016, 3, 1), 1),
+        (2, date(2016, 1, 1), 3),
+    ]
+
+def test_totals_match_a_sum_of_the_entries(tmp_path):
+    entries = random_entries()
+    save_block_table(block_table(*daily_counts(*entries, NUM_KEYS), NUM_KEYS), tmp_path / "counts.arrow")
+    counts = BlockCounts(*load_block_table(tmp_path / "counts.arrow"), NUM_KEYS)
+
+    for start_date, end_date in random_ranges():
+        expected = expected_totals(entries, start_date, end_date)
+        assert np.array_equal(counts.totals(start_date, end_date), expected), (start_date, end_date)
+
+        # Short ranges are merged by sorting, long ones by counting - both give the same entries
+        keys, sparse = counts.sparse_totals(start_date, end_date)
+        assert keys.tolist() == np.flatnonzero(expected).tolist(), (start_date, end_date)
+        assert sparse.tolist() == expected[keys].tolist()
+
+def test_an_empty_store(tmp_path):
+    save_block_table(block_table(np.empty(0, np.int64), np.empty(0, np.int64), NUM_KEYS), tmp_path / "counts.arrow")
+    counts = BlockCounts(*load_block_table(tmp_path / "counts.arrow"), NUM_KEYS)
+
+    assert not counts.totals("2016-01-01", "2017-01-01").any()
+    keys, sparse = counts.sparse_totals("2016-01-01", "2017-01-01")
+    assert len(keys) == len(sparse) == 0
@@ -0,0 +1,33 @@
+import numpy as np
+from backend.app.borough_aggregation import top_k
+
+def test_top_k_keeps_ties_in_order():
+    values = np.array([3, 5, 5, 1, 5])
+
+    assert top_k(values, 2).tolist() == [1, 2]
+    assert top_k(values, 3).tolist() == [1, 2, 4]
+    assert top_k(values, 4).tolist() == [1, 2, 4, 0]
+    assert top_k(values, 2, largest=False).tolist() == [3, 0]
+    assert top_k(np.array([2.0, 1.0, 1.0, 1.0]), 3, largest=False).tolist() == [1, 2, 3]
+
+def test_top_k_bounds():
+    values = np.array([3, 5, 5, 1, 5])
+
+    assert top_k(values, 0).tolist() == []
+    assert top_k(values, 10).tolist() == [1, 2, 4, 0, 3]
+    assert top_k(np.array([]), 3).tolist() == []
+
+def test_top_k_puts_nans_last():
+    values = np.array([np.nan, 2.0, np.nan, 4.0])
+
+    assert top_k(values, 3).tolist() == [3, 1, 0]
+    assert top_k(values, 3, largest=False).tolist() == [1, 3, 0]
+
+def test_top_k_matches_a_stable_sort():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        values = rng.integers(0, 4, size=rng.integers(1, 50)).astype(float)
+        k = int(rng.integers(0, len(values) + 1))
+        for largest in (True, False):
+            keys = -values if largest else values
+            assert top_k(values, k, largest).tolist() == np.argsort(keys, kind="stable")[:k].tolist()
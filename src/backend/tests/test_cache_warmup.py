@@ -0,0 +1,147 @@
+import asyncio
+from collections import Counter
+import json
+import pytest
+from backend.app import cache_warmup
+
+@pytest.fixture
+def counts(monkeypatch):
+    # Fresh range counts for each test
+    monkeypatch.setattr(cache_warmup, "_saved_counts", Counter())
+    monkeypatch.setattr(cache_warmup, "_unsaved_counts", Counter())
+
+@pytest.fixture
+def status(monkeypatch):
+    monkeypatch.setattr(cache_warmup, "_status", dict(cache_warmup._status, leader=False, running=False, rounds=0))
+    return cache_warmup._status
+
+def test_try_lock_is_held_by_one_caller(tmp_path):
+    path = tmp_path / "warmup.lock"
+
+    leader = cache_warmup.try_lock(path)
+    assert leader is not None
+    assert cache_warmup.try_lock(path) is None
+
+    leader.close()
+    follower = cache_warmup.try_lock(path)
+    assert follower is not None
+    follower.close()
+
+def test_record_range_normalises_and_ignores_invalid_dates(counts):
+    cache_warmup.record_range("2016-01-01", "2017-01-01")
+    cache_warmup.record_range("2016-01-01T00:00:00", "2017-01-01")
+    cache_warmup.record_range("not a date", "2017-01-01")
+
+    assert cache_warmup.popular_ranges() == [("2016-01-01T00:00:00+00:00", "2017-01-01T00:00:00+00:00")]
+    assert sum(cache_warmup._unsaved_counts.values()) == 2
+
+def test_save_adds_to_the_other_workers_counts(counts, tmp_path):
+    path = tmp_path / "popular_ranges.json"
+    other_worker = [
+        {"start_date": "2015-01-01T00:00:00+00:00", "end_date": "2016-01-01T00:00:00+00:00", "requests": 5},
+        {"start_date": "2016-01-01T00:00:00+00:00", "end_date": "2017-01-01T00:00:00+00:00", "requests": 1},
+    ]
+    path.write_text(json.dumps(other_worker))
+
+    for _ in range(3):
+        cache_warmup.record_range("2016-01-01", "2017-01-01")
+    cache_warmup.record_range("2020-03-01", "2020-03-20")
+    cache_warmup.save_popular_ranges(path)
+
+    saved = {(entry["start_date"], entry["end_date"]): entry["requests"] for entry in json.loads(path.read_text())}
+    assert saved == {
+        ("2015-01-01T00:00:00+00:00", "2016-01-01T00:00:00+00:00"): 5,
+        ("2016-01-01T00:00:00+00:00", "2017-01-01T00:00:00+00:00"): 4,
+        ("2020-03-01T00:00:00+00:00", "2020-03-20T00:00:00+00:00"): 1,
+    }
+    assert not cache_warmup._unsaved_counts
+    assert cache_warmup.popular_ranges(2) == [
+        ("2015-01-01T00:00:00+00:00", "2016-01-01T00:00:00+00:00"),
+        ("2016-01-01T00:00:00+00:00", "2017-01-01T00:00:00+00:00"),
+    ]
+
+    # Saving again only adds what was counted since
+    cache_warmup.save_popular_ranges(path)
+    assert sum(entry["requests"] for entry in json.loads(path.read_text())) == 10
+
+def test_failed_save_keeps_the_counts(counts, tmp_path):
+    cache_warmup.record_range("2016-01-01", "2017-01-01")
+
+    # The lock file can't be created inside a file
+    (tmp_path / "file").write_text("")
+    with pytest.raises(OSError):
+        cache_warmup.save_popular_ranges(tmp_path / "file" / "popular_ranges.json")
+
+    assert sum(cache_warmup._unsaved_counts.values()) == 1
+
+def test_trim_counts_keeps_the_most_requested_half(monkeypatch):
+    monkeypatch.setattr(cache_warmup, "MAX_TRACKED_RANGES", 4)
+    counts = Counter({("a", "b"): 5, ("c", "d"): 4, ("e", "f"): 3, ("g", "h"): 2, ("i", "j"): 1})
+
+    cache_warmup.trim_counts(counts)
+
+    assert counts == Counter({("a", "b"): 5, ("c", "d"): 4})
+
+def test_warmup_round_bookkeeping(status, monkeypatch):
+    async def warm_up():
+        return 6, 1
+    monkeypatch.setattr(cache_warmup, "warm_up", warm_up)
+
+    asyncio.run(cache_warmup.warmup_round())
+
+    assert status["rounds"] == 1
+    assert (status["queries"], status["failed"]) == (6, 1)
+    assert status["running"] is False
+    assert status["last_started"] is not None and status["last_duration_s"] >= 0
+
+def test_failed_warmup_round_still_counts(status, monkeypatch, capsys):
+    async def warm_up():
+        raise RuntimeError("no BigQuery")
+    monkeypatch.setattr(cache_warmup, "warm_up", warm_up)
+
+    asyncio.run(cache_warmup.warmup_round())
+
+    assert status["rounds"] == 1
+    assert status["running"] is False
+    assert "Cache warm-up failed" in capsys.readouterr().out
+
+def run_loop_once(monkeypatch, lock_path):
+    """
+    Runs warmup_loop() until its first sleep, then cancels it - returns (rounds run, saves)
+    """
+    rounds, saves = [], []
+
+    async def warmup_round():
+        rounds.append(1)
+
+    monkeypatch.setattr(cache_warmup, "WARMUP_LOCK_PATH", lock_path)
+    monkeypatch.setattr(cache_warmup, "WARMUP_INTERVAL", 3600)
+    monkeypatch.setattr(cache_warmup, "warmup_round", warmup_round)
+    monkeypatch.setattr(cache_warmup, "store_popular_ranges", lambda: saves.append(1))
+
+    async def main():
+        task = asyncio.create_task(cache_warmup.warmup_loop())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    return len(rounds), len(saves)
+
+def test_the_leader_warms_up(status, monkeypatch, tmp_path):
+    assert run_loop_once(monkeypatch, tmp_path / "warmup.lock") == (1, 2)
+    assert status["leader"] is True
+
+    # The lock is released when the loop stops
+    follower = cache_warmup.try_lock(tmp_path / "warmup.lock")
+    assert follower is not None
+    follower.close()
+
+def test_followers_only_save_their_counts(status, monkeypatch, tmp_path):
+    leader = cache_warmup.try_lock(tmp_path / "warmup.lock")
+    try:
+        assert run_loop_once(monkeypatch, tmp_path / "warmup.lock") == (0, 2)
+        assert status["leader"] is False
+    finally:
+        leader.close()
@@ -0,0 +1,163 @@
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+import os
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from backend.app import flow_matrix, main
+from backend.app.block_counts import save_block_table
+from backend.app.ride_store import MAX_STATION_ID
+from backend.app.station_registry import StationRegistry
+from backend.app.main import app
+
+STATIONS = [1, 2, 3, 4, 5, None, -1, MAX_STATION_ID]
+
+def random_rides(count=400, seed=0):
+    """
+    Rides from December 2015 to January 2017 between a few stations, some of them unknown
+    """
+    rng = np.random.default_rng(seed)
+    first = datetime(2015, 12, 1, tzinfo=timezone.utc)
+    rides = []
+    for rental_id in range(count):
+        start = first + timedelta(minutes=int(rng.integers(0, 427 * 24 * 60)))
+        duration = int(rng.integers(60, 3600))
+        start_id, end_id = rng.choice(len(STATIONS), 2, p=[0.2, 0.2, 0.2, 0.15, 0.1, 0.05, 0.05, 0.05])
+        rides.append((rental_id, duration, start, start + timedelta(seconds=duration), STATIONS[start_id], STATIONS[end_id]))
+    return rides
+
+def known(station_id):
+    return station_id is not None and 0 <= station_id < MAX_STATION_ID
+
+def expected_flows(rides, start_date, end_date):
+    """
+    The rides per (start station, end station) pair, grouped straight from the rides
+    """
+    first_day, end_day = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    return Counter(
+        (start_id, end_id)
+        for _, _, start, _, start_id, end_id in rides
+        if first_day <= start.date() < end_day and known(start_id) and known(end_id)
+    )
+
+RANGES = [
+    ("2016-01-04", "2016-01-05"),   # a day
+    ("2016-02-01", "2016-03-01"),   # a month
+    ("2016-01-01", "2017-01-01"),   # a year
+    ("2015-12-15", "2017-01-20"),   # days, months and a year
+    ("2016-06-10", "2016-06-10"),   # empty
+    ("2016-03-01", "2016-02-01"),   # backwards
+    ("2014-01-01", "2014-02-01"),   # before the rides
+]
+
+@pytest.fixture
+def rides(make_ride_store, tmp_path, monkeypatch):
+    rides = random_rides()
+    make_ride_store(rides)
+    monkeypatch.setattr(flow_matrix, "FLOW_MATRIX_PATH", tmp_path / "flow_matrix.arrow")
+    monkeypatch.setattr(flow_matrix, "_flow_matrix", None)
+    save_block_table(flow_matrix.build_flow_matrix(), flow_matrix.FLOW_MATRIX_PATH)
+    return rides
+
+def test_pair_totals_match_a_group_by_of_the_rides(rides):
+    matrix = flow_matrix.get_flow_matrix()
+
+    for start_date, end_date in RANGES:
+        pairs, counts = matrix.pair_totals(start_date, end_date)
+        flows = {(int(pair // MAX_STATION_ID), int(pair % MAX_STATION_ID)): int(count) for pair, count in zip(pairs, counts)}
+
+        assert flows == expected_flows(rides, start_date, end_date), (start_date, end_date)
+        assert np.all(np.diff(pairs) > 0)
+
+def test_every_day_adds_up_to_the_whole_range(rides):
+    matrix = flow_matrix.get_flow_matrix()
+
+    total = Counter()
+    day = date(2016, 2, 1)
+    while day < date(2016, 3, 1):
+        pairs, counts = matrix.pair_totals(day.isoformat(), (day + timedelta(days=1)).isoformat())
+        total.update({int(pair): int(count) for pair, count in zip(pairs, counts)})
+        day += timedelta(days=1)
+
+    pairs, counts = matrix.pair_totals("2016-02-01", "2016-03-01")
+    assert total == {int(pair): int(count) for pair, count in zip(pairs, counts)}
+
+def small_registry():
+    # Station 5 has no borough
+    return StationRegistry(
+        [1, 2, 3, 4, 5],
+        ["One", "Two", "Three", "Four", "Five"],
+        [51.50, 51.51, 51.52, 51.53, 51.54],
+        [-0.10, -0.11, -0.12, -0.13, -0.14],
+        [0, 0, 1, 1, -1],
+        ["Camden", "Hackney"],
+        [100.0, 200.0],
+    )
+
+@pytest.fixture
+def client(rides, monkeypatch):
+    monkeypatch.setattr(main, "get_station_registry", small_registry)
+    return TestClient(app)
+
+def test_flows_endpoint_returns_the_busiest_station_pairs(rides, client):
+    response = client.get("/db/flows", params={"start_date": "2016-01-01", "end_date": "2017-01-01", "top_n": 5})
+
+    # Busiest first, ties in (start station, end station) order
+    busiest = sorted(expected_flows(rides, "2016-01-01", "2017-01-01").items(), key=lambda flow: (-flow[1], flow[0]))[:5]
+    names = {1: "One", 2: "Two", 3: "Three", 4: "Four", 5: "Five"}
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "start_station_id": start_id, "start_station_name": names[start_id],
+            "end_station_id": end_id, "end_station_name": names[end_id],
+            "rides": count,
+        }
+        for (start_id, end_id), count in busiest
+    ]
+
+def test_flows_endpoint_rolls_stations_up_into_boroughs(rides, client):
+    boroughs = {1: 0, 2: 0, 3: 1, 4: 1}
+    flows = Counter()
+    for (start_id, end_id), count in expected_flows(rides, "2015-12-15", "2017-01-20").items():
+        if start_id in boroughs and end_id in boroughs:
+            flows[boroughs[start_id], boroughs[end_id]] += count
+
+    response = client.get("/db/flows", params={"start_date": "2015-12-15", "end_date": "2017-01-20", "by": "borough"})
+
+    names = ["Camden", "Hackney"]
+    busiest = sorted(flows.items(), key=lambda flow: (-flow[1], flow[0]))
+    assert response.json() == [
+        {"start_borough": names[start], "end_borough": names[end], "rides": count}
+        for (start, end), count in busiest
+    ]
+
+def test_flows_endpoint_with_no_rides(client):
+    response = client.get("/db/flows", params={"start_date": "2014-01-01", "end_date": "2014-02-01"})
+
+    assert response.status_code == 200
+    assert response.json() == []
+    assert client.get("/db/flows", params={"start_date": "2014-01-01", "end_date": "2014-02-01", "by": "borough"}).json() == []
+
+def test_flows_endpoint_without_a_flow_matrix(client):
+    os.remove(flow_matrix.FLOW_MATRIX_PATH)
+
+    response = client.get("/db/flows", params={"start_date": "2016-01-01", "end_date": "2017-01-01"})
+
+    assert response.status_code == 503
+    assert "python -m backend.app.flow_matrix" in response.json()["detail"]
+
+def test_a_rebuilt_flow_matrix_is_reloaded(rides):
+    matrix = flow_matrix.get_flow_matrix()
+    assert flow_matrix.get_flow_matrix() is matrix
+
+    # Rebuilt with 7 rides from station 1 to 2 on one day, and a new modification time
+    path = flow_matrix.FLOW_MATRIX_PATH
+    save_block_table(flow_matrix.block_table(*flow_matrix.daily_flows(
+        np.array([(date(2016, 5, 1) - date(1970, 1, 1)).days]), np.array([1]), np.array([2]), np.array([7.0]),
+    ), flow_matrix.NUM_PAIRS), path)
+    os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 1_000_000_000))
+
+    reloaded = flow_matrix.get_flow_matrix()
+    assert reloaded is not matrix
+    pairs, counts = reloaded.pair_totals("2016-01-01", "2017-01-01")
+    assert pairs.tolist() == [1 * MAX_STATION_ID + 2] and counts.tolist() == [7]
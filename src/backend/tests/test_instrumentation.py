@@ -0,0 +1,87 @@
+import math
+import re
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from backend.app import instrumentation
+from backend.app.instrumentation import DURATION_BUCKETS, Histogram, InstrumentationMiddleware, histogram, server_timing, span
+
+def test_values_go_in_the_first_bucket_they_fit_under():
+    values = Histogram([1, 10, 100, math.inf])
+    for value in (0.5, 1, 1.5, 10, 99, 100, 101, 10_000):
+        values.observe(value)
+
+    assert values.counts == [2, 2, 2, 2]
+    assert values.count == 8 and values.max == 10_000
+    assert values.sum == sum((0.5, 1, 1.5, 10, 99, 100, 101, 10_000))
+
+def test_quantiles_are_bucket_upper_bounds_capped_at_the_max():
+    values = Histogram([1, 10, 100, math.inf])
+    for value in [0.5] * 50 + [5] * 49 + [5000]:
+        values.observe(value)
+
+    assert values.quantile(0.5) == 1
+    assert values.quantile(0.99) == 10
+    assert values.quantile(1) == 5000
+
+    single = Histogram([1, 10, 100, math.inf])
+    single.observe(7)
+    # The bucket's bound is 10, but nothing was over 7
+    assert single.quantile(0.5) == 7
+
+def test_stats_list_only_the_buckets_with_values():
+    values = Histogram(DURATION_BUCKETS)
+    values.observe(3)
+    values.observe(40_000)
+
+    stats = values.stats()
+
+    assert stats["count"] == 2 and stats["mean"] == 20001.5 and stats["max"] == 40000
+    assert stats["buckets"] == [{"le": 5, "count": 1}, {"le": "+Inf", "count": 1}]
+    assert Histogram(DURATION_BUCKETS).stats()["mean"] is None
+
+def test_server_timing_adds_up_repeated_spans():
+    header = server_timing([("query.get_trip_totals", 12.25), ("encode.json", 0.5), ("query.get_trip_totals", 1.0)], 20)
+
+    assert header == "query.get_trip_totals;dur=13.25, encode.json;dur=0.50, total;dur=20.00"
+    assert server_timing([], 3.14159) == "total;dur=3.14"
+
+def test_span_is_a_no_op_when_instrumentation_is_off(monkeypatch):
+    monkeypatch.setattr(instrumentation, "INSTRUMENTATION", False)
+
+    assert span("test.off") is span("test.other")
+    with span("test.off"):
+        pass
+    assert "test.off" not in instrumentation.metrics()["histograms"]
+
+def test_middleware_adds_the_request_spans_as_a_server_timing_header(monkeypatch):
+    monkeypatch.setattr(instrumentation, "INSTRUMENTATION", True)
+    monkeypatch.setattr(instrumentation, "SERVER_TIMING", True)
+    app = FastAPI()
+    app.add_middleware(InstrumentationMiddleware)
+
+    @app.get("/timed/{station_id}")
+    def timed_endpoint(station_id: int):
+        for _ in range(2):
+            with span("test.lookup"):
+                pass
+        return {"station_id": station_id}
+
+    response = TestClient(app).get("/timed/3")
+
+    assert response.json() == {"station_id": 3}
+    assert re.fullmatch(r"test\.lookup;dur=\d+\.\d{2}, total;dur=\d+\.\d{2}", response.headers["server-timing"])
+    assert histogram("test.lookup").count >= 2
+    # Requests are recorded by route, not by URL
+    assert histogram("request./timed/{station_id}").count == 1
+
+def test_middleware_leaves_the_header_out_without_server_timing(monkeypatch):
+    monkeypatch.setattr(instrumentation, "INSTRUMENTATION", True)
+    monkeypatch.setattr(instrumentation, "SERVER_TIMING", False)
+    app = FastAPI()
+    app.add_middleware(InstrumentationMiddleware)
+    app.get("/plain")(lambda: {})
+
+    response = TestClient(app).get("/plain")
+
+    assert response.status_code == 200
+    assert "server-timing" not in response.headers
@@ -0,0 +1,142 @@
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from backend.app import main, profile_tensor
+from backend.app.block_counts import save_block_table
+from backend.app.ride_store import MAX_STATION_ID
+from backend.app.station_registry import StationRegistry
+from backend.app.main import app
+
+LONDON = ZoneInfo("Europe/London")
+STATIONS = [1, 2, 3, 4, 5, None, -1, MAX_STATION_ID]
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+def random_rides(count=400, seed=0):
+    """
+    Rides from December 2015 to January 2017 between a few stations, some of them unknown or without an end,
+        and a few around the clock changes
+    """
+    rng = np.random.default_rng(seed)
+    first = utc(2015, 12, 1)
+    rides = []
+    for rental_id in range(count):
+        start = first + timedelta(minutes=int(rng.integers(0, 427 * 24 * 60)))
+        duration = int(rng.integers(60, 3600))
+        start_id, end_id = rng.choice(len(STATIONS), 2, p=[0.2, 0.2, 0.2, 0.15, 0.1, 0.05, 0.05, 0.05])
+        end = start + timedelta(seconds=duration) if rng.random() > 0.05 else None
+        rides.append((rental_id, duration, start, end, STATIONS[start_id], STATIONS[end_id]))
+    rides += [
+        (count, 600, utc(2016, 3, 27, 0, 55), utc(2016, 3, 27, 1, 5), 1, 2),     # 00:55 GMT to 02:05 BST
+        (count + 1, 600, utc(2016, 10, 29, 23, 30), utc(2016, 10, 30, 1, 30), 2, 1),  # Sunday 00:30 BST to 01:30 GMT
+        (count + 2, 600, utc(2016, 7, 4, 23, 30), utc(2016, 7, 5, 0, 10), 3, 3),  # Tuesday 00:30 BST, counted on Monday the 4th (UTC)
+    ]
+    return rides
+
+def known(station_id):
+    return station_id is not None and 0 <= station_id < MAX_STATION_ID
+
+def expected_profiles(rides, start_date, end_date):
+    """
+    The (directions x stations x days of week x hours) counts, grouped straight from the rides in London time
+    """
+    first_day, end_day = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    profiles = np.zeros(profile_tensor.PROFILE_SHAPE, dtype=np.int64)
+    for _, _, start, end, start_id, end_id in rides:
+        if not first_day <= start.date() < end_day:
+            continue
+        if known(start_id):
+            local = start.astimezone(LONDON)
+            profiles[0, start_id, local.weekday(), local.hour] += 1
+        if end is not None and known(end_id):
+            local = end.astimezone(LONDON)
+            profiles[1, end_id, local.weekday(), local.hour] += 1
+    return profiles
+
+RANGES = [
+    ("2016-03-27", "2016-03-28"),   # a day, over the clock change
+    ("2016-10-01", "2016-11-01"),   # a month
+    ("2016-01-01", "2017-01-01"),   # a year
+    ("2015-12-15", "2017-01-20"),   # days, months and a year
+    ("2016-06-10", "2016-06-10"),   # empty
+    ("2014-01-01", "2014-02-01"),   # before the rides
+]
+
+@pytest.fixture
+def rides(make_ride_store, tmp_path, monkeypatch):
+    rides = random_rides()
+    make_ride_store(rides)
+    monkeypatch.setattr(profile_tensor, "PROFILE_TENSOR_PATH", tmp_path / "profile_tensor.arrow")
+    monkeypatch.setattr(profile_tensor, "_profile_tensor", None)
+    save_block_table(profile_tensor.build_profile_tensor(), profile_tensor.PROFILE_TENSOR_PATH)
+    return rides
+
+def test_station_profiles_match_a_group_by_of_the_rides(rides):
+    tensor = profile_tensor.get_profile_tensor()
+
+    for start_date, end_date in RANGES:
+        assert np.array_equal(tensor.station_profiles(start_date, end_date), expected_profiles(rides, start_date, end_date)), (start_date, end_date)
+
+def test_hours_are_london_local_time(rides):
+    profiles = profile_tensor.get_profile_tensor().station_profiles("2016-03-27", "2016-03-28")
+
+    # Sunday 00:55 GMT, arriving at 02:05 BST
+    assert profiles[0, 1, 6, 0] == 1
+    assert profiles[1, 2, 6, 2] == 1
+
+    # Started on Monday the 4th in UTC, but on Tuesday in London
+    profiles = profile_tensor.get_profile_tensor().station_profiles("2016-07-04", "2016-07-05")
+    assert profiles[0, 3, 1, 0] == 1 and profiles[1, 3, 1, 1] == 1
+
+def small_registry():
+    # Station 5 has no borough
+    return StationRegistry(
+        [1, 2, 3, 4, 5],
+        ["One", "Two", "Three", "Four", "Five"],
+        [51.50, 51.51, 51.52, 51.53, 51.54],
+        [-0.10, -0.11, -0.12, -0.13, -0.14],
+        [0, 0, 1, 1, -1],
+        ["Camden", "Hackney"],
+        [100.0, 200.0],
+    )
+
+@pytest.fixture
+def client(rides, monkeypatch):
+    monkeypatch.setattr(main, "get_station_registry", small_registry)
+    return TestClient(app)
+
+PARAMS = {"start_date": "2015-12-15", "end_date": "2017-01-20"}
+
+def test_profile_endpoint_for_a_station_a_borough_and_the_network(rides, client):
+    expected = expected_profiles(rides, PARAMS["start_date"], PARAMS["end_date"])
+    days_of_week = np.bincount([(date(2015, 12, 15) + timedelta(days=n)).weekday() for n in range(402)], minlength=7).tolist()
+
+    station = client.get("/db/profile", params={**PARAMS, "station_id": 3}).json()
+    assert station == {"departures": expected[0, 3].tolist(), "arrivals": expected[1, 3].tolist(), "days_of_week": days_of_week}
+
+    # Camden is stations 1 and 2
+    borough = client.get("/db/profile", params={**PARAMS, "borough": "Camden"}).json()
+    assert borough["departures"] == (expected[0, 1] + expected[0, 2]).tolist()
+    assert borough["arrivals"] == (expected[1, 1] + expected[1, 2]).tolist()
+
+    network = client.get("/db/profile", params=PARAMS).json()
+    assert network["departures"] == expected[0].sum(axis=0).tolist()
+    assert network["arrivals"] == expected[1].sum(axis=0).tolist()
+    assert np.sum(network["departures"]) == sum(
+        1 for ride in rides if known(ride[4]) and date(2015, 12, 15) <= ride[2].date() < date(2017, 1, 20)
+    )
+
+def test_profile_endpoint_with_an_unknown_station_or_borough(client):
+    assert client.get("/db/profile", params={**PARAMS, "station_id": 42}).status_code == 404
+    assert client.get("/db/profile", params={**PARAMS, "borough": "Atlantis"}).status_code == 404
+
+def test_profile_endpoint_without_a_profile_tensor(client):
+    profile_tensor.PROFILE_TENSOR_PATH.unlink()
+
+    response = client.get("/db/profile", params=PARAMS)
+
+    assert response.status_code == 503
+    assert "python -m backend.app.profile_tensor" in response.json()["detail"]
@@ -0,0 +1,117 @@
+import threading
+import time
+from backend.app.query_cache import cached_query, query_listener
+from backend.app.query_executor import CancelToken, track_job
+
+class FakeJob:
+    def __init__(self):
+        self.cancelled = False
+
+    def done(self):
+        return False
+
+    def cancel(self):
+        self.cancelled = True
+
+class BlockingQuery:
+    """
+    A query that starts a fake BigQuery job, then blocks until it's released - counts how often it actually ran
+    """
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.job = FakeJob()
+
+    def __call__(self, start_date, end_date):
+        self.calls += 1
+        track_job(self.job)
+        assert self.release.wait(5)
+        return [start_date, end_date]
+
+def call_in_thread(query_function, token, *args):
+    results = []
+
+    def run():
+        query_listener.set(token)
+        try:
+            results.append(query_function(*args))
+        except Exception as error:
+            results.append(error)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, results
+
+def wait_until_joined(token):
+    # A call joins the in-flight query (attaching to its request's token) before it blocks
+    deadline = time.monotonic() + 5
+    while not token.participations:
+        assert time.monotonic() < deadline, "the call never joined the query"
+        time.sleep(0.005)
+
+def test_coalesces_calls_with_the_same_normalised_arguments():
+    query = BlockingQuery()
+    query_function = cached_query(persist=False)(query)
+    tokens = [CancelToken() for _ in range(3)]
+
+    owner = call_in_thread(query_function, tokens[0], "2015-01-04", "2016-01-01")
+    wait_until_joined(tokens[0])
+    waiters = [
+        call_in_thread(query_function, tokens[1], "2015-01-04T00:00:00", "2016-01-01"),
+        call_in_thread(query_function, tokens[2], "2015-01-04 00:00:00+00:00", "2016-01-01"),
+    ]
+    for token in tokens[1:]:
+        wait_until_joined(token)
+    query.release.set()
+
+    for thread, results in [owner] + waiters:
+        thread.join(5)
+        assert results == [["2015-01-04", "2016-01-01"]]
+    assert query.calls == 1
+    # Cached from then on
+    assert query_function("2015-01-04", "2016-01-01") == ["2015-01-04", "2016-01-01"]
+    assert query.calls == 1
+
+def test_shared_job_is_only_cancelled_when_every_listener_has_left():
+    query = BlockingQuery()
+    query_function = cached_query(persist=False)(query)
+    owner_token, waiter_token = CancelToken(), CancelToken()
+
+    owner = call_in_thread(query_function, owner_token, "2015-01-04", "2016-01-01")
+    wait_until_joined(owner_token)
+    waiter = call_in_thread(query_function, waiter_token, "2015-01-04", "2016-01-01")
+    wait_until_joined(waiter_token)
+
+    # The request that started the query disconnects - another one is still waiting
+    owner_token.cancel()
+    assert not query.job.cancelled
+
+    waiter_token.cancel()
+    assert query.job.cancelled
+
+    query.release.set()
+    for thread, _ in (owner, waiter):
+        thread.join(5)
+
+def test_abandoned_query_is_run_again_by_the_next_call():
+    query = BlockingQuery()
+    query_function = cached_query(persist=False)(query)
+    token = CancelToken()
+
+    first = call_in_thread(query_function, token, "2015-01-04", "2016-01-01")
+    wait_until_joined(token)
+    token.cancel()
+    assert query.job.cancelled
+
+    # A new call doesn't join the abandoned query, it starts its own
+    query.job = FakeJob()
+    second_token = CancelToken()
+    second = call_in_thread(query_function, second_token, "2015-01-04", "2016-01-01")
+    wait_until_joined(second_token)
+    query.release.set()
+
+    for thread, _ in (first, second):
+        thread.join(5)
+    assert second[1] == [["2015-01-04", "2016-01-01"]]
+    assert query.calls == 2
+    assert not query.job.cancelled
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import pytest
+from fastapi import HTTPException
+from backend.app import query_executor
+from backend.app.query_executor import CancelToken, ClientDisconnected, run_query, track_job
+
+class FakeJob:
+    def __init__(self, done=False):
+        self.finished = done
+        self.cancelled = False
+
+    def done(self):
+        return self.finished
+
+    def cancel(self):
+        self.cancelled = True
+
+class BlockingQuery:
+    """
+    A query that starts a fake BigQuery job, then blocks until it's released
+    """
+    def __init__(self):
+        self.job = FakeJob()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, value):
+        track_job(self.job)
+        self.started.set()
+        assert self.release.wait(5)
+        return value
+
+class FakeRequest:
+    """
+    A request whose client goes away once disconnect() is called
+    """
+    def __init__(self):
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(query_executor, "DISCONNECT_POLL_INTERVAL", 0.01)
+
+def test_returns_the_result_from_a_query_thread():
+    def query_function(start_date, end_date):
+        return threading.current_thread().name, start_date, end_date
+
+    thread_name, *arguments = asyncio.run(run_query(FakeRequest(), query_function, "2016-01-01", "2017-01-01"))
+
+    assert thread_name.startswith("query")
+    assert arguments == ["2016-01-01", "2017-01-01"]
+
+def test_errors_are_raised_to_the_caller():
+    def query_function():
+        raise ValueError("bad date")
+
+    with pytest.raises(ValueError, match="bad date"):
+        asyncio.run(run_query(None, query_function))
+
+def test_a_timeout_cancels_the_jobs_and_returns_504():
+    query = BlockingQuery()
+
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(run_query(FakeRequest(), query, 1, timeout=0.05))
+    # A job started after the timeout is cancelled as soon as it's tracked
+    assert query.started.wait(5)
+    query.release.set()
+
+    assert raised.value.status_code == 504
+    assert query.job.cancelled
+
+def test_a_disconnected_client_cancels_the_jobs():
+    query = BlockingQuery()
+    request = FakeRequest()
+
+    async def disconnect_once_started():
+        task = asyncio.ensure_future(run_query(request, query, 1))
+        await asyncio.to_thread(query.started.wait, 5)
+        request.disconnect()
+        return await task
+
+    with pytest.raises(ClientDisconnected):
+        asyncio.run(disconnect_once_started())
+    query.release.set()
+
+    assert query.job.cancelled
+
+def test_a_cancelled_request_cancels_the_jobs():
+    query = BlockingQuery()
+
+    async def cancel_once_started():
+        task = asyncio.ensure_future(run_query(FakeRequest(), query, 1))
+        await asyncio.to_thread(query.started.wait, 5)
+        task.cancel()
+        return await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancel_once_started())
+    query.release.set()
+
+    assert query.job.cancelled
+
+def test_a_finished_query_cancels_nothing():
+    query = BlockingQuery()
+    query.release.set()
+
+    assert asyncio.run(run_query(FakeRequest(), query, 42)) == 42
+    assert not query.job.cancelled
+
+def test_cancel_token_cancels_jobs_added_after_it_was_cancelled():
+    token = CancelToken()
+    running, finished = FakeJob(), FakeJob(done=True)
+    token.add_job(running)
+    token.add_job(finished)
+
+    token.cancel()
+    late = FakeJob()
+    token.add_job(late)
+
+    assert running.cancelled and late.cancelled
+    assert not finished.cancelled
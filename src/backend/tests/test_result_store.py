@@ -0,0 +1,139 @@
+from datetime import datetime, timezone
+import sqlite3
+from types import SimpleNamespace
+import pyarrow as pa
+import pytest
+from backend.app import result_store, server, station_cube
+from backend.app.result_store import ResultStore, decode_table, encode_table
+
+def sample_table(rows=3):
+    return pa.table({
+        "station_id": pa.array(range(rows), pa.int64()),
+        "name": pa.array([f"Station {i}" for i in range(rows)]),
+        "total_rides": pa.array([10.5 * i for i in range(rows)]),
+    })
+
+def test_encode_decode_round_trip():
+    table = sample_table()
+    assert decode_table(encode_table(table)).equals(table)
+
+def test_put_then_get_returns_the_same_table(tmp_path):
+    store = ResultStore(tmp_path / "results.sqlite")
+    table = sample_table()
+    store.put("key", "get_ordered_stations", "local", "v1", table)
+
+    assert store.get("key", "local", "v1").equals(table)
+    assert store.get("other key", "local", "v1") is None
+    assert store.stats()["hits"] == 1 and store.stats()["misses"] == 1
+
+def test_other_versions_are_never_returned(tmp_path):
+    store = ResultStore(tmp_path / "results.sqlite")
+    store.put("key", "get_ordered_stations", "local", "v1", sample_table())
+
+    assert store.get("key", "local", "v2") is None
+    # The old version of the same backend was purged when v2 was first seen
+    assert store.get("key", "local", "v1") is None
+
+def test_purge_leaves_the_other_backend_alone(tmp_path):
+    path = tmp_path / "results.sqlite"
+    ResultStore(path).put("key", "get_ordered_stations", "bigquery", "b1", sample_table())
+
+    # A process on the local backend, e.g. a CLI, opens the same store
+    ResultStore(path).get("another key", "local", "l1")
+
+    assert ResultStore(path).get("key", "bigquery", "b1") is not None
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    table = sample_table(1000)
+    size = len(encode_table(table))
+    store = ResultStore(tmp_path / "results.sqlite", max_bytes=int(size * 2.5))
+    for key in ("a", "b", "c"):
+        store.put(key, "get_ordered_stations", "local", "v1", table)
+
+    # Down to 90% of the bound - only the newest entries fit
+    assert store.get("a", "local", "v1") is None
+    assert store.get("c", "local", "v1") is not None
+    assert store.stats()["bytes"] <= store.max_bytes * 0.9
+
+def summed_size(store):
+    return store.connection().execute("SELECT IFNULL(SUM(size), 0) FROM results").fetchone()[0]
+
+def test_the_total_size_follows_every_write(tmp_path):
+    store = ResultStore(tmp_path / "results.sqlite")
+    store.put("a", "get_ordered_stations", "local", "v1", sample_table(10))
+    store.put("b", "get_ordered_stations", "bigquery", "b1", sample_table(20))
+    assert store.total_size(store.connection()) == summed_size(store) > 0
+
+    # Replacing an entry swaps its size
+    store.put("a", "get_ordered_stations", "local", "v1", sample_table(500))
+    assert store.total_size(store.connection()) == summed_size(store)
+
+    store.get("a", "local", "v2")   # purges v1
+    assert store.total_size(store.connection()) == summed_size(store) == len(encode_table(sample_table(20)))
+
+    store.clear()
+    assert store.stats()["bytes"] == 0 and store.stats()["entries"] == 0
+
+def test_the_total_size_is_shared_between_processes(tmp_path):
+    path = tmp_path / "results.sqlite"
+    first, second = ResultStore(path), ResultStore(path)
+    first.put("a", "get_ordered_stations", "local", "v1", sample_table(10))
+    second.put("b", "get_ordered_stations", "local", "v1", sample_table(10))
+
+    assert first.stats()["bytes"] == second.stats()["bytes"] == 2 * len(encode_table(sample_table(10)))
+
+def test_an_existing_store_gets_its_total_size(tmp_path):
+    path = tmp_path / "results.sqlite"
+    store = ResultStore(path)
+    store.put("a", "get_ordered_stations", "local", "v1", sample_table(10))
+    # A store from before its size was kept
+    connection = sqlite3.connect(str(path))
+    connection.executescript("DROP TABLE store_size; DROP TRIGGER results_insert; DROP TRIGGER results_update; DROP TRIGGER results_delete;")
+    connection.close()
+
+    reopened = ResultStore(path)
+    assert reopened.stats()["bytes"] == len(encode_table(sample_table(10)))
+
+class FakeBigQueryClient:
+    def __init__(self, modified):
+        self.modified = modified
+        self.calls = 0
+
+    def get_table(self, name):
+        self.calls += 1
+        return SimpleNamespace(modified=self.modified)
+
+@pytest.fixture
+def bigquery_backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "QUERY_BACKEND", "bigquery")
+    monkeypatch.setattr(station_cube, "STATION_CUBE_PATH", tmp_path / "no_cube.arrow")
+    monkeypatch.setattr(result_store, "_version", None)
+    monkeypatch.setattr(result_store, "_bigquery_version", None)
+    monkeypatch.setattr(result_store, "get_result_store", lambda: ResultStore(tmp_path / "results.sqlite"))
+    started = []
+    monkeypatch.setattr(result_store, "start_version_checks", lambda: started.append(True))
+    client = FakeBigQueryClient(datetime(2023, 1, 1, tzinfo=timezone.utc))
+    monkeypatch.setattr(server, "get_client", lambda: client)
+    return SimpleNamespace(client=client, started=started)
+
+def test_queries_never_wait_on_the_bigquery_table_version(bigquery_backend):
+    # Not read yet - the store is skipped, and the version thread is started instead
+    assert result_store.dataset_version() is None
+    assert bigquery_backend.started and bigquery_backend.client.calls == 0
+    result_store.save_result(test_queries_never_wait_on_the_bigquery_table_version, "fingerprint", ["2016-01-01"], sample_table())
+    assert result_store.load_result("fingerprint", ["2016-01-01"]) is None
+    assert result_store.get_result_store().stats()["entries"] == 0
+
+    result_store.check_bigquery_version()
+    version = result_store.dataset_version()
+    assert version is not None and bigquery_backend.client.calls == 1
+    assert result_store.dataset_version() == version and bigquery_backend.client.calls == 1
+
+def test_a_new_bigquery_table_version_takes_effect_at_once(bigquery_backend):
+    result_store.check_bigquery_version()
+    version = result_store.dataset_version()
+
+    bigquery_backend.client.modified = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    result_store.check_bigquery_version()
+
+    assert result_store.dataset_version() != version
@@ -0,0 +1,102 @@
+import asyncio
+from datetime import datetime, timezone
+import numpy as np
+import pyarrow as pa
+import pytest
+from backend.app import main, ride_metrics, station_cube
+from backend.app.ride_store import MAX_STATION_ID
+from backend.app.services import get_CO2_offset, get_ride_metrics
+from backend.app.spatial_index import EARTH_RADIUS_M, haversine_m
+from backend.app.station_registry import StationRegistry
+
+# Metres per 0.01 degrees of latitude
+CENTI_DEGREE_M = np.pi * EARTH_RADIUS_M / 180 * 0.01
+
+def small_registry():
+    # Station 5 has no coordinates
+    return StationRegistry(
+        [1, 2, 3, 5],
+        ["One", "Two", "Three", "Five"],
+        [51.50, 51.51, 51.50, np.nan],
+        [-0.10, -0.10, -0.12, np.nan],
+        [0, 0, -1, 0],
+        ["Camden"],
+        [100.0],
+    )
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = small_registry()
+    monkeypatch.setattr(ride_metrics, "get_station_registry", lambda: registry)
+    return registry
+
+def test_distance_matrix_between_every_pair_of_station_ids(registry):
+    distances = ride_metrics.station_distance_matrix(registry)
+
+    assert distances.shape == (MAX_STATION_ID, MAX_STATION_ID)
+    assert distances[1, 2] == pytest.approx(CENTI_DEGREE_M)
+    assert distances[1, 3] == pytest.approx(haversine_m(51.50, -0.10, 51.50, -0.12))
+    assert np.array_equal(distances, distances.T)
+    assert distances[1, 1] == 0
+    # Unknown stations and stations without coordinates are 0 km from everywhere
+    assert distances[1, 5] == 0 and distances[4, 2] == 0 and distances[MAX_STATION_ID - 1, 1] == 0
+    assert not distances.flags.writeable
+
+def test_trip_distances_follow_the_registry(registry, monkeypatch):
+    assert ride_metrics.trip_distances(np.array([1, 2, 1]), np.array([2, 1, 1])) == pytest.approx([CENTI_DEGREE_M, CENTI_DEGREE_M, 0])
+
+    moved = StationRegistry([1, 2], ["One", "Two"], [51.50, 51.52], [-0.10, -0.10], [0, 0], ["Camden"], [100.0])
+    monkeypatch.setattr(ride_metrics, "get_station_registry", lambda: moved)
+    assert ride_metrics.trip_distances(np.array([1]), np.array([2])) == pytest.approx([2 * CENTI_DEGREE_M])
+
+def test_trip_totals_table_sums_every_station():
+    totals = {
+        "trip_counts": np.array([1, 2, 3]),
+        "duration_sums": np.array([60, 0, 120]),
+        "distance_sums": np.array([1000, 500, 0]),
+    }
+
+    assert ride_metrics.trip_totals_table(totals).to_pylist() == [{"trips": 6, "duration": 180, "distance": 1500}]
+
+def test_cube_distances_are_the_trip_distances(registry, make_ride_store):
+    utc = timezone.utc
+    make_ride_store([
+        (1, 600, datetime(2016, 1, 4, 8, tzinfo=utc), datetime(2016, 1, 4, 8, 10, tzinfo=utc), 1, 2),
+        (2, 300, datetime(2016, 1, 4, 9, tzinfo=utc), datetime(2016, 1, 4, 9, 5, tzinfo=utc), 1, 3),
+        (3, None, datetime(2016, 1, 4, 9, tzinfo=utc), None, 1, 2),   # no duration - not a trip
+        (4, 60, datetime(2016, 1, 4, 9, tzinfo=utc), datetime(2016, 1, 4, 9, 1, tzinfo=utc), 1, 5),
+    ])
+
+    cube = station_cube.build_cube()
+
+    distance = cube.window("distance_sums", "2016-01-04", "2016-01-05")[1]
+    assert distance == round(CENTI_DEGREE_M + haversine_m(51.50, -0.10, 51.50, -0.12))
+    assert cube.window("trip_counts", "2016-01-04", "2016-01-05")[1] == 3
+
+def test_ride_metrics_estimates_the_CO2_offset_both_ways():
+    trip_totals = pa.table({"trips": [4], "duration": [36000], "distance": [12_345_678]})
+
+    metrics = get_ride_metrics(trip_totals)
+
+    # 36000 s at 4.17 m/s is 150 km, and 150 km by car is 25 kg of CO2
+    assert metrics == {
+        "trips": 4,
+        "duration_hours": 10.0,
+        "average_duration_minutes": 150.0,
+        "estimated_distance_km": 150,
+        "straight_line_distance_km": 12345,
+        "CO2_offset_kg": 25,
+        "straight_line_CO2_offset_kg": 2110,
+        "tree_equivalent": 1,
+    }
+    assert get_ride_metrics(pa.table({"trips": [0], "duration": [0], "distance": [0]}))["average_duration_minutes"] is None
+
+def test_CO2_offset_panel_is_based_on_the_duration(monkeypatch):
+    monkeypatch.setattr(main, "get_trip_totals", lambda start_date, end_date: pa.table({
+        "trips": [4], "duration": [36000], "distance": [12_345_678],
+    }))
+
+    panel = asyncio.run(main.get_CO2_offset_panel(None, "2016-01-01", "2017-01-01"))
+
+    assert panel == [25, 1, 150]
+    assert panel[0::2] == get_CO2_offset(36000)
@@ -0,0 +1,124 @@
+from datetime import date, datetime, timedelta, timezone
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from backend.app import ride_store
+from backend.app.ride_store import MAX_STATION_ID, RIDE_SCHEMA
+from backend.app.usage_windows import usage_periods
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+# (rental_id, duration, start_date, end_date, start_station_id, end_station_id)
+RIDES = [
+    (1, 600, utc(2016, 1, 31, 23, 50), utc(2016, 2, 1, 0, 0), 1, 2),
+    (2, None, utc(2016, 2, 1, 8), None, 1, None),
+    (3, 300, utc(2016, 1, 15, 9), utc(2016, 1, 15, 9, 5), -1, 2),
+    (4, 120, utc(2016, 2, 10, 12), utc(2016, 2, 10, 12, 2), MAX_STATION_ID + 5, 3),
+    (5, 60, utc(2016, 3, 2, 7), utc(2016, 3, 2, 7, 1), 3, 1),
+]
+
+def test_to_timestamp_reads_dates_as_utc():
+    assert ride_store.to_timestamp("2016-01-04") == utc(2016, 1, 4)
+    assert ride_store.to_timestamp("2016-01-04T10:30:00") == utc(2016, 1, 4, 10, 30)
+    assert ride_store.to_timestamp("2016-01-04T10:30:00+01:00") == utc(2016, 1, 4, 9, 30)
+    assert ride_store.to_timestamp(datetime(2016, 1, 4)).tzinfo is timezone.utc
+    with pytest.raises(ValueError):
+        ride_store.to_timestamp("not a date")
+
+def test_station_counts_drops_nulls_and_unknown_stations():
+    ids = pa.chunked_array([pa.array([1, 1, None, -3, 2, MAX_STATION_ID, MAX_STATION_ID - 1], pa.int32())])
+
+    counts = ride_store.station_counts(ids)
+
+    assert len(counts) == MAX_STATION_ID
+    assert counts[1] == 2 and counts[2] == 1 and counts[MAX_STATION_ID - 1] == 1
+    assert counts.sum() == 4
+
+class FakeQuery:
+    def __init__(self, table):
+        self.table = table
+
+    def result(self):
+        return self
+
+    def to_arrow_iterable(self):
+        # BigQuery hands back pages in no particular order
+        yield from reversed(self.table.to_batches(max_chunksize=2))
+
+class FakeClient:
+    def __init__(self, table):
+        self.table = table
+
+    def query(self, sql):
+        return FakeQuery(self.table)
+
+def test_ingest_partitions_by_start_month_and_sorts_each_month(tmp_path):
+    table = pa.table(dict(zip(RIDE_SCHEMA.names, zip(*RIDES))), schema=RIDE_SCHEMA)
+
+    ride_store.ingest_rides(FakeClient(table), tmp_path / "rides")
+
+    assert sorted(path.name for path in (tmp_path / "rides").iterdir()) == ["month=2016-01", "month=2016-02", "month=2016-03"]
+    assert not (tmp_path / "rides_staging").exists()
+    february = pq.read_table(tmp_path / "rides" / "month=2016-02" / "rides.parquet")
+    assert february.column("rental_id").to_pylist() == [2, 4]
+    assert february.schema.equals(RIDE_SCHEMA)
+    # Ride 1 started in January, so it stays there even though it ended in February
+    january = pq.read_table(tmp_path / "rides" / "month=2016-01" / "rides.parquet")
+    assert january.column("rental_id").to_pylist() == [3, 1]
+
+def test_min_and_max_dates_come_from_the_statistics(make_ride_store):
+    make_ride_store(RIDES)
+
+    assert ride_store.get_min_date().column("min_date").to_pylist() == [utc(2016, 1, 15, 9)]
+    # Rides without an end_date are left out of the max
+    assert ride_store.get_max_date().column("max_date").to_pylist() == [utc(2016, 3, 2, 7, 1)]
+
+def test_date_filters_only_open_the_months_they_cover(make_ride_store):
+    make_ride_store(RIDES)
+    (ride_store.RIDE_STORE_PATH / "month=2016-03" / "rides.parquet").write_bytes(b"not parquet")
+
+    # March is never read...
+    batches = list(ride_store.iter_station_daily_counts("2016-01-31", "2016-02-11"))
+    rows = pa.Table.from_batches(batches).to_pylist()
+    assert [(row["day"].isoformat(), row["station_id"], row["start_rides"], row["end_rides"]) for row in rows] == [
+        ("2016-01-31", 1, 1, 0),
+        ("2016-01-31", 2, 0, 1),
+        ("2016-02-01", 1, 1, 0),
+        ("2016-02-10", 3, 0, 1),
+    ]
+
+    # ...until a range covers it
+    with pytest.raises(pa.ArrowInvalid):
+        list(ride_store.iter_station_daily_counts("2016-02-01", "2016-03-05"))
+
+def test_daily_counts_skip_unknown_stations(make_ride_store):
+    make_ride_store(RIDES)
+
+    rows = pa.Table.from_batches(list(ride_store.iter_station_daily_counts("2016-01-15", "2016-01-16"))).to_pylist()
+
+    # Ride 3 started at station -1, so only its end counts
+    assert [(row["station_id"], row["start_rides"], row["end_rides"]) for row in rows] == [(2, 0, 1)]
+
+def test_no_months_in_range(make_ride_store):
+    make_ride_store(RIDES)
+
+    assert list(ride_store.iter_station_daily_counts("2015-01-01", "2015-02-01")) == []
+    assert list(ride_store.iter_station_daily_counts("2016-01-01", "2016-01-01")) == []
+
+def test_change_in_usage_counts_known_start_stations(make_ride_store):
+    start = utc(2016, 1, 1)
+    rides = [
+        (n, 60, start + timedelta(days=n), start + timedelta(days=n, minutes=1), [1, -2, None, MAX_STATION_ID][n % 4], 1)
+        for n in range(120)
+    ]
+    make_ride_store(rides)
+
+    table = ride_store.get_change_in_monthly_average_use_foreach_station("2016-01-01", "2016-04-30", 1)
+
+    start_period, end_period = usage_periods(date(2016, 1, 1), date(2016, 4, 30), date(2016, 1, 1), date(2016, 4, 29), 1)
+    def known_starts(period):
+        return sum(1 for ride in rides if ride[4] == 1 and period[0] <= ride[2].date() <= period[1])
+    assert table.to_pylist() == [
+        {"station_id": 1, "starting_period_avg": known_starts(start_period), "ending_period_avg": known_starts(end_period)},
+    ]
@@ -0,0 +1,61 @@
+import math
+import numpy as np
+import pytest
+from backend.app.spatial_index import EARTH_RADIUS_M, StationGrid, haversine_m
+
+# Metres per 0.01 degrees of latitude
+CENTI_DEGREE_M = math.pi * EARTH_RADIUS_M / 180 * 0.01
+
+LATITUDES = np.array([51.50, 51.51, np.nan, 51.52, 51.60, 51.50])
+LONGITUDES = np.array([-0.10, -0.10, -0.11, -0.10, -0.20, -0.12])
+
+def test_haversine_along_a_meridian():
+    distances = haversine_m(51.50, -0.10, np.array([51.50, 51.51, 51.52]), np.array([-0.10, -0.10, -0.10]))
+
+    assert distances == pytest.approx([0, CENTI_DEGREE_M, 2 * CENTI_DEGREE_M])
+
+def test_in_bbox_includes_the_edges_and_leaves_out_unknown_coordinates():
+    grid = StationGrid(LATITUDES, LONGITUDES)
+
+    assert sorted(grid.in_bbox(51.50, -0.12, 51.52, -0.10).tolist()) == [0, 1, 3, 5]
+    assert sorted(grid.in_bbox(51.505, -0.11, 51.53, -0.09).tolist()) == [1, 3]
+    assert grid.in_bbox(40.0, 10.0, 41.0, 11.0).tolist() == []
+
+def test_within_radius_nearest_first():
+    grid = StationGrid(LATITUDES, LONGITUDES)
+
+    rows, distances = grid.within_radius(51.50, -0.10, 2 * CENTI_DEGREE_M + 1)
+
+    assert rows.tolist() == [0, 1, 5, 3]
+    assert distances == pytest.approx(haversine_m(51.50, -0.10, LATITUDES[rows], LONGITUDES[rows]))
+    assert distances[0] == 0
+    assert distances[1] == pytest.approx(CENTI_DEGREE_M)
+
+    rows, _ = grid.within_radius(51.50, -0.10, CENTI_DEGREE_M - 1)
+    assert rows.tolist() == [0]
+
+def test_within_radius_outside_the_grid():
+    grid = StationGrid(LATITUDES, LONGITUDES)
+
+    rows, distances = grid.within_radius(10.0, 10.0, 1000)
+
+    assert rows.tolist() == [] and distances.tolist() == []
+
+def test_grid_matches_a_full_scan():
+    rng = np.random.default_rng(0)
+    latitudes = rng.uniform(51.45, 51.55, 500)
+    longitudes = rng.uniform(-0.25, 0.0, 500)
+    grid = StationGrid(latitudes, longitudes)
+
+    for _ in range(50):
+        latitude, longitude = rng.uniform(51.45, 51.55), rng.uniform(-0.25, 0.0)
+        radius = rng.uniform(100, 3000)
+        distances = haversine_m(latitude, longitude, latitudes, longitudes)
+        rows, found = grid.within_radius(latitude, longitude, radius)
+        assert rows.tolist() == np.argsort(distances, kind="stable")[:np.count_nonzero(distances <= radius)].tolist()
+
+        min_latitude, max_latitude = sorted(rng.uniform(51.45, 51.55, 2))
+        min_longitude, max_longitude = sorted(rng.uniform(-0.25, 0.0, 2))
+        inside = (latitudes >= min_latitude) & (latitudes <= max_latitude) & \
+            (longitudes >= min_longitude) & (longitudes <= max_longitude)
+        assert sorted(grid.in_bbox(min_latitude, min_longitude, max_latitude, max_longitude).tolist()) == np.flatnonzero(inside).tolist()
@@ -0,0 +1,213 @@
+from datetime import date, datetime, timezone
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pytest
+from backend.app import station_cube
+from backend.app.query_cache import cached_query, clear_query_caches
+from backend.app.ride_store import MAX_STATION_ID
+from backend.app.station_cube import MEASURES, StationCube, refresh_cube
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+def station_daily(counts_by_station, num_days):
+    # (days x stations) array with the given daily counts at a few stations
+    daily = np.zeros((num_days, MAX_STATION_ID), dtype=np.int64)
+    for station_id, counts in counts_by_station.items():
+        daily[:, station_id] = counts
+    return daily
+
+def small_cube(first_day=date(2016, 1, 1), counts=(1, 2, 3)):
+    daily = {measure: station_daily({1: counts}, len(counts)) for measure in MEASURES}
+    return StationCube.from_daily(first_day, daily, utc(2016, 1, 1, 8), utc(2016, 1, 3, 18))
+
+def cube_daily(cube, measure, station_id):
+    return cube.daily(measure, 0, cube.num_days)[:, station_id].tolist()
+
+def test_window_is_a_prefix_sum_difference():
+    cube = small_cube()
+    assert cube.window("start_counts", "2016-01-02", "2016-01-04")[1] == 2 + 3
+    assert cube.window("start_counts", "2015-06-01", "2016-01-02")[1] == 1
+    assert cube.window("start_counts", "2016-01-03", "2016-01-01")[1] == 0
+
+def test_fold_in_adds_to_existing_days_and_extends_the_cube():
+    updates = {measure: station_daily({1: [10, 20]}, 2) for measure in MEASURES}
+    cube = small_cube().fold_in(date(2016, 1, 3), updates, utc(2016, 1, 3, 9), utc(2016, 1, 4, 20))
+
+    assert cube_daily(cube, "start_counts", 1) == [1, 2, 13, 20]
+    assert cube.min_date == utc(2016, 1, 1, 8)
+    assert cube.max_date == utc(2016, 1, 4, 20)
+
+def test_fold_in_before_the_first_day_pads_the_cube():
+    updates = {measure: station_daily({1: [7]}, 1) for measure in MEASURES}
+    cube = small_cube().fold_in(date(2015, 12, 31), updates, utc(2015, 12, 31, 9), utc(2015, 12, 31, 10))
+
+    assert cube.first_day == date(2015, 12, 31)
+    assert cube_daily(cube, "start_counts", 1) == [7, 1, 2, 3]
+
+def test_fold_in_replace_drops_what_was_there_from_the_first_updated_day():
+    updates = {measure: station_daily({1: [5]}, 1) for measure in MEASURES}
+    cube = small_cube().fold_in(date(2016, 1, 2), updates, utc(2016, 1, 2, 9), utc(2016, 1, 2, 10), replace=True)
+
+    # Days after the updates are replaced too (with nothing)
+    assert cube_daily(cube, "start_counts", 1) == [1, 5, 0]
+
+def test_fold_in_does_not_write_to_the_original_cube():
+    cube = small_cube()
+    updates = {measure: station_daily({1: [10]}, 1) for measure in MEASURES}
+    cube.fold_in(date(2016, 1, 2), updates, utc(2016, 1, 2), utc(2016, 1, 2))
+    assert cube_daily(cube, "start_counts", 1) == [1, 2, 3]
+
+"""
+    REFRESH
+"""
+
+class FakeJob:
+    def __init__(self, table):
+        self.table = table
+
+    def to_arrow(self):
+        return self.table
+
+class FakeClient:
+    """
+    Returns canned refresh rows - (day, start station, end station, rides, trips, duration, min start, max end)
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.parameters = []
+
+    def query(self, sql, job_config):
+        self.parameters.append({parameter.name: parameter.value for parameter in job_config.query_parameters})
+        columns = list(zip(*self.rows)) or [()] * 8
+        return FakeJob(pa.table({
+            "day": pa.array(columns[0], pa.date32()),
+            "start_station_id": pa.array(columns[1], pa.int64()),
+            "end_station_id": pa.array(columns[2], pa.int64()),
+            "rides": pa.array(columns[3], pa.int64()),
+            "trips": pa.array(columns[4], pa.int64()),
+            "duration_sum": pa.array(columns[5], pa.int64()),
+            "min_date": pa.array(columns[6], pa.timestamp("us", tz="UTC")),
+            "max_date": pa.array(columns[7], pa.timestamp("us", tz="UTC")),
+        }))
+
+FIRST_PULL = [
+    (date(2016, 1, 1), 1, 2, 2, 2, 600, utc(2016, 1, 1, 8), utc(2016, 1, 1, 9)),
+    # No end station or end date yet - still counted as a start
+    (date(2016, 1, 2), 1, None, 1, 0, 0, utc(2016, 1, 2, 11), None),
+    (date(2016, 1, 2), 2, 1, 1, 1, 300, utc(2016, 1, 2, 10), utc(2016, 1, 2, 12)),
+]
+
+def test_refresh_without_a_cube_builds_it_from_the_whole_table():
+    client = FakeClient(FIRST_PULL)
+    cube = refresh_cube(client)
+
+    assert client.parameters == [{"replace_from": None}]
+    assert cube.first_day == date(2016, 1, 1)
+    assert cube_daily(cube, "start_counts", 1) == [2, 1]
+    assert cube_daily(cube, "end_counts", 2) == [2, 0]
+    assert cube_daily(cube, "trip_counts", 1) == [2, 0]
+    assert cube_daily(cube, "duration_sums", 1) == [600, 0]
+    assert cube_daily(cube, "duration_sums", 2) == [0, 300]
+    assert (cube.min_date, cube.max_date) == (utc(2016, 1, 1, 8), utc(2016, 1, 2, 12))
+
+def test_refresh_replaces_the_overlap_window_instead_of_adding_to_it():
+    cube = refresh_cube(FakeClient(FIRST_PULL))
+
+    # Everything from the day before the watermark's day, as it is in the table now: a ride landed late on
+    #   2016-01-01, the open ride on 2016-01-02 ended, and there's a new day
+    client = FakeClient([
+        (date(2016, 1, 1), 1, 2, 3, 3, 900, utc(2016, 1, 1, 8), utc(2016, 1, 1, 9)),
+        (date(2016, 1, 2), 1, 2, 1, 1, 200, utc(2016, 1, 2, 11), utc(2016, 1, 2, 13)),
+        (date(2016, 1, 2), 2, 1, 1, 1, 300, utc(2016, 1, 2, 10), utc(2016, 1, 2, 12)),
+        (date(2016, 1, 3), 2, 1, 1, 1, 100, utc(2016, 1, 3, 7), utc(2016, 1, 3, 8)),
+    ])
+    refreshed = refresh_cube(client, cube)
+
+    assert client.parameters == [{"replace_from": date(2016, 1, 1)}]
+    assert cube_daily(refreshed, "start_counts", 1) == [3, 1, 0]
+    assert cube_daily(refreshed, "start_counts", 2) == [0, 1, 1]
+    assert cube_daily(refreshed, "end_counts", 2) == [3, 1, 0]
+    assert cube_daily(refreshed, "trip_counts", 1) == [3, 1, 0]
+    assert cube_daily(refreshed, "duration_sums", 1) == [900, 200, 0]
+    assert refreshed.max_date == utc(2016, 1, 3, 8)
+
+def test_refresh_with_nothing_to_pull_keeps_the_cube():
+    cube = small_cube()
+    assert refresh_cube(FakeClient([]), cube) is cube
+
+"""
+    LOADING
+"""
+
+@pytest.fixture
+def cube_path(tmp_path, monkeypatch):
+    path = tmp_path / "station_cube.arrow"
+    monkeypatch.setattr(station_cube, "STATION_CUBE_PATH", path)
+    monkeypatch.setattr(station_cube, "_cube", None)
+    monkeypatch.setattr(station_cube, "_cube_mtime", None)
+    return path
+
+def save_with_mtime(cube, path, mtime):
+    # An explicit mtime, so two saves in the same instant still look like a change
+    cube.save(path)
+    os.utime(path, (mtime, mtime))
+
+def test_save_and_load_round_trip(cube_path):
+    small_cube().save(cube_path)
+
+    cube = station_cube.load_cube(cube_path)
+
+    assert cube.first_day == date(2016, 1, 1)
+    assert cube_daily(cube, "distance_sums", 1) == [1, 2, 3]
+    assert (cube.min_date, cube.max_date) == (utc(2016, 1, 1, 8), utc(2016, 1, 3, 18))
+
+def test_a_cube_without_every_measure_is_not_used(cube_path, capsys):
+    full_path = cube_path.with_name("full_cube.arrow")
+    small_cube().save(full_path)
+    table = ipc.open_file(pa.memory_map(str(full_path), "r")).read_all()
+    with ipc.new_file(str(cube_path), table.drop_columns(["distance_sums"]).schema) as writer:
+        writer.write_table(table.drop_columns(["distance_sums"]))
+
+    with pytest.raises(ValueError, match="distance_sums"):
+        station_cube.load_cube(cube_path)
+    assert station_cube.get_cube() is None
+    assert "Not using the station cube" in capsys.readouterr().out
+
+def test_a_changed_cube_clears_the_query_caches(cube_path):
+    calls = []
+
+    @cached_query(persist=False)
+    def get_first_day(start_date):
+        calls.append(start_date)
+        return station_cube.get_cube().first_day
+
+    save_with_mtime(small_cube(), cube_path, 1_000_000)
+    assert get_first_day("2016-01-01") == date(2016, 1, 1)
+    assert get_first_day("2016-01-01") == date(2016, 1, 1)
+    assert len(calls) == 1
+
+    # e.g. python -m backend.app.station_cube refresh, in another process
+    save_with_mtime(small_cube(first_day=date(2015, 1, 1)), cube_path, 2_000_000)
+    assert get_first_day("2016-01-01") == date(2015, 1, 1)
+    assert len(calls) == 2
+
+    cube_path.unlink()
+    with pytest.raises(AttributeError):
+        get_first_day("2016-01-01")
+
+def test_a_query_running_while_the_caches_are_cleared_is_not_cached():
+    calls = []
+
+    @cached_query(persist=False)
+    def query(start_date):
+        calls.append(start_date)
+        if len(calls) == 1:
+            clear_query_caches()
+        return len(calls)
+
+    assert query("2016-01-01") == 1
+    assert query("2016-01-01") == 2
+    assert query("2016-01-01") == 2
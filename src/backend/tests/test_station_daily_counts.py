@@ -0,0 +1,129 @@
+from datetime import date, datetime, timezone
+import json
+import sqlite3
+import pyarrow as pa
+import pytest
+from fastapi.testclient import TestClient
+from backend.app import ride_store, server, station_cube
+from backend.app.main import app
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+# (rental_id, duration, start_date, end_date, start_station_id, end_station_id)
+RIDES = [
+    (1, 600, utc(2016, 1, 30, 23, 50), utc(2016, 1, 31, 0, 0), 1, 2),
+    (2, None, utc(2016, 1, 31, 8), None, 1, None),            # still out - no end_date or end station
+    (3, 300, utc(2016, 1, 31, 9), None, 2, 1),                # end_date missing, end station known
+    (4, 120, utc(2016, 1, 31, 23, 59), utc(2016, 2, 1, 0, 1), 2, 2),
+    (5, 60, utc(2016, 2, 1, 7), utc(2016, 2, 1, 7, 1), None, 3),
+    (6, 60, utc(2016, 2, 2, 10), utc(2016, 2, 2, 10, 5), 3, 1), # starts on the end day - left out
+    (7, 60, utc(2016, 1, 29, 10), utc(2016, 1, 29, 11), 1, 1),  # before the first day - left out
+]
+
+# Every ride that started on 2016-01-30, 2016-01-31 or 2016-02-01, with or without an end_date
+EXPECTED = [
+    {"day": "2016-01-30", "station_id": 1, "start_rides": 1, "end_rides": 0},
+    {"day": "2016-01-30", "station_id": 2, "start_rides": 0, "end_rides": 1},
+    {"day": "2016-01-31", "station_id": 1, "start_rides": 1, "end_rides": 1},
+    {"day": "2016-01-31", "station_id": 2, "start_rides": 2, "end_rides": 1},
+    {"day": "2016-02-01", "station_id": 3, "start_rides": 0, "end_rides": 1},
+]
+
+class SqliteJob:
+    """
+    A finished BigQuery job, with its result computed by SQLite
+    """
+    cache_hit = False
+    total_bytes_processed = 0
+    total_bytes_billed = 0
+
+    def __init__(self, table):
+        self.table = table
+        self.total_rows = table.num_rows
+
+    def result(self, timeout=None, page_size=None):
+        return self
+
+    def to_arrow_iterable(self):
+        yield from self.table.to_batches(max_chunksize=2)
+
+    def done(self):
+        return True
+
+    def cancel(self):
+        pass
+
+class SqliteClient:
+    """
+    Runs the station_daily_counts SQL on a SQLite copy of the rides - SQLite reads the backquoted table name
+        as one identifier and the @name parameters as named parameters, so the query runs as written
+    """
+    def __init__(self, rides):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute(
+            "CREATE TABLE `bigquery-public-data.london_bicycles.cycle_hire` "
+            "(rental_id, duration, start_date, end_date, start_station_id, end_station_id)"
+        )
+        self.connection.executemany(
+            "INSERT INTO `bigquery-public-data.london_bicycles.cycle_hire` VALUES (?, ?, ?, ?, ?, ?)",
+            [tuple(value.isoformat(" ") if isinstance(value, datetime) else value for value in ride) for ride in rides],
+        )
+
+    def query(self, sql, job_config):
+        parameters = {parameter.name: str(parameter.value) for parameter in job_config.query_parameters}
+        cursor = self.connection.execute(sql, parameters)
+        names = [column[0] for column in cursor.description]
+        columns = list(zip(*cursor.fetchall())) or [()] * len(names)
+        table = pa.table({name: list(values) for name, values in zip(names, columns)})
+        return SqliteJob(table.set_column(0, "day", pa.array([date.fromisoformat(day) for day in columns[0]], pa.date32())))
+
+def rows(batches):
+    return [
+        {**row, "day": row["day"].isoformat()}
+        for batch in batches
+        for row in pa.Table.from_batches([batch]).to_pylist()
+    ]
+
+@pytest.fixture
+def rides(make_ride_store, monkeypatch):
+    make_ride_store(RIDES)
+    monkeypatch.setattr(server, "QUERY_BACKEND", "local")
+    monkeypatch.setattr(station_cube, "get_cube", lambda: None)
+
+def test_every_backend_counts_the_same_rides(rides, monkeypatch):
+    local = rows(ride_store.iter_station_daily_counts("2016-01-30", "2016-02-02"))
+    cube = rows(station_cube.build_cube().iter_station_daily_counts("2016-01-30", "2016-02-02"))
+
+    monkeypatch.setattr(server, "QUERY_BACKEND", "bigquery")
+    monkeypatch.setattr(server, "_client", SqliteClient(RIDES))
+    bigquery = rows(server.iter_station_daily_counts("2016-01-30", "2016-02-02"))
+
+    assert local == EXPECTED
+    assert cube == EXPECTED
+    assert bigquery == EXPECTED
+
+def test_times_of_day_are_ignored(rides):
+    # The range covers whole days, so a time on the end day doesn't add that day
+    assert rows(ride_store.iter_station_daily_counts("2016-01-30T12:00:00", "2016-02-02T23:00:00")) == EXPECTED
+
+def test_endpoint_streams_ndjson_and_json(rides, monkeypatch):
+    cube = station_cube.build_cube()
+    monkeypatch.setattr(station_cube, "get_cube", lambda: cube)
+    client = TestClient(app)
+
+    response = client.get("/get_station_daily_counts", params={"start_date": "2016-01-30", "end_date": "2016-02-02"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line) for line in response.text.splitlines()] == EXPECTED
+
+    response = client.get("/get_station_daily_counts", params={"start_date": "2016-01-30", "end_date": "2016-02-02", "format": "json"})
+    assert response.headers["content-type"].startswith("application/json")
+    assert response.json() == EXPECTED
+
+def test_endpoint_with_no_rides(rides):
+    client = TestClient(app)
+
+    response = client.get("/get_station_daily_counts", params={"start_date": "2010-01-01", "end_date": "2010-02-01", "format": "json"})
+    assert response.json() == []
+    assert client.get("/get_station_daily_counts", params={"start_date": "2010-01-01", "end_date": "2010-02-01"}).text == ""
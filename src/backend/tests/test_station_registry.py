@@ -0,0 +1,88 @@
+import json
+import os
+import pytest
+from backend.app import borough_assignment, station_registry
+from backend.app.reference_build import write_table
+
+STATION_DETAILS = [
+    {"id": 1, "name": "River Street , Clerkenwell", "borough": "Islington"},
+    {"id": 3, "name": "Christopher Street, Liverpool Street", "borough": "Hackney"},
+    {"id": None, "name": "No id", "borough": None},
+]
+STATION_COORDS = [
+    {"id": 1, "latitude": 51.529, "longitude": -0.110},
+    {"id": 3, "latitude": 51.521, "longitude": -0.085},
+]
+BOROUGH_POPULATIONS = [
+    {"borough": "Islington", "population_2021": 216600},
+    {"borough": "Hackney", "population_2021": 259200},
+]
+
+def write_json(path, data, mtime=None):
+    path.write_text(json.dumps(data))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    write_json(tmp_path / "station_details.json", STATION_DETAILS, 1_000_000)
+    write_json(tmp_path / "station_coords.json", STATION_COORDS, 1_000_000)
+    write_json(tmp_path / "borough_populations.json", BOROUGH_POPULATIONS, 1_000_000)
+    monkeypatch.setattr(station_registry, "DATA_PATH", tmp_path)
+    monkeypatch.setattr(station_registry, "STATION_TABLE_PATH", tmp_path / "stations.arrow")
+    monkeypatch.setattr(station_registry, "BOROUGH_TABLE_PATH", tmp_path / "boroughs.arrow")
+    monkeypatch.setattr(borough_assignment, "STATION_BOROUGHS_PATH", tmp_path / "station_boroughs.npz")
+    monkeypatch.setattr(borough_assignment, "load_station_boroughs", lambda: None)
+    monkeypatch.setattr(station_registry, "_registry", None)
+    monkeypatch.setattr(station_registry, "_registry_mtimes", None)
+    monkeypatch.setattr(station_registry, "_last_checked", 0)
+    return tmp_path
+
+def test_loads_the_json_reference_files(data_path):
+    registry = station_registry.get_station_registry()
+
+    assert registry.name_of(3) == "Christopher Street, Liverpool Street"
+    assert registry.name_of(2) is None
+    assert registry.borough_of(1) == "Islington"
+    assert registry.coords_of(3) == (51.521, -0.085)
+    assert registry.population_of("Hackney") == 259200
+
+def test_unchanged_files_keep_the_same_registry(data_path, monkeypatch):
+    registry = station_registry.get_station_registry()
+    monkeypatch.setattr(station_registry, "RELOAD_CHECK_INTERVAL", 0)
+
+    assert station_registry.get_station_registry() is registry
+
+def test_a_changed_file_is_reloaded_after_the_check_interval(data_path, monkeypatch):
+    registry = station_registry.get_station_registry()
+    renamed = [{**STATION_DETAILS[0], "name": "Renamed"}] + STATION_DETAILS[1:]
+    write_json(data_path / "station_details.json", renamed, 2_000_000)
+
+    # Not checked again until RELOAD_CHECK_INTERVAL has passed...
+    monkeypatch.setattr(station_registry, "RELOAD_CHECK_INTERVAL", 3600)
+    assert station_registry.get_station_registry() is registry
+
+    # ...then rebuilt and swapped in - the old registry is left as it was, for whoever still holds it
+    monkeypatch.setattr(station_registry, "RELOAD_CHECK_INTERVAL", 0)
+    reloaded = station_registry.get_station_registry()
+    assert reloaded is not registry
+    assert reloaded.name_of(1) == "Renamed"
+    assert registry.name_of(1) == "River Street , Clerkenwell"
+
+def test_the_station_table_is_only_used_while_it_is_current(data_path, monkeypatch, capsys):
+    monkeypatch.setattr(station_registry, "RELOAD_CHECK_INTERVAL", 0)
+    stations, boroughs = station_registry.get_station_registry().to_tables()
+    # A table that says something else, so it's clear where the registry came from
+    stations = stations.set_column(stations.schema.get_field_index("name"), "name", [["From the table", "From the table too"]])
+    for table, path in ((stations, data_path / "stations.arrow"), (boroughs, data_path / "boroughs.arrow")):
+        write_table(table, path)
+        os.utime(path, (1_500_000, 1_500_000))
+
+    assert station_registry.get_station_registry().name_of(1) == "From the table"
+
+    # A reference file changed after the table was built
+    write_json(data_path / "station_coords.json", STATION_COORDS, 2_000_000)
+    registry = station_registry.get_station_registry()
+
+    assert registry.name_of(1) == "River Street , Clerkenwell"
+    assert "The station table is out of date" in capsys.readouterr().out
@@ -0,0 +1,59 @@
+from datetime import date
+import numpy as np
+import pytest
+from backend.app.usage_windows import shift_months, usage_change_table, usage_periods
+
+MIN_DATE = date(2015, 1, 4)
+MAX_DATE = date(2022, 9, 13)
+
+@pytest.mark.parametrize("day, months, expected", [
+    (date(2015, 11, 15), 3, date(2016, 2, 15)),
+    (date(2015, 2, 15), -3, date(2014, 11, 15)),
+    # The day is clamped to the end of the month, like DATE_ADD(..., INTERVAL n MONTH)
+    (date(2015, 1, 31), 1, date(2015, 2, 28)),
+    (date(2016, 1, 31), 1, date(2016, 2, 29)),
+    (date(2015, 3, 31), -1, date(2015, 2, 28)),
+    (date(2015, 12, 31), 12, date(2016, 12, 31)),
+])
+def test_shift_months(day, months, expected):
+    assert shift_months(day, months) == expected
+
+def test_periods_are_45_days_either_side_of_the_dates():
+    assert usage_periods(date(2016, 6, 1), date(2017, 1, 1), MIN_DATE, MAX_DATE) == (
+        (date(2016, 4, 17), date(2016, 7, 16)),
+        (date(2016, 11, 17), date(2017, 2, 15)),
+    )
+
+def test_starting_period_before_the_first_ride_runs_for_the_window_from_it():
+    start_period, _ = usage_periods(date(2015, 1, 10), date(2017, 1, 1), MIN_DATE, MAX_DATE)
+    assert start_period == (date(2015, 1, 4), date(2015, 4, 4))
+
+def test_starting_period_after_the_last_ride_is_cut_at_it():
+    start_period, _ = usage_periods(date(2022, 9, 1), date(2022, 9, 10), MIN_DATE, MAX_DATE)
+    assert start_period == (date(2022, 7, 18), date(2022, 9, 13))
+
+def test_ending_period_after_the_last_ride_runs_for_the_window_up_to_it():
+    _, end_period = usage_periods(date(2016, 6, 1), date(2022, 9, 1), MIN_DATE, MAX_DATE)
+    assert end_period == (date(2022, 6, 13), date(2022, 9, 13))
+
+def test_ending_period_before_the_first_ride_starts_at_it():
+    _, end_period = usage_periods(date(2015, 1, 5), date(2015, 1, 20), MIN_DATE, MAX_DATE)
+    assert end_period == (date(2015, 1, 4), date(2015, 3, 6))
+
+def test_window_months_sets_the_period_length():
+    assert usage_periods(date(2016, 6, 1), date(2017, 1, 1), MIN_DATE, MAX_DATE, window_months=1) == (
+        (date(2016, 5, 17), date(2016, 6, 16)),
+        (date(2016, 12, 17), date(2017, 1, 16)),
+    )
+
+def test_usage_change_table_averages_per_month_for_stations_with_rides():
+    starting = np.array([0, 3, 0, 10])
+    ending = np.array([0, 0, 5, 4])
+
+    table = usage_change_table(starting, ending)
+
+    assert table.to_pydict() == {
+        "station_id": [1, 2, 3],
+        "starting_period_avg": [1.0, 0.0, 3.33],
+        "ending_period_avg": [0.0, 1.67, 1.33],
+    }